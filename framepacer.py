@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import unittest
+from PyQt5 import QtCore
+
+class FramePacer(QtCore.QObject):
+  '''Coalesce a stream of updates (such as mouse moves) into at most one per frame.
+     post() just records the latest arguments; a timer later calls the callback
+     with only the most recent ones, so a backlog of events can't build up
+     no matter how long each update takes.
+  '''
+
+  def __init__(self, callback, frameRate=60, parent=None):
+    super().__init__(parent)
+    self._callback = callback
+    self._pending = None
+    self._timer = QtCore.QTimer(self)
+    self._timer.setSingleShot(True)
+    self._timer.timeout.connect(self.flush)
+    self._lastFrame = QtCore.QElapsedTimer()
+    self.setFrameRate(frameRate)
+    self.resetCounters()
+
+  def resetCounters(self):
+    self.posted = 0   # number of calls to post()
+    self.merged = 0   # number of posted updates superseded by a later one
+    self.frames = 0   # number of times the callback was actually called
+
+  def setFrameRate(self, frameRate):
+    'Set the target number of updates per second (0 = as fast as possible).'
+    self._interval = int(1000 / frameRate) if frameRate > 0 else 0
+
+  def isPending(self):
+    return not self._pending is None
+
+  def post(self, *args):
+    'Schedule the callback to be called with args, replacing any not yet called.'
+    self.posted += 1
+    if not self._pending is None:
+      self.merged += 1
+    self._pending = args
+    if not self._timer.isActive():
+      wait = 0
+      if self._lastFrame.isValid():
+        wait = max(0, self._interval - self._lastFrame.elapsed())
+      self._timer.start(wait)
+
+  @QtCore.pyqtSlot()
+  def flush(self):
+    'Call the callback now with the latest posted arguments, if any.'
+    self._timer.stop()
+    if self._pending is None: return
+    args = self._pending
+    self._pending = None
+    self._lastFrame.start()
+    self.frames += 1
+    self._callback(*args)
+
+  def cancel(self):
+    'Forget any posted update without calling the callback.'
+    self._timer.stop()
+    self._pending = None
+
+class TestFramePacer(unittest.TestCase):
+
+  def setUp(self):
+    self.app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([__file__])
+    self.calls = []
+    self.pacer = FramePacer(lambda *args: self.calls.append(args))
+
+  def waitFor(self, condition, ms=1000):
+    'Run the event loop until condition() is true, or ms pass.'
+    clock = QtCore.QElapsedTimer()
+    clock.start()
+    while not condition() and clock.elapsed() < ms:
+      self.app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+
+  def test_Coalesce(self):
+    p = self.pacer
+    for k in range(3):
+      p.post(k, 'x')
+    self.assertTrue(p.isPending())
+    self.assertEqual((p.posted, p.merged, p.frames), (3, 2, 0))
+    self.waitFor(lambda: self.calls)
+    self.assertEqual(self.calls, [(2, 'x')])
+    self.assertEqual(p.frames, 1)
+    self.assertFalse(p.isPending())
+    p.resetCounters()
+    self.assertEqual((p.posted, p.merged, p.frames), (0, 0, 0))
+
+  def test_Flush(self):
+    p = self.pacer
+    p.flush()  # nothing posted
+    self.assertEqual(self.calls, [])
+    p.post(1)
+    p.post(2)
+    p.flush()
+    self.assertEqual(self.calls, [(2,)])
+    self.waitFor(lambda: False, 50)
+    self.assertEqual(self.calls, [(2,)])  # not called again by the timer
+
+  def test_Cancel(self):
+    p = self.pacer
+    p.post(1)
+    p.cancel()
+    self.assertFalse(p.isPending())
+    self.waitFor(lambda: False, 50)
+    self.assertEqual((self.calls, p.frames), ([], 0))
+
+  def test_FrameRate(self):
+    p = self.pacer
+    p.setFrameRate(10)
+    p.post(1)
+    self.waitFor(lambda: self.calls)
+    clock = QtCore.QElapsedTimer()
+    clock.start()
+    p.post(2)  # within 100 ms of the last frame, so waits for the next
+    self.waitFor(lambda: len(self.calls) == 2)
+    self.assertGreaterEqual(clock.elapsed(), 50)
+    self.assertEqual(self.calls, [(1,), (2,)])
+    p.setFrameRate(0)  # as fast as possible
+    p.post(3)
+    clock.restart()
+    self.waitFor(lambda: len(self.calls) == 3)
+    self.assertLess(clock.elapsed(), 50)
+
+if __name__=='__main__':
+  unittest.main()
@@ -1,77 +1,125 @@
+#!/usr/bin/env python3
 
-import re
-import itertools
+import re, sys, array, functools, itertools, unittest
 import xml.etree.ElementTree as ET
 from PyQt5.QtCore import QPointF
 from PyQt5.QtGui import QPolygonF, QTransform
 
 logger = None
 
+# Files saved by this program repeat the same few colors and similar transforms
+# many thousands of times, so those parsers remember recent results.
+PARSE_CACHE_SIZE = 4096
+
+_colorRE = re.compile(r'#([0-9A-Fa-f]{3}|[0-9A-Fa-f]{6}|[0-9A-Fa-f]{8})$')
+_separatorRE = re.compile(r'\s+,?\s*|,\s*')
+_transformRE = re.compile(r'[\s,]*(\w+)\s*\(([^)]*)\)')
+_numberRE = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[Ee][+-]?\d+)?')
+_pathCmdRE = re.compile(r'\s*([MmZzLlHhVvCcSsQqTtAa])([^MmZzLlHhVvCcSsQqTtAa]*)')
+_pathArgsRE = re.compile(r'(?:[\s,]*{})*[\s,]*'.format(_numberRE.pattern))
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
 def ParseColor(s):
-  c = None
-  if re.match(r'^\s*#[0-9A-Fa-f]{3}\s*$', s):
-    c = (int(h+h,16) for h in s[1:])                        # #RGB -> (R,G,B)
-  elif re.match(r'^\s*#[0-9A-Fa-f]{6}\s*$', s):
-    c = (int(h,16) for h in [s[1:3],s[3:5],s[5:7]])         # #RRGGBB -> (R,G,B)
-  elif re.match(r'^\s*#[0-9A-Fa-f]{8}\s*$', s):
-    c = (int(h,16) for h in [s[3:5],s[5:7],s[7:9],s[1:3]])  # #AARRGGBB -> (R,G,B,A)
-  return c
+  'Parse "#RGB", "#RRGGBB" or "#AARRGGBB" into an (R,G,B) or (R,G,B,A) tuple, or return None'
+  m = _colorRE.match(s.strip())
+  if not m: return None
+  h = m.group(1)
+  if len(h) == 3:
+    return tuple(int(c+c,16) for c in h)                        # #RGB -> (R,G,B)
+  elif len(h) == 6:
+    return tuple(int(h[i:i+2],16) for i in (0,2,4))             # #RRGGBB -> (R,G,B)
+  else:
+    return tuple(int(h[i:i+2],16) for i in (2,4,6,0))           # #AARRGGBB -> (R,G,B,A)
 
 def SplitFloatValues(s):
   if not s or s.isspace(): return []
-  return [float(n) for n in re.split(r'\s+,?\s*|,\s*', s.strip())]
+  return [float(n) for n in _separatorRE.split(s.strip())]
 
 def FloatsToQPointFs(values):
   'Convert an iterable of floats into a list of QPointF objects (two floats per point)'
   return list( QPointF(*xy) for xy in zip(values[::2], values[1::2]) )
 
+def ArrayToQPolygonF(values):
+  '''Convert an array('d') of x,y pairs into a QPolygonF,
+     copying it into the polygon's own storage all at once.'''
+  poly = QPolygonF(len(values) // 2)
+  if values:
+    buf = poly.data()   # QPointF is stored as two doubles
+    buf.setsize(len(values) * values.itemsize)
+    memoryview(buf)[:] = memoryview(values).cast('B')
+  return poly
+
+def ParsePoints(s):
+  '''Parse an SVG points attribute (or any other list of coordinate pairs) into a QPolygonF.
+     The coordinates are converted into a contiguous array of doubles,
+     which is then copied into the polygon in bulk.
+  '''
+  try:
+    values = array.array('d', map(float, s.replace(',', ' ').split()))
+  except ValueError:
+    values = None
+  if values is None or len(values) % 2:
+    # Unusual input: take the slow path, which will complain about anything truly bad.
+    return QPolygonF(FloatsToQPointFs(SplitFloatValues(s)))
+  return ArrayToQPolygonF(values)
+
 def ParseTransformAttrib(s):
   # where s is an SVG transform attribute such as "translate(-2,1) matrix(0 1 2 3 4 5)"
   # return a list of QTransforms
   xforms = []
-  s = s.lower()
-  while s:
-    s = re.sub(r'^\s+,?\s+', '', s)  # remove leading WS,WS
-    m = re.match(r'\s*(\w+)\s*\(((\s*[0-9Ee.+-]+\s*,?)+)\)', s) # match identifier(numbers) clause
-    if m:
-      values = SplitFloatValues(m.group(2))
-      if m.group(1) == 'translate':
-        if len(values) == 1: values.append(0)
-        xforms.append( QTransform.fromTranslate(*values) )
-      elif m.group(1) == 'scale':
-        if len(values) == 1: values.append(values[0])
-        xforms.append( QTransform.fromScale(*values) )
-      elif m.group(1) == 'rotate':
-        xforms.append( QTransform().rotate(values[0]) )  # TODO: handle cx,cy values
-      elif m.group(1) == 'matrix':
-        logger.trace('matrix({}): m.group(2) = {}', values, m.group(2))
-        xforms.append( QTransform( values[0], values[1], 0
-                                 , values[2], values[3], 0
-                                 , values[4], values[5], 1) )
-      # TODO: handle skewX and skewY
-      else: logger.warning('unrecognized transform: {}', m.group())
-      s = s[m.end()+1:]
-    else:
-      if s: logger.warning('unparsed transform: {}', s)
-      break
+  pos = 0
+  for m in _transformRE.finditer(s):
+    if m.start() != pos: break  # something between clauses that isn't a clause
+    pos = m.end()
+    name = m.group(1).lower()
+    values = SplitFloatValues(m.group(2))
+    if name == 'translate':
+      if len(values) == 1: values.append(0)
+      xforms.append( QTransform.fromTranslate(*values) )
+    elif name == 'scale':
+      if len(values) == 1: values.append(values[0])
+      xforms.append( QTransform.fromScale(*values) )
+    elif name == 'rotate':
+      xforms.append( QTransform().rotate(values[0]) )  # TODO: handle cx,cy values
+    elif name == 'matrix':
+      logger.trace('matrix({}): m.group(2) = {}', values, m.group(2))
+      xforms.append( QTransform( values[0], values[1], 0
+                               , values[2], values[3], 0
+                               , values[4], values[5], 1) )
+    # TODO: handle skewX and skewY
+    else: logger.warning('unrecognized transform: {}', m.group())
+  if s[pos:] and not s[pos:].isspace():
+    logger.warning('unparsed transform: {}', s[pos:])
   return xforms
 
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _ParseTransform(s):
+  xform = QTransform()
+  for t in reversed(ParseTransformAttrib(s)):
+    xform *= t
+  return xform
+
+def ParseTransform(s):
+  'Parse an SVG transform attribute into one (combined) QTransform'
+  return QTransform(_ParseTransform(s))  # a copy, since QTransforms are mutable
+
 def ParseSvgPathData(s):
-  '''Break SVG path data (the value of a 'd' attrib) down into a list of strings,
-    each containing a command with its arguments.
+  '''Break SVG path data (the value of a 'd' attrib) down into a list of
+    (command, [numbers]) tuples.
   '''
   pathCmds = []
-  s = s.strip()
-  while s:
-    # Commands are a single letter. Whitespace is only required for separating numbers.
-    m = re.match(r'\s*([A-Za-z])((\s*[0-9Ee.+-]*\s*,?)+)', s) # match "C numbers" clause
-    if m:
-      values = SplitFloatValues(m.group(2))
-      pathCmds.append( (m.group(1), values) )
-      s = s[m.end():]
-    else:
-      if s: logger.warning('unparsed path data: {}', s)
-      break
+  pos = 0
+  # Commands are a single letter. Whitespace is only required for separating numbers.
+  for m in _pathCmdRE.finditer(s):
+    if m.start() != pos: break  # something before (or between) commands
+    pos = m.end()
+    args = m.group(2)
+    values = [float(n) for n in _numberRE.findall(args)]
+    if not _pathArgsRE.fullmatch(args):
+      logger.warning('unparsed path data: {}', args)
+    pathCmds.append( (m.group(1), values) )
+  if s[pos:] and not s[pos:].isspace():
+    logger.warning('unparsed path data: {}', s[pos:])
   return pathCmds
 
 def SvgPathCmdsToPolygons(pathCmds):
@@ -192,18 +240,18 @@ def ParseStyleAttrib(s):
       d[namevalue[0].strip()] = namevalue[1].strip()
   return d
 
+_intAttribs = frozenset(('tiles:shapeno',))
+_floatAttribs = frozenset('tiles:size cx cy rx ry'.split())
+
 def ParseSvgAttribs(e):
   d = {}
   for k,v in e.attrib.items():
-    if k in 'tiles:shapeno'.split():
+    if k in _intAttribs:
       d[k] = int(v)
-    elif k in 'tiles:size cx cy rx ry'.split():
+    elif k in _floatAttribs:
       d[k] = float(v)
     elif k == 'points':
-      values = SplitFloatValues(v)
-      points = FloatsToQPointFs(values)
-      logger.trace('polygon {}', points)
-      d[k] = points
+      d[k] = ParsePoints(v)
     elif k == 'd':
       d[k] = ParseSvgPathData(v)
     elif k == 'fill':
@@ -215,12 +263,9 @@ def ParseSvgAttribs(e):
       try:
         d[k] = int(float(v) * 255)
       except ValueError:
-        logger.trace('failed to parse attribute: {}="{}"', name, ds[name])
+        logger.trace('failed to parse attribute: {}="{}"', k, v)
     elif k == 'transform':
-      xform = QTransform()
-      for t in reversed(ParseTransformAttrib(v)):
-        xform *= t
-      d[k] = xform
+      d[k] = ParseTransform(v)
     elif k == 'style':
       ds = ParseStyleAttrib(v)
       ignored = []
@@ -239,3 +284,75 @@ def ParseSvgAttribs(e):
     else: logger.trace('unparsed attribute: {}="{}"', k, v)
   return d
 
+class TestSvgParsing(unittest.TestCase):
+
+  def setUp(self):
+    global logger
+    if logger is None:
+      import tilelog
+      logger = tilelog.NotLogger()
+
+  def test_ParseColor(self):
+    self.assertEqual(ParseColor('#f0a'), (255,0,170))
+    self.assertEqual(ParseColor(' #FF00aa '), (255,0,170))
+    self.assertEqual(ParseColor('#80FF00aa'), (255,0,170,128))
+    self.assertIsNone(ParseColor('red'))
+
+  def test_SplitFloatValues(self):
+    self.assertEqual(SplitFloatValues(' 1,2 -3.5e1 , .5 '), [1,2,-35,.5])
+    self.assertEqual(SplitFloatValues(''), [])
+
+  def test_ParsePoints(self):
+    expected = [QPointF(1,2), QPointF(-3.5,.5)]
+    self.assertEqual(list(ParsePoints('1,2 -3.5,0.5')), expected)
+    self.assertEqual(list(ParsePoints(' 1 2,-3.5e0 .5 ')), expected)
+    self.assertEqual(list(ParsePoints('1,2,-3.5,.5')), expected)
+    self.assertEqual(list(ParsePoints('')), [])
+    self.assertRaises(ValueError, ParsePoints, '1,2 x,4')
+
+  def test_ParseTransform(self):
+    xf = ParseTransform('translate(1 2) matrix(0 1 -1 0 0 0),scale(2)')
+    expected = QTransform(0,2,-2,0,1,2)
+    self.assertEqual(xf, expected)
+    xf.translate(5,5)  # must not alter the cached transform
+    self.assertEqual(ParseTransform('translate(1 2) matrix(0 1 -1 0 0 0),scale(2)'), expected)
+    self.assertEqual(len(ParseTransformAttrib('rotate(90)translate(1)')), 2)
+
+  def test_ParseSvgPathData(self):
+    self.assertEqual( ParseSvgPathData('M0,0 l1-1e1.5.5 z')
+                    , [('M',[0,0]), ('l',[1,-10,.5,.5]), ('z',[])] )
+    polys = SvgPathCmdsToPolygons(ParseSvgPathData('m 1,1 2,0 0,2 z'))
+    self.assertEqual(list(polys[0]), [QPointF(1,1), QPointF(3,1), QPointF(3,3)])
+
+def _benchmark(n=20000):
+  'Print how many attributes of various kinds can be parsed per second.'
+  import time, random, tilelog
+  global logger
+  if logger is None: logger = tilelog.NotLogger()
+  rand = random.Random(1)
+  colors = ['#{:06x}'.format(rand.randrange(1<<24)) for i in range(40)]
+  xforms = [ 'translate({} {}) matrix({} {} {} {} 0 0)'.format(rand.randrange(-99,99), rand.randrange(-99,99), *r)
+             for r in ((1,0,0,1), (0,1,-1,0), (-1,0,0,-1), (0,-1,1,0)) for i in range(25) ]
+  bigPoints = ' '.join('{!r},{!r}'.format(rand.uniform(-9,9), rand.uniform(-9,9)) for i in range(300))
+  points = '0.5,-0.5 1.5,-0.5 1.5,0.5 0.5,0.5 0.5,1.5 -0.5,1.5 -0.5,0.5 -1.5,0.5 -1.5,-0.5 -0.5,-0.5'
+  path = 'M 0.5,-0.5 L 1.5,-0.5 1.5,0.5 0.5,0.5 0.5,1.5 -0.5,1.5 -0.5,0.5 -1.5,0.5 -1.5,-0.5 -0.5,-0.5 Z'
+  cases = [ ('fill', [rand.choice(colors) for i in range(n)])
+          , ('transform', [rand.choice(xforms) for i in range(n)])
+          , ('points', [points] * n)
+          , ('points', [bigPoints] * (n//100))
+          , ('d', [path] * n)
+          ]
+  for (name, values) in cases:
+    n = len(values)
+    elements = [ET.Element('polygon', {name: v}) for v in values]
+    t = time.perf_counter()
+    for e in elements:
+      ParseSvgAttribs(e)
+    dt = time.perf_counter() - t
+    print('{:>10}: {:9.0f} attributes/s'.format(name, n/dt))
+
+if __name__=='__main__':
+  if '--benchmark' in sys.argv:
+    _benchmark()
+  else:
+    unittest.main()
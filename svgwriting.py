@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import io, functools, unittest
+from xml.sax.saxutils import escape
+from PyQt5.QtGui import QTransform
+from q2str import FormatQTransform
+
+logger = None
+
+def QuoteAttrib(value):
+  'Return value (a str) as a double-quoted XML attribute value.'
+  # Substring tests are much quicker than a regex search over long points lists.
+  if '&' in value or '<' in value or '"' in value:
+    value = escape(value, {'"': '&quot;'})
+  return '"' + value + '"'
+
+def FormatAttribs(attribs):
+  'Format (name, value) pairs as XML attributes, each preceded by a space.'
+  return ''.join([' ' + k + '=' + QuoteAttrib(v) for (k,v) in attribs])
+
+@functools.lru_cache(maxsize=1024)
+def FormatMatrix(t):
+  'Format a QTransform for SVG, remembering recent results since most tiles share a few.'
+  if not t.isAffine():
+    logger.warning('Loss of transformation: {}', FormatQTransform(t))
+  if t.type() == QTransform.TxTranslate:
+    return 'translate(%r %r)' % (t.dx(), t.dy())
+  return 'matrix(%r %r %r %r %r %r)' % (t.m11(), t.m12(), t.m21(), t.m22(), t.m31(), t.m32())
+
+def FormatTransform(pos, t):
+  '''Format a position and QTransform as an SVG transform attribute.
+     Note that SVG and QTransform matrices are relatively transposed.
+     Floats are written with repr(), the shortest string that reads back exactly.
+  '''
+  (x, y) = (pos.x(), pos.y())
+  if t.isIdentity():
+    return 'translate(%r %r)' % (x, y)
+  elif not (x or y):
+    return FormatMatrix(t)
+  return 'translate(%r %r) %s' % (x, y, FormatMatrix(t))
+
+class SVGWriter(object):
+  '''Write an SVG document straight to a text stream, element by element,
+     rather than building an ElementTree of the whole document first.
+     The presentation attributes of each distinct fill color are formatted
+     only once, as documents typically have thousands of tiles but only a
+     handful of colors.  Likewise, shapes can be define()d once, in <defs>,
+     and then drawn any number of times with <use xlink:href="#id">.
+  '''
+
+  def __init__(self, f):
+    self._write = f.write
+    self._styles = {}  # QColor.rgba() -> formatted fill attributes
+    self._open = []    # tags of elements started but not yet ended
+    self._ids = {}     # define()d key -> '#id'
+
+  def declaration(self, decl):
+    self._write(decl)
+    self._write('\n')
+
+  def start(self, tag, attribs=()):
+    'Write the start tag of an element that will contain other elements.'
+    self._write('{}<{}{}>\n'.format('  ' * len(self._open), tag, FormatAttribs(attribs)))
+    self._open.append(tag)
+
+  def end(self):
+    'Write the end tag of the most recently started element.'
+    tag = self._open.pop()
+    self._write('{}</{}>\n'.format('  ' * len(self._open), tag))
+
+  def close(self):
+    'End any elements still open.'
+    while self._open:
+      self.end()
+
+  def element(self, tag, attribs=(), style=''):
+    '''Write an empty element.  style is preformatted attributes, as from fillStyle().
+       Attribute values must be strs.
+    '''
+    self._write('{}<{}{}{} />\n'.format('  ' * len(self._open), tag, FormatAttribs(attribs), style))
+
+  def define(self, key, tag, attribs):
+    '''Unless key has already been defined, write an element with a new id,
+       which reference(key) will then return.  Call this within <defs>.'''
+    if not key in self._ids:
+      name = 'shape{}'.format(len(self._ids))
+      self.element(tag, [('id', name)] + list(attribs))
+      self._ids[key] = '#' + name
+
+  def reference(self, key):
+    "Return the '#id' of the element define()d for key, or None."
+    return self._ids.get(key)
+
+  def fillStyle(self, color):
+    'Return formatted fill attributes for a shape filled with QColor color.'
+    rgba = color.rgba()
+    style = self._styles.get(rgba)
+    if style is None:
+      style = ' fill="{}"'.format(color.name())
+      if color.alpha() != 255:  # SVG's default fill-opacity is 1
+        style += ' fill-opacity="{!r}"'.format(color.alphaF())
+      self._styles[rgba] = style
+    return style
+
+class TestSVGWriter(unittest.TestCase):
+
+  def test_QuoteAttrib(self):
+    self.assertEqual(QuoteAttrib('1,2 3,4'), '"1,2 3,4"')
+    self.assertEqual(QuoteAttrib('a<b & "c"'), '"a&lt;b &amp; &quot;c&quot;"')
+
+  def test_FormatTransform(self):
+    from PyQt5.QtCore import QPointF
+    self.assertEqual( FormatTransform(QPointF(.1, -2), QTransform(0,1,-1,0,0,0))
+                    , 'translate(0.1 -2.0) matrix(0.0 1.0 -1.0 0.0 0.0 0.0)' )
+    self.assertEqual(FormatTransform(QPointF(.1, -2), QTransform()), 'translate(0.1 -2.0)')
+    self.assertEqual(FormatTransform(QPointF(0, 0), QTransform.fromTranslate(3, 4)), 'translate(3.0 4.0)')
+
+  def test_SVGWriter(self):
+    from PyQt5.QtGui import QColor
+    import xml.etree.ElementTree as ET
+    f = io.StringIO()
+    w = SVGWriter(f)
+    w.declaration('<?xml version="1.0" encoding="utf-8" standalone="no"?>')
+    w.start('svg', [('xmlns', 'http://www.w3.org/2000/svg')])
+    w.start('g', [('id', 'a&b')])
+    style = w.fillStyle(QColor(255,0,0,128))
+    self.assertIs(w.fillStyle(QColor(255,0,0,128)), style)
+    self.assertEqual(w.fillStyle(QColor(0,255,0)), ' fill="#00ff00"')
+    w.element('polygon', [('points', '0,0 1,0 0,1')], style)
+    w.start('defs')
+    w.define('tri', 'polygon', [('points', '0,0 1,0 0,1')])
+    w.define('tri', 'polygon', [('points', '0,0 1,0 0,1')])
+    w.end()
+    w.element('use', [('href', w.reference('tri'))], style)
+    self.assertIsNone(w.reference('square'))
+    w.close()
+    doc = ET.fromstring(f.getvalue().encode())
+    g = doc[0]
+    self.assertEqual(g.get('id'), 'a&b')
+    self.assertEqual(g[0].get('fill'), '#ff0000')
+    self.assertEqual(float(g[0].get('fill-opacity')), 128/255)
+    self.assertEqual(g[0].get('points'), '0,0 1,0 0,1')
+    self.assertEqual(len(g[1]), 1)
+    self.assertEqual(g[2].get('href'), '#' + g[1][0].get('id'))
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+'''Background autosave.
+
+An AutoSaver keeps each tile of a TileScene packed as a .tiles TILE record,
+re-packing only the tiles that tileChanged reports, a slice at a time on
+the GUI thread.  Joining the records into a snapshot is then cheap, and a
+worker thread writes it out as a .tiles file, replacing the oldest of a
+small ring of versions.  Each process autosaves to a ring of its own,
+which it holds a lock on, so a ring whose lock is not held was left
+behind by a crash.
+'''
+
+import concurrent.futures, os, unittest
+from PyQt5 import QtCore
+
+import tilesfile
+
+AUTOSAVE_VERSIONS = 3  # number of recent versions kept
+
+def WriteSnapshot(f, snapshot):
+  'Write a snapshot (as made by AutoSaver) to binary file f in .tiles format.'
+  (shapeData, nTiles, records, storeRecords) = snapshot
+  if not storeRecords is None:
+    import tilestore
+    (storeRecords, promoted, shapeMap) = storeRecords
+    storeRecords = tilestore.PackRecords(storeRecords, promoted, shapeMap)
+    nTiles += len(storeRecords) // tilesfile.TILE.size
+  tilesfile.WriteHeader(f, shapeData, nTiles)
+  f.write(records)
+  if not storeRecords is None:
+    f.write(storeRecords)
+
+class AutoSaveRing(object):
+  '''A directory of the most recent few autosaved versions of a document.
+     Each version is written to a temporary file, flushed to disk, then
+     renamed over the oldest, so a crash while writing can only lose the
+     version being written.
+     The process using a ring lock()s it, so others know it isn't orphaned.
+  '''
+
+  LOCK_NAME = 'lock'
+  RECOVERED_NAME = 'recovered.tiles'
+
+  def __init__(self, directory, versions=AUTOSAVE_VERSIONS):
+    self.directory = directory
+    self.versions = versions
+    self._lock = None
+
+  def slotPath(self, k):
+    return os.path.join(self.directory, 'autosave-{}.tiles'.format(k))
+
+  def recoveredPath(self):
+    'Return where a version recovered from an orphaned ring may be kept while it is open.'
+    return os.path.join(self.directory, self.RECOVERED_NAME)
+
+  def lock(self):
+    '''Try to claim this ring for this process, without waiting.  Return True
+       if it is now locked by this process, False if another running process
+       holds it.  A lock left by a process that is no longer running is taken over.'''
+    if self._lock is None:
+      os.makedirs(self.directory, exist_ok=True)
+      lock = QtCore.QLockFile(os.path.join(self.directory, self.LOCK_NAME))
+      lock.setStaleLockTime(0)  # stale only if its process has ended, however long it has run
+      if not lock.tryLock(0):
+        return False
+      self._lock = lock
+    return True
+
+  def unlock(self):
+    if not self._lock is None:
+      self._lock.unlock()
+      self._lock = None
+
+  def paths(self):
+    'Return the paths of the existing versions, most recent first.'
+    found = []
+    for k in range(self.versions):
+      p = self.slotPath(k)
+      try:
+        found.append((os.stat(p).st_mtime_ns, k, p))
+      except OSError:
+        pass
+    return [ p for (_t, _k, p) in sorted(found, reverse=True) ]
+
+  def write(self, writeTo):
+    '''Call writeTo(f) with a binary file object to write a new version to,
+       replacing the oldest version.  Return the path written.'''
+    existing = self.paths()
+    if len(existing) < self.versions:
+      used = set(existing)
+      path = next(self.slotPath(k) for k in range(self.versions) if not self.slotPath(k) in used)
+    else:
+      path = existing[-1]
+    os.makedirs(self.directory, exist_ok=True)
+    tmp = path + '.tmp'
+    try:
+      with open(tmp, 'wb') as f:
+        writeTo(f)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp, path)
+    except:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      raise
+    return path
+
+  def discard(self):
+    '''Delete all versions and any recovered version, release the lock, and
+       remove the directory.  A recovered version still open (on some
+       platforms) is left, along with the directory, for a later discard().'''
+    for k in range(self.versions):
+      for p in (self.slotPath(k), self.slotPath(k) + '.tmp'):
+        if os.path.exists(p):
+          os.remove(p)
+    try:
+      os.remove(self.recoveredPath())
+    except OSError:
+      pass
+    self.unlock()
+    try:
+      os.rmdir(self.directory)
+    except OSError:
+      pass
+
+def OwnRing(root, versions=AUTOSAVE_VERSIONS):
+  'Return a new, locked AutoSaveRing for this process, in a directory under root named for it.'
+  name = '{}-{}'.format(os.getpid(), QtCore.QDateTime.currentMSecsSinceEpoch())
+  ring = AutoSaveRing(os.path.join(root, name), versions)
+  if not ring.lock():
+    raise OSError('cannot lock autosave directory {}'.format(ring.directory))
+  return ring
+
+def OrphanedRings(root, versions=AUTOSAVE_VERSIONS):
+  '''Return the AutoSaveRings under root that no running process holds (so
+     were left behind by a crash), locked by this process, the one with the
+     most recent version first.  Those with no versions are discarded.'''
+  try:
+    names = os.listdir(root)
+  except OSError:
+    return []
+  found = []
+  for name in names:
+    directory = os.path.join(root, name)
+    if not os.path.isdir(directory):
+      continue
+    ring = AutoSaveRing(directory, versions)
+    if not ring.lock():
+      continue  # in use
+    paths = ring.paths()
+    if paths:
+      found.append((os.stat(paths[0]).st_mtime_ns, name, ring))
+    else:
+      ring.discard()
+  return [ ring for (_t, _n, ring) in sorted(found, reverse=True) ]
+
+class AutoSaver(QtCore.QObject):
+  '''Autosaves the tiles of a TileScene to an AutoSaveRing, in the background,
+     some time after they change.
+     Nothing is written unless tileChanged has been emitted since the last
+     version.  The GUI thread only re-packs the changed tiles, in slices of at
+     most SLICE_MS, and joins the packed records; the worker thread does the
+     rest, including packing the records of any TileStore.
+  '''
+
+  INTERVAL_MS = 30000  # time from a change until the autosave starts
+  SLICE_MS = 8         # most time to spend packing tiles per turn of the event loop: half a 60 Hz frame
+
+  # Emitted with the path of each version written.
+  saved = QtCore.pyqtSignal(str)
+
+  # (path or '', error message or '') from the worker thread
+  _written = QtCore.pyqtSignal(str, str)
+
+  def __init__(self, logger, scene, ring, parent=None):
+    super().__init__(parent)
+    self._log = logger
+    self._scene = scene
+    self._ring = ring
+    self._shapes = tilesfile.ShapeTable()
+    self._records = {}        # item -> packed TILE record, as of when it last changed
+    self._dirty = set()       # items to (re)pack before the next snapshot
+    self._changed = False     # whether tileChanged was emitted since the last snapshot
+    self._storeItems = set()  # items promoted from the scene's TileStore, as of the last snapshot
+    self._store = None        # the TileStore self._storeShapeMap is for
+    self._storeShapeMap = None
+    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self._writing = False
+    self._stopped = False
+    self._timer = QtCore.QTimer(self)
+    self._timer.setSingleShot(True)
+    self._timer.setInterval(self.INTERVAL_MS)
+    self._timer.timeout.connect(self.startSnapshot)
+    self._sliceTimer = QtCore.QTimer(self)
+    self._sliceTimer.timeout.connect(self.snapshotSlice)
+    self._written.connect(self.writeFinished)
+    scene.tileChanged.connect(self.noteChange)
+    self.resetCounters()
+
+  def resetCounters(self):
+    self.snapshots = 0      # number of snapshots taken
+    self.slices = 0         # number of turns of the event loop spent on them
+    self.longestSlice = 0   # most ms spent on the GUI thread in one turn
+
+  def ring(self):
+    return self._ring
+
+  def setInterval(self, ms):
+    self._timer.setInterval(ms)
+
+  def isBusy(self):
+    return self._sliceTimer.isActive() or self._writing
+
+  @QtCore.pyqtSlot(object)
+  def noteChange(self, change):
+    for it in change.removed:
+      self._records.pop(it, None)
+      self._dirty.discard(it)
+    self._dirty |= change.added
+    self._dirty |= change.modified
+    self._changed = True
+    if not self.isBusy() and not self._timer.isActive():
+      self._timer.start()
+
+  @QtCore.pyqtSlot()
+  def startSnapshot(self):
+    if self._stopped:
+      return
+    if self.isBusy():
+      return  # writeFinished() will try again
+    self._changed = False
+    self._sliceTimer.start(0)
+
+  def syncStoreItems(self):
+    'Track the items promoted from (or demoted back to) the TileStore, which tileChanged does not report.'
+    store = self._scene.tileStore()
+    promoted = set() if store is None else { it for (_i, it) in store.promotedItems() }
+    for it in self._storeItems - promoted:
+      self._records.pop(it, None)
+    self._dirty |= promoted - self._storeItems
+    self._storeItems = promoted
+    if not store is self._store:
+      self._store = store
+      self._storeShapeMap = None if store is None else \
+        [ self._shapes.index(tilesfile.StoredShapeKey(s)) for s in store.shapes() ]
+
+  @QtCore.pyqtSlot()
+  def snapshotSlice(self):
+    clock = QtCore.QElapsedTimer()
+    clock.start()
+    scene = self._scene
+    records = self._records
+    if not self._dirty:
+      self.syncStoreItems()
+    while self._dirty and clock.elapsed() < self.SLICE_MS:
+      it = self._dirty.pop()
+      if it.scene() is scene and type(it) in tilesfile.tile_types:
+        buf = bytearray(tilesfile.TILE.size)
+        tilesfile.PackTile(buf, 0, it, self._shapes)
+        records[it] = bytes(buf)
+      else:
+        records.pop(it, None)
+      if not self._dirty:
+        self.syncStoreItems()  # in case more were promoted meanwhile
+    if not self._dirty:
+      self._sliceTimer.stop()
+      storeRecords = None
+      if not self._store is None:
+        storeRecords = self._store.snapshot() + (self._storeShapeMap,)
+      snapshot = (list(self._shapes.data), len(records), b''.join(records.values()), storeRecords)
+      self._writing = True
+      self._pool.submit(self.write, snapshot)
+      self.snapshots += 1
+    self.slices += 1
+    self.longestSlice = max(self.longestSlice, clock.elapsed())
+    if not self._sliceTimer.isActive():
+      self._log.debug('autosave snapshot {}: {} tiles, {} slices so far, longest {} ms'
+                     , self.snapshots, len(records), self.slices, self.longestSlice)
+
+  def write(self, snapshot):
+    'Write a snapshot to the ring.  Called on the worker thread.'
+    try:
+      path = self._ring.write(lambda f: WriteSnapshot(f, snapshot))
+      self._written.emit(path, '')
+    except Exception as e:
+      self._written.emit('', str(e) or type(e).__name__)
+
+  @QtCore.pyqtSlot(str, str)
+  def writeFinished(self, path, error):
+    self._writing = False
+    if error:
+      self._log.warning('autosave failed: {}', error)
+    else:
+      self._log.debug('autosaved to {}', path)
+      self.saved.emit(path)
+    if self._changed and not self._timer.isActive():
+      self._timer.start()
+
+  def stop(self):
+    'Stop autosaving, and wait for any version being written.  Stopping again does nothing.'
+    if self._stopped:
+      return
+    self._stopped = True
+    self._scene.tileChanged.disconnect(self.noteChange)
+    self._timer.stop()
+    self._sliceTimer.stop()
+    self._pool.shutdown(wait=True)
+
+class TestAutoSaveRing(unittest.TestCase):
+
+  def test_Ring(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+      ring = AutoSaveRing(os.path.join(d, 'autosave'), versions=2)
+      self.assertEqual(ring.paths(), [])
+      written = []
+      for i in range(3):
+        written.append(ring.write(lambda f: f.write(bytes([i]))))
+        os.utime(written[-1], ns=(i * 10**9, i * 10**9))  # don't depend on the file system's timestamp resolution
+      self.assertEqual(ring.paths(), [written[2], written[1]])
+      self.assertEqual(written[2], written[0])  # the oldest was replaced
+      with open(ring.paths()[0], 'rb') as f:
+        self.assertEqual(f.read(), bytes([2]))
+      self.assertRaises(ZeroDivisionError, ring.write, lambda f: 1/0)
+      self.assertEqual(sorted(os.listdir(ring.directory)), sorted(os.path.basename(p) for p in written[1:]))
+      ring.discard()
+      self.assertFalse(os.path.exists(ring.directory))
+
+  def test_OrphanedRings(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as root:
+      mine = OwnRing(root)
+      mine.write(lambda f: f.write(b'mine'))
+      self.assertEqual(OrphanedRings(root), [])  # locked by a running process
+      # As if left by a crash: versions, but nothing holding the lock.
+      crashed = AutoSaveRing(os.path.join(root, 'crashed'))
+      crashed.write(lambda f: f.write(b'crashed'))
+      os.makedirs(os.path.join(root, 'empty'))
+      found = OrphanedRings(root)
+      self.assertEqual([ r.directory for r in found ], [crashed.directory])
+      self.assertFalse(os.path.exists(os.path.join(root, 'empty')))
+      self.assertFalse(AutoSaveRing(crashed.directory).lock())  # now held by found[0]
+      found[0].discard()
+      mine.discard()
+      self.assertEqual(os.listdir(root), [])
+
+class TestRecovery(unittest.TestCase):
+
+  def test_DeclineThenClose(self):
+    import tempfile
+    from PyQt5 import QtWidgets
+    import tilelog, tileitems, tilemain
+    tileitems.logger = tilelog.NotLogger()
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([__file__])
+    QtCore.QStandardPaths.setTestModeEnabled(True)
+    question = QtWidgets.QMessageBox.question
+    QtWidgets.QMessageBox.question = lambda *args: QtWidgets.QMessageBox.No
+    try:
+      w = tilemain.MagneticTilesMainWindow(tilelog.NotLogger())
+      root = w._autoSaveRoot
+      crashed = AutoSaveRing(os.path.join(root, 'crashed'))
+      crashed.write(lambda f: f.write(b'crashed'))
+      self.assertFalse(w.offerRecovery())
+      self.assertFalse(os.path.exists(crashed.directory))
+      # Still autosaving this document.
+      w.scene.recordChange(modified=[ it for it in w.scene.items() if hasattr(it, 'sceneSnapPoints') ][:1])
+      self.assertTrue(w.autoSaver._timer.isActive())
+      ring = w.autoSaver.ring()
+      w.setWindowModified(False)
+      self.assertTrue(w.close())
+      self.assertFalse(os.path.exists(ring.directory))
+      w.autoSaver.stop()  # again
+    finally:
+      QtWidgets.QMessageBox.question = question
+      QtCore.QStandardPaths.setTestModeEnabled(False)
+
+  def test_WriteSnapshot(self):
+    import io, tilelog, tileitems
+    from tileitems import PolygonTileItem, RegularPolygon
+    tileitems.logger = tilelog.NotLogger()
+    shapes = tilesfile.ShapeTable()
+    tiles = [ PolygonTileItem(polygon=RegularPolygon(n)) for n in (3, 4, 3) ]
+    records = bytearray(tilesfile.TILE.size * len(tiles))
+    for (i, it) in enumerate(tiles):
+      tilesfile.PackTile(records, i * tilesfile.TILE.size, it, shapes)
+    f = io.BytesIO()
+    WriteSnapshot(f, (shapes.data, len(tiles), bytes(records), None))
+    g = io.BytesIO()
+    tilesfile.WriteTiles(g, tiles)
+    self.assertEqual(f.getvalue(), g.getvalue())
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+
+import math
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import QPointF, QLineF, QRectF
+
+class BackgroundGuide(object):
+  '''The polar/cartesian guide lines (and title) drawn behind the tiles.
+     These used to be dozens of QGraphicsItems, which every scene query then
+     had to wade through.  Instead, TileScene.drawBackground() calls paint().
+     Drawing on screen goes through a cache of pixmap tiles rendered at
+     quantized zoom levels, so panning or repainting around dragged tiles
+     just blits pixmaps.
+  '''
+
+  RADIUS = 10          # extent of the guide, in scene units
+  TILE_PIXELS = 256    # width & height of each cached pixmap tile
+  MAX_TILES = 256      # forget all cached tiles rather than cache more than this
+
+  def __init__(self, title=''):
+    self._title = title
+    self._titleFont = QtGui.QFont()
+    self._titleScale = .1
+    fm = QtGui.QFontMetricsF(self._titleFont)
+    self._titleRect = QRectF(0, 0, fm.width(title), fm.height())
+    self._titleRect.moveTopLeft(QPointF(-self._titleRect.width() * self._titleScale / 2, -9))
+    self._linePen = QtGui.QPen(QtGui.QColor.fromHsv(0,0,127,31), 0)
+    self._zeroPen = QtGui.QPen(QtGui.QColor(127,127,127,63), 0)
+    self._titleColor = QtGui.QColor.fromHsv(300,5,127,31)
+    r = self.RADIUS
+    self._boundingRect = QRectF(-r, -r, 2*r, 2*r)
+    self._tileZoom = None  # zoom level of the cached tiles
+    self._tiles = {}       # (tx,ty) -> QPixmap
+
+  def boundingRect(self):
+    return QRectF(self._boundingRect)
+
+  @staticmethod
+  def zoomLevel(lod):
+    'Quantize a level of detail (pixels per scene unit) into half-octave steps.'
+    return round(2 * math.log2(lod))
+
+  def paint(self, painter, rect):
+    'Paint the part of the guide within rect (in scene coordinates).'
+    rect = rect & self._boundingRect
+    if rect.isEmpty(): return
+    lod = QtWidgets.QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+    if lod * self.RADIUS < 4: return  # too small to see
+    if isinstance(painter.device(), QtWidgets.QWidget):
+      self.paintCached(painter, rect, lod)
+    else:
+      # Printing or exporting: keep the output resolution independent.
+      painter.save()
+      painter.setClipRect(rect)
+      self.paintGuide(painter, lod)
+      painter.restore()
+
+  def paintCached(self, painter, rect, lod):
+    z = self.zoomLevel(lod)
+    if z != self._tileZoom or len(self._tiles) > self.MAX_TILES:
+      self._tiles.clear()
+      self._tileZoom = z
+    scale = 2 ** (z / 2)
+    span = self.TILE_PIXELS / scale  # scene width of one tile
+    painter.save()
+    painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+    for ty in range(math.floor(rect.top() / span), math.ceil(rect.bottom() / span)):
+      for tx in range(math.floor(rect.left() / span), math.ceil(rect.right() / span)):
+        pixmap = self._tiles.get((tx,ty))
+        if pixmap is None:
+          pixmap = self._tiles[(tx,ty)] = self.renderTile(tx, ty, scale)
+        painter.drawPixmap(QRectF(tx*span, ty*span, span, span), pixmap, QRectF(pixmap.rect()))
+    painter.restore()
+
+  def renderTile(self, tx, ty, scale):
+    'Return a pixmap of the guide, scaled by scale, tile (tx,ty) of a grid of TILE_PIXELS square tiles.'
+    n = self.TILE_PIXELS
+    pixmap = QtGui.QPixmap(n, n)
+    pixmap.fill(QtCore.Qt.transparent)
+    p = QtGui.QPainter(pixmap)
+    p.setRenderHint(QtGui.QPainter.Antialiasing)
+    p.translate(-tx*n, -ty*n)
+    p.scale(scale, scale)
+    self.paintGuide(p, scale)
+    p.end()
+    return pixmap
+
+  def paintGuide(self, painter, lod):
+    '''Draw the guide directly, omitting detail that would be too crowded
+       at lod pixels per scene unit.'''
+    r = self.RADIUS
+    # Grid lines and circles, every unit if they'd be at least 4 pixels apart.
+    step = 1 if lod >= 4 else 5 if lod >= .8 else r
+    painter.setPen(self._linePen)
+    painter.setBrush(QtCore.Qt.NoBrush)
+    painter.drawLines([QLineF(-r, y, r, y) for y in range(-r, r+1, step)])
+    painter.drawLines([QLineF(x, -r, x, r) for x in range(-r, r+1, step)])
+    for c in range(step, r+1, step):
+      painter.drawEllipse(QPointF(0,0), c, c)
+    # Radii, every 5 degrees, but fewer when they'd crowd together.
+    degrees = 5 if lod >= 24 else 15 if lod >= 8 else 45
+    painter.drawLines([ QLineF(.5*math.cos(a), .5*math.sin(a), r*math.cos(a), r*math.sin(a))
+                        for a in (math.radians(d) for d in range(0, 360, degrees)) ])
+    if lod >= 8:
+      painter.setPen(self._zeroPen)
+      painter.drawLine(QLineF(-.5, 0, .5, 0))
+      painter.drawLine(QLineF(0, -.5, 0, .5))
+    if lod >= 2 and self._title:
+      painter.save()
+      painter.translate(self._titleRect.topLeft())
+      painter.scale(self._titleScale, self._titleScale)
+      painter.setFont(self._titleFont)
+      painter.setPen(self._titleColor)
+      painter.drawText(QRectF(0, 0, self._titleRect.width(), self._titleRect.height())
+                      , QtCore.Qt.AlignLeft | QtCore.Qt.AlignTop, self._title)
+      painter.restore()
@@ -1,15 +1,15 @@
 
-import math, random, re
+import collections, functools, math, random, re, weakref
 from math import pi, degrees, radians, sqrt, sin, cos, tan, atan2, asin, acos
 #from abc import ABCMeta, abstractmethod, abstractclassmethod
 
-import xml.etree.ElementTree as ET
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import QPointF, QLineF
 from PyQt5.QtGui import QPolygonF
 
-import svgparsing
+import svgparsing, tilesnap
+from svgwriting import FormatTransform
 from qmathturtle import RecordingTurtle
 from q2str import *
 
@@ -48,6 +48,36 @@ def IterEdges(p):
   if p.size() > 2 and not p.isClosed():
     yield QLineF(p[p.size()-1], p[0])
 
+def _Hashable(x):
+  'Convert (nested) lists into (nested) tuples, so they can be used as dict keys'
+  if isinstance(x, (list, tuple)):
+    return tuple(_Hashable(y) for y in x)
+  return x
+
+SHARED_POLYGON_CACHE_SIZE = 1024  # most distinct shapes kept per function
+
+def SharedPolygon(func):
+  '''Decorate a QPolygonF creating function to compute each distinct shape only once.
+     Every call returns a new QPolygonF, which is cheap because QPolygonF is
+     implicitly shared (copy-on-write), so callers may still modify the result.
+     Only the most recently used SHARED_POLYGON_CACHE_SIZE shapes are kept.
+  '''
+  cache = collections.OrderedDict()  # least recently used first
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    key = (_Hashable(args), tuple(sorted(kwargs.items())))
+    poly = cache.get(key)
+    if poly is None:
+      poly = cache[key] = func(*args, **kwargs)
+      if len(cache) > SHARED_POLYGON_CACHE_SIZE:
+        cache.popitem(last=False)
+    else:
+      cache.move_to_end(key)
+    return QPolygonF(poly)
+  wrapper.cache = cache
+  return wrapper
+
+@SharedPolygon
 def RegularPolygon(sides=6, size=1, r=None, rotate=0.0):
   # Must provide one of size or r, size overrides r
   theta = 2*pi/sides
@@ -67,6 +97,7 @@ See:
   https://math.stackexchange.com/questions/1439795/relationships-between-schl%C3%A4fli-symbol-and-geometrical-properties-of-regular-conc
 '''
 
+@SharedPolygon
 def RegularPolygram(p,q, size=1):
   'Return a polygram, {p/q}, with p points, visiting every q-th point'
   # q is also the winding or turning number (the number of times around)
@@ -88,6 +119,7 @@ def RegularPolygram(p,q, size=1):
     if i == 0: break
   return QPolygonF(vertices)
 
+@SharedPolygon
 def StarPolygon(n,d, size=1):
   '''
     n = number of points
@@ -118,6 +150,7 @@ def StarPolygon(n,d, size=1):
       t.fd(size).rt(spike_exterior_angle)
   return t.polygon()
 
+@SharedPolygon
 def GoldenRectangle(size=1):
   #return QPolygonF(QtCore.QRectF(-.5,.5,size*PHI,1.0)) # renders strangely
   return QPolygonF(( QPointF(-.5+size*PHI,.5)
@@ -126,16 +159,19 @@ def GoldenRectangle(size=1):
                    , QPointF(-.5+size*PHI,-.5)
                    ))
 
+@SharedPolygon
 def Rhombus(degrees, size=1):
   t = RecordingTurtle().pu().bk(size/2).lt(degrees).bk(size/2).rt(degrees).pd()
   for i in range(2):
     t.fd(size).lt(degrees).fd(size).lt(180-degrees)
   return t.polygon()
 
+@SharedPolygon
 def Triangle306090(size=1):
   t = RecordingTurtle().fd(size).lt(90+30).fd(size).fd(size) #.lt(90+60).fd(sqrt(3)*size)
   return RecenteredPolygonF(t.polygon())
 
+@SharedPolygon
 def Triangle345(size=1):
   t = RecordingTurtle()
   t.pu().goto(QPointF(-2,-1.5)).pd()
@@ -146,25 +182,30 @@ def Triangle345(size=1):
   t.fd(size).fd(size).fd(size).fd(size)#.fd(size)
   return t.polygon()
 
+@SharedPolygon
 def RightIsoscelesByLegs(size=1):
   'Return a right isosceles triangle whose legs are (size)'
   return RecenteredPolygonF(QPolygonF(( QPointF(0,size), QPointF(0,0), QPointF(size,0) )))
 
+@SharedPolygon
 def RightIsoscelesByBase(size=1):
   'Return a right isosceles triangle whose base is (size)'
   size2 = size/2
   return RecenteredPolygonF(QPolygonF(( QPointF(0,0), QPointF(size2,size2), QPointF(size,0) )))
 
+@SharedPolygon
 def TangramLargeTriangle(size=1):
   '2-unit-area 45-45-90 triangle including extra vertices bisecting each side'
   t = RecordingTurtle().fd(size).fd(size).lt(90).fd(size).fd(size).lt(90+45).fd(size*sqrt(2)) #.fd(size*sqrt(2))
   return RecenteredPolygonF(t.polygon())
 
+@SharedPolygon
 def TangramMediumTriangle(size=1):
   'unit-area 45-45-90 triangle including an extra vertex bisecting the hypotenuse'
   t = RecordingTurtle().fd(size).fd(size).lt(90+45).fd(size*sqrt(2)).lt(90) #.fd(size*sqrt(2))
   return RecenteredPolygonF(t.polygon())
 
+@SharedPolygon
 def TangramParallelogram(size=1):
   'unit-area 45-135 parallelogram'
   return RecenteredPolygonF(QPolygonF(( QPointF(0,0), QPointF(size,size), QPointF(size,0), QPointF(0,-size) )))
@@ -396,9 +437,11 @@ def SquareCellScan(squaremap):
           segs.append( ((x,y+1),(x+1,y+1)) )      # bottom
   return segs
 
+@SharedPolygon
 def Polyiamond(trianglemap):
   return RecenteredPolygonF(Segments2QPolygonF(TriangleCellScan(trianglemap)))
 
+@SharedPolygon
 def Polyomino(squaremap):
   return RecenteredPolygonF(Segments2QPolygonF(SquareCellScan(squaremap)))
 
@@ -421,16 +464,92 @@ def TetrominoPolySet():
 def PentominoPolySet():
   return (Polyomino(pp) for pp in pentomino_patterns)
 
+@SharedPolygon
 def HalfDiamond():
   h = sqrt(3)/2.0
   return QPolygonF([QPointF(h,0), QPointF(0,-.5), QPointF(-h,0)])
 
+@SharedPolygon
 def Arrowhead(size=1):
   "Return a particular concave asymmetrical quadrilateral"
   # note that turtle +y = up while qt +y = down
   t = RecordingTurtle().lt(108).fd(1).lt(144).fd(1).lt(144).fd(.5) #.rt(90).fd(*) implied
   return RecenteredPolygonF(YFlippedPolygonF(t.polygon()))
 
+#==== Shared shape prototypes
+
+def PolygonKey(p):
+  'Return a hashable value identifying the exact vertices of QPolygonF p'
+  n = p.size()
+  if not n: return b''
+  return QPolygonF(p).data().asstring(n * 16)  # 2 doubles per vertex
+
+class ShapePrototype(object):
+  '''The immutable geometry shared by all tiles of one shape (a flyweight).
+     Use ShapePrototype.get(polygon) rather than constructing instances,
+     so that identical polygons share one prototype.
+     Nothing here may be modified once created.
+  '''
+
+  _registry = weakref.WeakValueDictionary()  # PolygonKey -> ShapePrototype
+
+  @classmethod
+  def get(cls, polygon):
+    'Return the prototype for polygon, creating it if needed.'
+    key = PolygonKey(polygon)
+    proto = cls._registry.get(key)
+    if proto is None:
+      proto = cls(polygon, key)
+      cls._registry[key] = proto
+    return proto
+
+  @classmethod
+  def count(cls):
+    return len(cls._registry)
+
+  def __init__(self, polygon, key):
+    self.key = key
+    self.polygon = QPolygonF(polygon)
+    self.area = QPolygonFArea(polygon)
+    self.boundingRect = polygon.boundingRect()
+    self._clipPath = None
+    self._selectionStrokes = {}  # pen width -> QPainterPath
+    self._svgPoints = None
+    self._corners = None
+
+  def __len__(self):
+    return self.polygon.size()
+
+  def clipPath(self):
+    'Return a closed QPainterPath of the polygon, for clipping.'
+    if self._clipPath is None:
+      path = QtGui.QPainterPath()
+      path.addPolygon(self.polygon)
+      path.closeSubpath()
+      self._clipPath = path
+    return self._clipPath
+
+  def selectionStroke(self, width):
+    'Return the outline of the polygon stroked with a pen of the given width.'
+    stroke = self._selectionStrokes.get(width)
+    if stroke is None:
+      stroker = QtGui.QPainterPathStroker()
+      stroker.setWidth(width)
+      stroke = self._selectionStrokes[width] = stroker.createStroke(self.clipPath()).simplified()
+    return stroke
+
+  def corners(self):
+    'Return (interior angle, length of edge before, length of edge after) for each vertex.'
+    if self._corners is None:
+      self._corners = tuple(tilesnap.PolygonCorners(self.polygon))
+    return self._corners
+
+  def svgPoints(self):
+    'Return the vertices formatted for an SVG points attribute.'
+    if self._svgPoints is None:
+      self._svgPoints = ' '.join('%r,%r' % (p.x(), p.y()) for p in self.polygon)
+    return self._svgPoints
+
 def HighlightCompliment(c):
   'Calculate a color for drawing a selection highlight to cotrast with c'
   (h,s,v,a) = c.getHsvF()
@@ -492,14 +611,16 @@ EllipseTileItem() : Tile, QGraphicsEllipseItem
 
 '''
 
-#SCENE_MAPPING_CHANGES = frozenset(
-#  (QtWidgets.QGraphicsItem.ItemTransformChange
-#  ,QtWidgets.QGraphicsItem.ItemPositionChange
-#  ,QtWidgets.QGraphicsItem.ItemParentChange
-#  ,QtWidgets.QGraphicsItem.ItemRotationChange
-#  ,QtWidgets.QGraphicsItem.ItemScaleChange
-#  ,QtWidgets.QGraphicsItem.ItemSceneChange
-#  ))
+# Changes that alter how an item maps to scene coordinates.
+SCENE_MAPPING_CHANGES = frozenset(
+  (QtWidgets.QGraphicsItem.ItemTransformHasChanged
+  ,QtWidgets.QGraphicsItem.ItemPositionHasChanged
+  ,QtWidgets.QGraphicsItem.ItemParentHasChanged
+  ,QtWidgets.QGraphicsItem.ItemRotationHasChanged
+  ,QtWidgets.QGraphicsItem.ItemScaleHasChanged
+  ,QtWidgets.QGraphicsItem.ItemTransformOriginPointHasChanged
+  ,QtWidgets.QGraphicsItem.ItemSceneHasChanged
+  ))
 
 
 '''
@@ -512,17 +633,23 @@ class Tile(object):
   '''A mixin for QGraphicsItems that can be moved/rotated/scaled by the user
      and can snap to other Tiles'''
 
+  # Scene-coordinate geometry cache statistics, for all Tiles.
+  sceneCacheHits = 0
+  sceneCacheMisses = 0
+
   # It's important that this mixin ctor pass posargs up to Qt
   # Extra args should be keywords between posargs and kwargs
   def __init__(self, *posargs, color=None, **kwargs):
     logger.trace('entering')
+    self._const_sceneSnapPoints = None  # cached sceneSnapPoints()
+    self._const_sceneEdges = None       # cached sceneEdges()
     super().__init__(*posargs, **kwargs)
     self.setFlags( self.flags()
                  | QtWidgets.QGraphicsItem.ItemIsFocusable
                  | QtWidgets.QGraphicsItem.ItemIsSelectable
                  | QtWidgets.QGraphicsItem.ItemIsMovable
                  | QtWidgets.QGraphicsItem.ItemClipsToShape
-               # | QtWidgets.QGraphicsItem.ItemSendsGeometryChanges
+                 | QtWidgets.QGraphicsItem.ItemSendsGeometryChanges  # for itemChange()
                  )
     self._selectionPenWidth = .1
     if color is None: color = QtCore.Qt.yellow
@@ -534,7 +661,7 @@ class Tile(object):
   # Defined in derived concrete classes, but not here:
   # @classmethod
   # @abstractmethod ?
-  # def newFromSvg(cls, e): pass
+  # def newFromSvg(cls, e, polygon=None): pass
 
   def color(self):
     logger.trace('{}', self._color.getRgb())
@@ -548,11 +675,7 @@ class Tile(object):
     self.updateSelectionPen()
 
   def pen(self):
-    if self.scene().renderMode == self.scene().RENDER_OUTLINE:
-      return QtGui.QPen(BlackOrWhiteCompliment(self.scene().backgroundBrush().color()), 0)
-    else:
-      return QtGui.QPen(self.scene().borderColor, 0)
-      return super().pen()
+    return self.scene().tilePen()
 
   def updateSelectionPen(self):
     #self.selectionPen = QtGui.QPen(QtCore.Qt.red, .2)
@@ -561,25 +684,83 @@ class Tile(object):
     self.selectionPen = QtGui.QPen(HighlightCompliment(c), self._selectionPenWidth)
     self.update()
 
+  # Defined in derived concrete classes:
+  # svgTag = 'polygon'
+  # def svgGeometry(self): return [(name, value), ...]  # the shape, in item coordinates
+
+  def svgAttribs(self):
+    'Return the SVG attributes other than geometry and presentation, as (name, value) pairs.'
+    return [('transform', self.svgTransform())]
+
+  def svgTransform(self):
+    'Return the position and transform of this Tile as an SVG transform attribute.'
+    return FormatTransform(self.pos(), self.transform())
+
+  def writeSvgDefs(self, writer):
+    'Write any geometry this Tile can share with others into <defs>, for writeSvg() to refer to.'
+    pass
+
+  def writeSvg(self, writer):
+    'Write this Tile as an SVG element, using an svgwriting.SVGWriter.'
+    writer.element(self.svgTag, self.svgGeometry() + self.svgAttribs(), writer.fillStyle(self._color))
+
   #@abstractmethod
   #def snapPoints(self):
   #  logger.warning('abstract method called')
   #  return ()
 
-  def sceneSnapPoints(self):
+  def mapSnapPointsToScene(self):
     # A slower fallback method.
-    return (self.mapToScene(p) for p in self.snapPoints())
+    return tuple(self.mapToScene(p) for p in self.snapPoints())
+
+  def mapEdgesToScene(self):
+    return ()
+
+  def sceneSnapPoints(self):
+    '''Return snap points in scene coordinates.
+       Cached while this Tile has no parent: the SelectionGroup's transforms
+       are not notified to its children, so selected Tiles are always mapped.
+    '''
+    if not self.parentItem() is None:
+      return self.mapSnapPointsToScene()
+    if self._const_sceneSnapPoints is None:
+      Tile.sceneCacheMisses += 1
+      self._const_sceneSnapPoints = self.mapSnapPointsToScene()
+    else:
+      Tile.sceneCacheHits += 1
+    return self._const_sceneSnapPoints
+
+  def sceneCorners(self):
+    '''Return (x, y, interior angle, lengths of the edges meeting there)
+       for each snap point, in scene coordinates.  Points that are not
+       corners of a polygon take up no angle and have no edges.'''
+    return [ (p.x(), p.y(), 0.0, ()) for p in self.sceneSnapPoints() ]
+
+  def sceneEdges(self):
+    'Return a sequence of QLineF edges in scene coordinates, cached like sceneSnapPoints().'
+    if not self.parentItem() is None:
+      return self.mapEdgesToScene()
+    if self._const_sceneEdges is None:
+      Tile.sceneCacheMisses += 1
+      self._const_sceneEdges = self.mapEdgesToScene()
+    else:
+      Tile.sceneCacheHits += 1
+    return self._const_sceneEdges
 
   def iterLineSegments(self):
-    if False:
-      yield None
+    return iter(self.sceneEdges())
 
-  #def itemChange(self, change, value):
-  #  # Note that changes in apparent selection state due to group membership
-  #  # do not trigger item selection change notifications!
-  #  if change in SCENE_MAPPING_CHANGES:
-  #    self._const_sceneSnapPoints = None
-  #  return super().itemChange(change, value)
+  def itemChange(self, change, value):
+    # Note that changes in apparent selection state due to group membership
+    # do not trigger item selection change notifications!
+    if change in SCENE_MAPPING_CHANGES:
+      self._const_sceneSnapPoints = None
+      self._const_sceneEdges = None
+      scene = self.scene()
+      if not scene is None:
+        scene.markSnapDirty(self)
+        scene.markExtentDirty(self)
+    return super().itemChange(change, value)
 
   def setSelected(self, selection):
     g = self.group()
@@ -627,22 +808,30 @@ class PolygonTileItem(Tile, QtWidgets.QGraphicsPolygonItem):
     '''
     # PyQt doesn't support keywords for non-option arguments,
     # so this ctor exists to accept (some of?) them.
-    super().__init__(polygon, *posargs, **kwargs)
+    # Tiles of the same shape share one prototype (and one copy of the vertices).
+    prototype = ShapePrototype.get(polygon)
+    super().__init__(prototype.polygon, *posargs, **kwargs)
+    self._prototype = prototype
     # Many Qt functions take const arguments; do likewise here.
-    self._const_polygon = polygon
-    if QPolygonFArea(polygon) < 1:
+    self._const_polygon = prototype.polygon
+    if prototype.area < 1:
       self._selectionPenWidth /= 2
       self.updateSelectionPen()
 
+  def prototype(self):
+    return self._prototype
+
   @classmethod
-  def newFromSvg(cls, e):
+  def newFromSvg(cls, e, polygon=None):
+    '''Construct a tile from (localized) SVG element e.
+       polygon is the shape a <use> element refers to, if e is one.'''
     d = svgparsing.ParseSvgAttribs(e)
     if 'points' in d:
-      poly = QtGui.QPolygonF(d['points'])
+      poly = d['points']
     elif 'd' in d:
       poly = svgparsing.SvgPathCmdsToPolygons(d['d'])[0]
     else:
-      poly = None
+      poly = polygon
     pti = cls(polygon = poly)
     if 'fill' in d:
       pti.setColor(QtGui.QColor(*d['fill']))
@@ -654,59 +843,53 @@ class PolygonTileItem(Tile, QtWidgets.QGraphicsPolygonItem):
       pti.setTransform(d['transform'])
     return pti
 
-  def toSvg(self, parent):
-    # Note that SVG and QTransform matrices are relatively transposed.
-    # If no skewing or projection is present, the third vector should be (0,0,1).
-    pos = self.pos()
-    t = self.transform()
-    t3 = (t.m13(), t.m23(), t.m33())
-    if t3 != (0,0,1):
-      logger.warning('Loss of transformation: {}', FormatQTransform(t))
-    coords = [ '{},{}'.format(p.x(),p.y()) for p in self._const_polygon ]
+  svgTag = 'polygon'
+
+  def svgGeometry(self):
     #pycode = 'PolygonTileItem(polygon=QPolygonF([{}]))'.format(','.join('QPointF({})'.format(c) for c in coords))
-    attrs = \
-      { 'points' : ' '.join(coords)
-      , 'stroke' : self.pen().color().name()
-      , 'stroke-width': '.03px'
-      , 'fill' : self.brush().color().name() # QtGui.QColor.HexArgb)
-      , 'fill-opacity' : str(self.brush().color().alphaF())
-      , 'transform' : 'translate({x} {y}) matrix({a} {b} {c} {d} {e} {f})'
-     #, 'transform' : 'matrix({a} {b} {c} {d} {e} {f}) translate({x} {y})'
-                      .format(a=t.m11(),b=t.m12(),c=t.m21(),d=t.m22(),e=t.m31(),f=t.m32() ,x=pos.x(), y=pos.y())
-                     #.format(a=t.m11(),b=t.m21(),c=t.m12(),d=t.m22(),e=t.m13(),f=t.m23() ,x=pos.x(), y=pos.y())
-     #, 'tiles:pycode': pycode
-      }
-    return ET.Element('polygon', attrib=attrs)
-    #ET.SubElement(parent, 'polygon', attrib=attrs)
+    return [('points', self._prototype.svgPoints())]  # formatted once per shape
+
+  def writeSvgDefs(self, writer):
+    writer.define(self._prototype, self.svgTag, self.svgGeometry())
+
+  def writeSvg(self, writer):
+    # Tiles of the same shape all <use> the one polygon defined for their prototype.
+    ref = writer.reference(self._prototype)
+    if ref is None:
+      super().writeSvg(writer)
+    else:
+      writer.element('use', [('xlink:href', ref)] + self.svgAttribs(), writer.fillStyle(self._color))
 
   def snapPoints(self):
-    assert len(self._const_polygon) > 2
+    assert len(self._prototype) > 2
     return self._const_polygon
 
-  def sceneSnapPoints(self):
+  def mapSnapPointsToScene(self):
     return self.mapToScene(self._const_polygon)
 
-  def iterLineSegments(self):
-    poly = self.mapToScene(self._const_polygon)
-    z = poly.size()
-    for i in range(1, z):
-      yield QLineF(poly[i-1], poly[i])
-    if z > 2 and not poly.isClosed():
-      yield QLineF(poly[z-1], poly[0])
+  def mapEdgesToScene(self):
+    return tuple(IterEdges(self.sceneSnapPoints()))
+
+  def sceneCorners(self):
+    pts = self.sceneSnapPoints()
+    s = tilesnap.SimilarityScale(self.sceneTransform())
+    if s is None:
+      # Stretched or sheared, so the shape's angles don't apply.
+      (s, corners) = (1, tilesnap.PolygonCorners(pts))
+    else:
+      corners = self._prototype.corners()
+    return [ (p.x(), p.y(), a, (la*s, lb*s)) for (p, (a, la, lb)) in zip(pts, corners) ]
 
   halfDashedLine = (1,1,1,1)
 
   def paint(self, painter, option, widget=0):
     #painter.setClipRect(option.exposedRect)
     painter.setPen(self.pen())
-    path = QtGui.QPainterPath()
     if logger.isEnabledFor('debug'):
       painter.drawRect(self.boundingRect())  # debug bounding rect
     else:
       # Prevent paint from falling outside the lines
-      path.addPolygon(self._const_polygon)
-      path.closeSubpath()
-      painter.setClipPath(path)
+      painter.setClipPath(self._prototype.clipPath())
     if self.scene().renderMode != self.scene().RENDER_OUTLINE:
       painter.setBrush(self.brush())
     painter.drawPolygon(self._const_polygon)
@@ -729,12 +912,8 @@ class PolygonTileItem(Tile, QtWidgets.QGraphicsPolygonItem):
     painter.drawPolygon(self._const_polygon)                  # draw dashed black border
 
   def paintInsetHighlight(self, painter):
-    path = QtGui.QPainterPath()
-    path.addPolygon(self._const_polygon)
-    path.closeSubpath()
-    stroker = QtGui.QPainterPathStroker()
-    stroker.setWidth(2.5 * self._selectionPenWidth)
-    strokedPath = stroker.createStroke(path).simplified()
+    # The stroke is the same for every tile of this shape, so it's cached.
+    strokedPath = self._prototype.selectionStroke(2.5 * self._selectionPenWidth)
     #painter.setPen(QtGui.QPen(HighlightCompliment(self.color()), .1))
     painter.setPen(self.selectionPen)
     painter.setBrush(QtCore.Qt.NoBrush)
@@ -766,32 +945,12 @@ class PenroseTileItem(PolygonTileItem):
     self._shape = shape
     self._size = size
     if color is None: color = QtGui.QColor.fromHsv(shape*30, 31, 239)
-    poly = None
-    if not polygon is None:
-      poly = polygon
-    elif shape == PenroseTileItem.THIN_RHOMB:
-      poly = Rhombus(144, size)
-    elif shape == PenroseTileItem.THICK_RHOMB:
-      poly = Rhombus(72, size)
-    elif shape == PenroseTileItem.DART:
-      # Draw the kite & dart with outside/longer edges of unit length.
-      t = RecordingTurtle().pu().fd(.5*size).pd()
-      # Dart: start at arrow-tip and go CCW:
-      t.lt(180-36).fd(size).lt(180-36).fd(size/PHI).rt(36).fd(size/PHI) #.lt(180-36).fd(size)
-      poly = t.polygon()
-    elif shape == PenroseTileItem.KITE:
-      t = RecordingTurtle().pu().fd(.5*size).pd()
-      t.lt(108).fd(size/PHI).lt(108).fd(size).lt(108).fd(size) #.lt(108).fd(size/PHI)
-      logger.trace('RecordingTurtle.vertices() == {}', t.vertices())
-      poly = t.polygon()
-      logger.trace('poly.isClosed() == {}', poly.isClosed())
-      assert len(list(p for p in poly)) == 4
-    else:
-      raise TypeError("unsupported shape")
-    super().__init__(*posargs, polygon=poly, color=color, **kwargs)
+    if polygon is None:
+      polygon = PenrosePolygon(shape, size)
+    super().__init__(*posargs, polygon=polygon, color=color, **kwargs)
 
   @classmethod
-  def newFromSvg(cls, e):
+  def newFromSvg(cls, e, polygon=None):
     parsedAttribs = svgparsing.ParseSvgAttribs(e)
     kwargs = { }
     for k in 'tiles:size'.split():
@@ -799,8 +958,10 @@ class PenroseTileItem(PolygonTileItem):
     if 'tiles:shapeno' in parsedAttribs:
       kwargs['shape'] = parsedAttribs['tiles:shapeno']
     if 'points' in parsedAttribs:
-      kwargs['polygon'] = QtGui.QPolygonF(parsedAttribs['points'])
+      kwargs['polygon'] = parsedAttribs['points']
       logger.trace('PenroseTileItem.newFromSvg() points = {}', FormatQPointFs(kwargs['polygon']))
+    elif not polygon is None:
+      kwargs['polygon'] = polygon
     pti = cls(**kwargs)
     if 'fill' in parsedAttribs:
       pti.setColor(QtGui.QColor(*parsedAttribs['fill']))
@@ -812,13 +973,12 @@ class PenroseTileItem(PolygonTileItem):
       pti.setTransform(parsedAttribs['transform'])
     return pti
 
-  def toSvg(self, parent):
-    e = super().toSvg(parent)
-    e.attrib['tiles:type'] = 'PenroseTileItem'
-    e.attrib['tiles:shapeno'] = str(self._shape)
-    e.attrib['tiles:size'] = str(self._size)
-    logger.trace('PenroseTileItem.toSvg() points = {}', e.attrib['points'])
-    return e
+  def svgAttribs(self):
+    return super().svgAttribs() + \
+      [ ('tiles:type', 'PenroseTileItem')
+      , ('tiles:shapeno', str(self._shape))
+      , ('tiles:size', str(self._size))
+      ]
 
   def paint(self, painter, option, widget=0):
     super().paint(painter, option, widget)
@@ -840,9 +1000,33 @@ class PenroseTileItem(PolygonTileItem):
       if self._shape == PenroseTileItem.THICK_RHOMB:
         r2 = 1 - r0
     painter.setPen(QtGui.QPen(c0, w))
-    painter.drawEllipse(self.polygon()[0], r0,r0)
+    painter.drawEllipse(self._const_polygon[0], r0,r0)
     painter.setPen(QtGui.QPen(c2, w))
-    painter.drawEllipse(self.polygon()[2], r2,r2)
+    painter.drawEllipse(self._const_polygon[2], r2,r2)
+
+@SharedPolygon
+def PenrosePolygon(shape, size=1):
+  'Return the polygon for one of the PenroseTileItem shapes'
+  if shape == PenroseTileItem.THIN_RHOMB:
+    return Rhombus(144, size)
+  elif shape == PenroseTileItem.THICK_RHOMB:
+    return Rhombus(72, size)
+  elif shape == PenroseTileItem.DART:
+    # Draw the kite & dart with outside/longer edges of unit length.
+    t = RecordingTurtle().pu().fd(.5*size).pd()
+    # Dart: start at arrow-tip and go CCW:
+    t.lt(180-36).fd(size).lt(180-36).fd(size/PHI).rt(36).fd(size/PHI) #.lt(180-36).fd(size)
+    return t.polygon()
+  elif shape == PenroseTileItem.KITE:
+    t = RecordingTurtle().pu().fd(.5*size).pd()
+    t.lt(108).fd(size/PHI).lt(108).fd(size).lt(108).fd(size) #.lt(108).fd(size/PHI)
+    logger.trace('RecordingTurtle.vertices() == {}', t.vertices())
+    poly = t.polygon()
+    logger.trace('poly.isClosed() == {}', poly.isClosed())
+    assert len(list(p for p in poly)) == 4
+    return poly
+  else:
+    raise TypeError("unsupported shape")
 
 def UnitFd(t, d):
   'Move turtle t fd in increments of 1 until reaching d'
@@ -853,19 +1037,24 @@ def UnitFd(t, d):
     t.fd(d)
   return t
 
+@SharedPolygon
+def RulerPolygon(length=10, width=1):
+  'Return the outline of a ruler, with a vertex at every unit of length'
+  t = RecordingTurtle()
+  for half in range(2):
+    UnitFd(t, length)
+    t.lt(90)
+    UnitFd(t, width)
+    t.lt(90)
+  return UnclosePolygonF(t.polygon())
+
 class RulerTileItem(PolygonTileItem):
   'A RulerTileItem has markings for measuring lengths'
 
   def __init__(self, *posargs, length=10, width=1, color=None, **kwargs):
     if color is None:
       color = QtGui.QColor.fromHsv(50,127,255)
-    t = RecordingTurtle()
-    for half in range(2):
-      UnitFd(t, length)
-      t.lt(90)
-      UnitFd(t, width)
-      t.lt(90)
-    super().__init__(*posargs, polygon=UnclosePolygonF(t.polygon()), color=color, **kwargs)
+    super().__init__(*posargs, polygon=RulerPolygon(length, width), color=color, **kwargs)
     self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption, True) # for exposedRect
     # ItemCoordinateCache reduces repainting, but turns the lines into
     #   indistinct gray blocks unless logicalCacheSize is big enough,
@@ -877,7 +1066,8 @@ class RulerTileItem(PolygonTileItem):
     #self.setFlag(QtWidgets.QGraphicsItem.ItemSendsGeometryChanges, True)
 
   @classmethod
-  def newFromSvg(cls, e):
+  def newFromSvg(cls, e, polygon=None):
+    # A ruler's polygon is always generated, never read.
     parsedAttribs = svgparsing.ParseSvgAttribs(e)
     kwargs = { }
     pti = cls(**kwargs)
@@ -891,10 +1081,8 @@ class RulerTileItem(PolygonTileItem):
       pti.setTransform(parsedAttribs['transform'])
     return pti
 
-  def toSvg(self, parent):
-    e = super().toSvg(parent)
-    e.attrib['tiles:type'] = 'RulerTileItem'
-    return e
+  def svgAttribs(self):
+    return super().svgAttribs() + [('tiles:type', 'RulerTileItem')]
 
   def setColor(self, color):
     super().setColor(color)
@@ -938,8 +1126,8 @@ class RulerTileItem(PolygonTileItem):
     textScale = .02
     magnitude = 0  # 10**0 = units, and go down from there
     maxMagnitude = math.log10(lod/2)
-    h = self._const_polygon.boundingRect().height()
-    w = self._const_polygon.boundingRect().width()
+    h = self._prototype.boundingRect.height()
+    w = self._prototype.boundingRect.width()
     n = 0
     #while 10**magnitude * 2 < lod: # draw markings until they're too small
     while magnitude < maxMagnitude:
@@ -988,7 +1176,7 @@ class RulerTileItem(PolygonTileItem):
     painter.scale(z,z)      # initial zoom in
     zmax = zadj/lod
     magnitude = 0           # track exponent for markings scale
-    top = h = self._const_polygon.boundingRect().height() * z
+    top = h = self._prototype.boundingRect.height() * z
     lt = option.exposedRect.left() * z
     rt = option.exposedRect.right() * z
     n = 0
@@ -1051,27 +1239,15 @@ class EllipseTileItem(Tile, QtWidgets.QGraphicsEllipseItem):
       eti.setTransform(d['transform'])
     return eti
 
-  def toSvg(self, parent):
-    pos = self.pos()
-    t = self.transform()
-    t3 = (t.m13(), t.m23(), t.m33())
-    if t3 != (0,0,1):
-      logger.warning('Loss of transformation: {}', FormatQTransform(t))
-    attrs = \
-      { 'cx' : str(self._const_rect.center().x())
-      , 'cy' : str(self._const_rect.center().y())
-      , 'rx' : str(self._const_rect.width() / 2)
-      , 'ry' : str(self._const_rect.height() / 2)
-      , 'stroke' : self.pen().color().name()
-      , 'stroke-width': '.03px'
-      , 'fill' : self.brush().color().name()
-      , 'fill-opacity' : str(self.brush().color().alphaF())
-      , 'transform' : 'translate({x} {y}) matrix({a} {b} {c} {d} {e} {f})'
-     #, 'transform' : 'matrix({a} {b} {c} {d} {e} {f}) translate({x} {y})'
-                      .format(a=t.m11(),b=t.m12(),c=t.m21(),d=t.m22(),e=t.m31(),f=t.m32() ,x=pos.x(), y=pos.y())
-                     #.format(a=t.m11(),b=t.m21(),c=t.m12(),d=t.m22(),e=t.m13(),f=t.m23() ,x=pos.x(), y=pos.y())
-      }
-    return ET.Element('ellipse', attrib=attrs)
+  svgTag = 'ellipse'
+
+  def svgGeometry(self):
+    center = self._const_rect.center()
+    return [ ('cx', repr(center.x()))
+           , ('cy', repr(center.y()))
+           , ('rx', repr(self._const_rect.width() / 2))
+           , ('ry', repr(self._const_rect.height() / 2))
+           ]
 
   def snapPoints(self):
     logger.trace('{}', self._const_snapPoints)
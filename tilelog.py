@@ -29,52 +29,78 @@ And none of the above deals with what in my view should have been an obviously d
 So I'm not willing to fix all that for such a modest project.
 '''
 
-import inspect as _inspect
+import functools as _functools
 import os as _os
+import sys as _sys
+
+def _StackDepth(frame):
+  'Count the frames on the stack from frame down (much cheaper than len(inspect.stack())).'
+  n = 0
+  while frame:
+    n += 1
+    frame = frame.f_back
+  return n
+
+def _DontLog(msg='', *posargs, **kwargs):
+  'Stands in for the methods of filtered-out levels, so they cost only a call.'
+  pass
 
 class NotLogger(object):
 
+  # A fixed set of logging levels doesn't permit inserting new levels easily.
+  # Just use names (mapped once to numbers here).
+  LEVEL_NAMES = 'all trace debug info warning error critical'.split()
+  LEVELS = { name: i for (i, name) in enumerate(LEVEL_NAMES) }
+  ALL, TRACE, DEBUG, INFO, WARNING, ERROR, CRITICAL = range(len(LEVEL_NAMES))
+
   def __init__(self, **kwargs):
     super().__init__(**kwargs)
-    self._baseline = len(_inspect.stack())
-    # A fixed set of logging levels doesn't permit inserting new levels easily.
-    # Just use names.
-    # Not currently efficient at all.
-    self._levels = 'all trace debug info warning error critical'.split()
+    self._baseline = _StackDepth(_sys._getframe())
+    self._levels = self.LEVEL_NAMES
     self.setFilterLevel('warning')
 
   def getLevel(self, levelName):
-    for i in range(len(self._levels)):
-      if self._levels[i] == levelName:
-        return i
-    raise TypeError("unregistered logging level")
+    try:
+      return self.LEVELS[levelName]
+    except KeyError:
+      raise TypeError("unregistered logging level")
 
   def setFilterLevel(self, levelName):
     self._lvl = self.getLevel(levelName)
+    # Shadow the per-level methods with either a no-op or a direct call to
+    # _emit(), so a filtered call never even compares levels.
+    for name in ('trace', 'debug', 'info', 'warning', 'error'):
+      lvl = self.LEVELS[name]
+      if lvl >= self._lvl:
+        setattr(self, name, _functools.partial(self._emit, lvl, 1))
+      else:
+        setattr(self, name, _DontLog)
 
   def isEnabledFor(self, levelName):
-    return self.getLevel(levelName) >= self._lvl
+    return self.LEVELS[levelName] >= self._lvl
 
   def log(self, lvl, msg='', *posargs, **kwargs):
     if lvl >= self._lvl:
-      message = msg.format(*posargs, **kwargs)
-      levelName = self._levels[lvl].upper()
-      stack = _inspect.stack()
-      indent = '. ' * (len(stack) - self._baseline - 1)
-      frec = stack[2]
-      filename = _os.path.basename(frec[1])
-      if filename.endswith('.py'): filename = filename[:-3]
-      funcname = frec[3]
-      #frame = frec[0]
-      #funcname = _inspect.getframeinfo(frame).function
-      print('{}{}:{}:{}:{}'.format(indent, levelName, filename, funcname, message), flush=True)
-      del frec, stack
-
-  def trace     (self, *posargs, **kwargs): return self.log(self.getLevel('trace'   ), *posargs, **kwargs)
-  def debug     (self, *posargs, **kwargs): return self.log(self.getLevel('debug'   ), *posargs, **kwargs)
-  def info      (self, *posargs, **kwargs): return self.log(self.getLevel('info'    ), *posargs, **kwargs)
-  def warning   (self, *posargs, **kwargs): return self.log(self.getLevel('warning' ), *posargs, **kwargs)
-  def error     (self, *posargs, **kwargs): return self.log(self.getLevel('error'   ), *posargs, **kwargs)
+      self._emit(lvl, 2, msg, *posargs, **kwargs)
+
+  def _emit(self, lvl, depth, msg='', *posargs, **kwargs):
+    'Format and print a message from the caller depth frames up.'
+    frame = _sys._getframe(depth)
+    message = msg.format(*posargs, **kwargs)  # only formatted if not filtered out
+    levelName = self._levels[lvl].upper()
+    indent = '. ' * max(0, _StackDepth(frame) - self._baseline + 1)
+    filename = _os.path.basename(frame.f_code.co_filename)
+    if filename.endswith('.py'): filename = filename[:-3]
+    funcname = frame.f_code.co_name
+    print('{}{}:{}:{}:{}'.format(indent, levelName, filename, funcname, message), flush=True)
+    del frame
+
+  # Used only until setFilterLevel() replaces them on the instance.
+  def trace     (self, *posargs, **kwargs): return self.log(self.TRACE  , *posargs, **kwargs)
+  def debug     (self, *posargs, **kwargs): return self.log(self.DEBUG  , *posargs, **kwargs)
+  def info      (self, *posargs, **kwargs): return self.log(self.INFO   , *posargs, **kwargs)
+  def warning   (self, *posargs, **kwargs): return self.log(self.WARNING, *posargs, **kwargs)
+  def error     (self, *posargs, **kwargs): return self.log(self.ERROR  , *posargs, **kwargs)
 
 def _selftest():
   logger = NotLogger()
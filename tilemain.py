@@ -6,7 +6,7 @@ if sys.hexversion < 0x03040000:
   print("Python 3.4 minimum required.")
   sys.exit(2)
 
-import os, math, random, argparse, platform
+import io, os, math, random, argparse, platform
 #from abc import ABCMeta, abstractmethod, abstractclassmethod
 import xml.etree.ElementTree as ET
 
@@ -21,9 +21,12 @@ SOUND = False
 if SOUND:
   from PyQt5 import QtMultimedia
 
-import tilelog, tileitems, svgparsing, q2str
+import tilelog, tileitems, svgparsing, svgwriting, q2str
 from tileitems import PolygonTileItem, PenroseTileItem, RulerTileItem
 from tilescene import TileScene
+from tilebackground import BackgroundGuide
+from svgwriting import SVGWriter
+import tilesfile, tilestore, tileautosave
 from tileview import TileView
 from tilerandomizerdialog import TileRandomizerDialog
 
@@ -34,10 +37,13 @@ u'''<p>Magnetic Tiles version {}.{}
 <p>Copyright &copy; 2015&ndash;2016,2021 by Marty White under the GNU GPL V3<p>Python {}'''.format(app_version[0],app_version[1],sys.version.replace('\n','<p>'))
 
 MIME_TYPE_SVG = "image/svg+xml"
+SAVE_FILTERS = "SVG files (*.svg);;Tiles files, for large documents (*.tiles)"
+OPEN_FILTERS = "Tile documents (*.svg *.tiles);;SVG files (*.svg);;Tiles files (*.tiles)"
 XML_decl = '<?xml version="1.0" encoding="utf-8" standalone="no"?>'
 DOCTYPE_decl = '<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">'
 SVG_ns = 'http://www.w3.org/2000/svg'
 TILES_ns = 'http://tiles/tiles'
+XLINK_ns = 'http://www.w3.org/1999/xlink'
 ET_nss = { 'svg' : SVG_ns, 'tiles' : TILES_ns }
 SVG_sample = \
 '''<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="100" height="100">
@@ -48,27 +54,17 @@ SVG_sample = \
 '''
 dummySVG = XML_decl + DOCTYPE_decl + SVG_sample
 
-def rename_namespace(doc, from_namespace, to_namespace):
-  fnsl = len(from_namespace)
-  for elem in doc.getiterator(): # DeprecationWarning: use 'tree.iter()' or 'list(tree.iter()) instead'
-      if elem.tag.startswith(from_namespace):
-          elem.tag = to_namespace + elem.tag[fnsl:]
-      for k in elem.keys():
-        if k.startswith(from_namespace):
-          v = elem.attrib[k]
-          del elem.attrib[k]
-          elem.attrib[to_namespace + k[fnsl:]] = v
-
 class SVGReader(object):
+  '''Constructs TileItems from SVG elements as they are parsed,
+     so the whole document never needs to be in memory at once.'''
 
-  def __init__(self, logger, et=None):
+  def __init__(self, logger):
     self._log = logger
-    self._et = et
     self._viewXforms = []
-    self._items = self.read(et)
+    self._names = {}  # cache of localName() results
+    self._defs = {}   # id -> QPolygonF, from <defs>
     self.found_native_tiles = False
 
-  def get_items(self): return self._items
   def get_view_transforms(self): return self._viewXforms
 
   tiles_types = \
@@ -77,51 +73,194 @@ class SVGReader(object):
     , 'RulerTileItem'   : RulerTileItem
     }
 
+  # ElementTree names things '{namespace}name'; the tile classes expect
+  # plain SVG names and 'tiles:' prefixed names.
+  namespace_prefixes = ( ('{%s}'%SVG_ns, ''), ('{%s}'%TILES_ns, 'tiles:'), ('{%s}'%XLINK_ns, 'xlink:') )
+
+  def localName(self, qname):
+    name = self._names.get(qname)
+    if name is None:
+      name = qname
+      for (ns, prefix) in self.namespace_prefixes:
+        if qname.startswith(ns):
+          name = prefix + qname[len(ns):]
+          break
+      self._names[qname] = name
+    return name
+
+  def localize(self, e):
+    'Rename the tag and attributes of element e to use local names.'
+    e.tag = self.localName(e.tag)
+    if any(k.startswith('{') for k in e.attrib):
+      attrib = { self.localName(k) : v for (k,v) in e.attrib.items() }
+      e.attrib.clear()
+      e.attrib.update(attrib)
+    return e
+
+  def isContainer(self, e):
+    return e.tag in ('svg', 'g', 'defs') and not e.get('tiles:type') in self.tiles_types
+
+  def iterItems(self, source):
+    '''Given a file name or binary file object of SVG,
+       yield the corresponding TileItems as their elements are parsed.'''
+    # TODO:
+    #   parse attrs: width w, height h, viewbox x y w h
+    #   and then scale contents accordingly?
+    # Default is to ignore container structure and return the contained objects.
+    # Only the contents of <svg> and <g> are read, and each element is
+    # discarded once read, so memory use doesn't grow with the document.
+    # Shapes in <defs> are remembered for later <use> elements.
+    elements = []  # the open elements
+    reading = []   # whether the children of each open element are read
+    for (event, e) in ET.iterparse(source, events=('start', 'end')):
+      if event == 'start':
+        self.localize(e)
+        readChildren = (not reading or reading[-1]) and self.isContainer(e) \
+                       and (not elements or elements[-1].tag != 'defs')
+        if readChildren and e.get('tiles:type') == 'MagneticTileView':
+          # This is not a tile, it's a group for recording the view transformation.
+          self._log.trace("found MagneticTileView element")
+          if 'transform' in e.attrib:
+            self._viewXforms = svgparsing.ParseTransformAttrib(e.attrib['transform'])
+        elements.append(e)
+        reading.append(readChildren)
+      else:
+        elements.pop()
+        readChildren = reading.pop()
+        if reading and reading[-1] and not readChildren:
+          if elements[-1].tag == 'defs':
+            self.define(e)
+          else:
+            it = self.read(e)
+            if not it is None:
+              yield it
+        if elements:
+          elements[-1].remove(e)
+        e.clear()
+
   def read(self, e):
-    "Given an ElementTree, return a corresponding list of constructed TileItems"
-    if 'tiles:type' in e.attrib:
-      tt = e.attrib['tiles:type']
+    "Given a (localized) SVG element, return a corresponding constructed TileItem, or None"
+    tt = e.get('tiles:type')
+    if not tt is None:
       self.found_native_tiles = True
-    else:
-      tt = None
-    if tt in self.tiles_types:
-      cls = self.tiles_types[tt]
-      pti = cls.newFromSvg(e)
-      if not pti is None:
-        return [pti]
-    elif e.tag in 'svg g'.split():
-      # TODO:
-      #   parse attrs: width w, height h, viewbox x y w h
-      #   and then scale contents accordingly?
-
-      # Default is to ignore container structure and return the contained objects.
-      if tt == 'MagneticTileView':
-        # This is not a tile, it's a group for recording the view transformation.
-        self._log.trace("found MagneticTileView element")
-        if 'transform' in e.attrib:
-          self._viewXforms = svgparsing.ParseTransformAttrib(e.attrib['transform'])
-      self._log.trace('recursing on "{}" tag', e.tag)
-      items = []
-      for c in e:
-        for it in self.read(c):
-          items.append(it)
-      return items
+    if e.tag == 'use':
+      return self.readUse(e, tt)
+    elif tt in self.tiles_types:
+      return self.tiles_types[tt].newFromSvg(e)
     elif e.tag == 'polygon':
-      cls = PolygonTileItem
-      pti = cls.newFromSvg(e)
-      if not pti is None:
-        return [pti]
+      return PolygonTileItem.newFromSvg(e)
     elif e.tag == 'path':
       if 'd' in e.attrib:
         self._log.trace('path {}', e.attrib['d'])
-        pti = PolygonTileItem.newFromSvg(e)
-        if not pti is None:
-          return [pti]
+        return PolygonTileItem.newFromSvg(e)
     elif e.tag == 'ellipse':
-      eti = tileitems.EllipseTileItem.newFromSvg(e)
-      if not eti is None:
-        return [eti]
-    return []
+      return tileitems.EllipseTileItem.newFromSvg(e)
+    return None
+
+  def define(self, e):
+    'Remember the shape of (localized) element e, a child of <defs>, for <use> elements to refer to.'
+    name = e.get('id')
+    if name is None:
+      return
+    if e.tag == 'polygon' and 'points' in e.attrib:
+      polygon = svgparsing.ParsePoints(e.attrib['points'])
+    elif e.tag == 'path' and 'd' in e.attrib:
+      polygon = svgparsing.SvgPathCmdsToPolygons(svgparsing.ParseSvgPathData(e.attrib['d']))[0]
+    else:
+      self._log.debug('ignoring definition of {} #{}', e.tag, name)
+      return
+    if 'transform' in e.attrib:
+      polygon = svgparsing.ParseTransform(e.attrib['transform']).map(polygon)
+    self._defs[name] = polygon
+
+  def readUse(self, e, tt):
+    "Given a (localized) <use> element, return a TileItem of the shape it refers to, or None"
+    href = e.get('xlink:href', e.get('href', ''))
+    polygon = self._defs.get(href[1:]) if href.startswith('#') else None
+    if polygon is None:
+      self._log.warning('unresolved <use> reference: "{}"', href)
+      return None
+    it = self.tiles_types.get(tt, PolygonTileItem).newFromSvg(e, polygon)
+    # <use> x & y are an additional translation, applied before the transform.
+    (x, y) = (float(e.get('x', 0)), float(e.get('y', 0)))
+    if x or y:
+      it.setTransform(QtGui.QTransform.fromTranslate(x, y) * it.transform())
+    return it
+
+class DocumentLoader(QtCore.QObject):
+  '''Adds the tiles from an SVG or .tiles file to a scene a chunk at a time,
+     from the event loop, so the first tiles appear right away, the
+     application stays responsive, and a long load can be canceled.'''
+
+  CHUNK_MS = 50  # time to spend adding tiles before returning to the event loop
+
+  # Emitted once, with True if the whole file was loaded.
+  finished = QtCore.pyqtSignal(bool)
+
+  def __init__(self, logger, scene, f, progress=None, parent=None):
+    '''
+      Parameters:
+      f           a buffered binary file object, which will be closed when finished
+      progress    an optional QProgressDialog, with a maximum of the file size in KiB
+    '''
+    super().__init__(parent)
+    self._log = logger
+    self._scene = scene
+    self._file = f
+    if tilesfile.IsTilesFile(f):
+      self._reader = tilesfile.TilesReader(logger)
+    else:
+      self._reader = SVGReader(logger)
+    self._items = self._reader.iterItems(f)
+    self._progress = progress
+    self._timer = QtCore.QTimer(self)
+    self._timer.timeout.connect(self.loadChunk)
+    self.count = 0      # number of tiles added so far
+    self.error = None   # description of why loading failed, if it did
+
+  def reader(self):
+    return self._reader
+
+  def start(self):
+    self._timer.start(0)
+
+  def cancel(self):
+    self._log.info('loading canceled after {} tiles', self.count)
+    self.finish(False)
+
+  def finish(self, ok):
+    self._timer.stop()
+    self._items.close()
+    self._file.close()
+    if not self._progress is None:
+      self._progress.reset()
+    self.finished.emit(ok)
+
+  @QtCore.pyqtSlot()
+  def loadChunk(self):
+    if not self._progress is None and self._progress.wasCanceled():
+      return self.cancel()
+    clock = QtCore.QElapsedTimer()
+    clock.start()
+    done = True
+    try:
+      # Opening a document can't be undone.
+      with self._scene.undoStack.suspended(), self._scene.batch():
+        for it in self._items:
+          self._scene.addItem(it)
+          self.count += 1
+          if clock.elapsed() >= self.CHUNK_MS:
+            done = False
+            break
+    except (ET.ParseError, ValueError) as e:
+      self.error = str(e)
+      self._log.warning('error after {} tiles: {}', self.count, e)
+      return self.finish(False)
+    if not self._progress is None and not self._file.closed:
+      self._progress.setValue(self._file.tell() // 1024)
+    if done:
+      self._log.debug('loaded {} tiles', self.count)
+      self.finish(True)
 
 regularPolyName = '0-gon monogon digon triangle square pentagon hexagon heptagon octagon nonagon decagon hendecagon dodecagon tridecagon tetradecagon pentadecagon hexadecagon heptadecagon octadecagon nonadecagon icosagon'.split()
 
@@ -152,14 +291,19 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     #Ui_MagneticTilesMainWindow.__init__(self)
     super().__init__()
     self._log = logger
+    self._loader = None  # DocumentLoader of a file being opened
     self.setupUi(self)
     self.actionPrint.setVisible(False)
     self.actionSnapSettings.setVisible(False)
     self.actionAboutQt.triggered.connect(QtWidgets.qApp.aboutQt)
     self.initScene()
-    self.actionSelectAll.triggered.connect(self.scene.setSelectionAll)
+    self.initAutoSave()
+    self.actionSelectAll.triggered.connect(self.selectAll)
     self.actionDeselectAll.triggered.connect(self.scene.clearSelection)
+    self.actionInvertSelection = self.menuEdit.addAction('&Invert Selection', self.invertSelection, 'Ctrl+I')
     self.initGraphicsView()
+    self.initUndoActions()
+    self.initSnapModeMenu()
     self.menuShape.addAction('&Color', self.on_actionShapeColor_triggered, 'C')
     self.menuShape.addAction('Randomize...', self.on_randomize)
     self.createShapeAddMenuEntries()
@@ -176,6 +320,7 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     if SOUND:
       self.initSound()
       self.scene.snapped.connect(self.playSnapSound)
+    self.scene.undoStack.clear()
     self.setWindowModified(False)
     self.updateWindowTitle()
     self._defaultRegularPolygonSides = 6
@@ -195,6 +340,59 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     self.actionBackground_Color.triggered.connect(self.scene.editBackgroundColor)
     self.actionBorder_Color.triggered.connect(self.scene.editBorderColor)
 
+  def initAutoSave(self):
+    # Each process autosaves to its own ring, under a common directory where
+    # the next one looks for rings orphaned by a crash.
+    self._autoSaveRoot = os.path.join(QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppDataLocation), 'autosave')
+    ring = tileautosave.OwnRing(self._autoSaveRoot)
+    self._recoveredPath = ring.recoveredPath()
+    self.autoSaver = tileautosave.AutoSaver(self._log, self.scene, ring, parent=self)
+
+  def offerRecovery(self):
+    '''If autosaved versions were left behind (by a crash), offer to open the latest.
+       Return True if it is being opened.'''
+    rings = tileautosave.OrphanedRings(self._autoSaveRoot)
+    if not rings:
+      return False
+    # Offer the latest; any others are left to offer next time.
+    ring = rings[0]
+    for other in rings[1:]:
+      other.unlock()
+    path = ring.paths()[0]
+    stdBtnId = QtWidgets.QMessageBox.question(self, 'Recover document?',
+      'Tiles were autosaved at {}, but not saved before the program ended.\n'
+      'Do you want to recover them?'.format(
+        QtCore.QDateTime.fromSecsSinceEpoch(int(os.path.getmtime(path))).toString()))
+    if stdBtnId != QtWidgets.QMessageBox.Yes:
+      ring.discard()
+      return False
+    # Move it into this process's ring, where it is kept until closing.
+    os.replace(path, self._recoveredPath)
+    ring.discard()
+    self.open(self._recoveredPath)
+    return True
+
+  def initUndoActions(self):
+    undoStack = self.scene.undoStack
+    self.actionUndo = QtWidgets.QAction('&Undo', self)
+    self.actionUndo.setShortcut(QtGui.QKeySequence.Undo)
+    self.actionUndo.triggered.connect(undoStack.undo)
+    self.actionRedo = QtWidgets.QAction('&Redo', self)
+    self.actionRedo.setShortcut(QtGui.QKeySequence.Redo)
+    self.actionRedo.triggered.connect(undoStack.redo)
+    self.menuEdit.insertActions(self.actionCut, [self.actionUndo, self.actionRedo])
+    self.menuEdit.insertSeparator(self.actionCut)
+    undoStack.changed.connect(self.updateUndoActions)
+    self.updateUndoActions()
+
+  @QtCore.pyqtSlot()
+  def updateUndoActions(self):
+    undoStack = self.scene.undoStack
+    self.actionUndo.setEnabled(undoStack.canUndo())
+    self.actionUndo.setText(' '.join(['&Undo', undoStack.undoText()]).strip())
+    self.actionRedo.setEnabled(undoStack.canRedo())
+    self.actionRedo.setText(' '.join(['&Redo', undoStack.redoText()]).strip())
+
   def initGraphicsView(self):
     self.graphicsView._log = self._log
     self.graphicsView.setResizeAnchor(QtWidgets.QGraphicsView.AnchorViewCenter)
@@ -202,10 +400,25 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     self.graphicsView.setAcceptDrops(True)
     self.on_actionViewReset_triggered()
 
+  @QtCore.pyqtSlot()
+  def selectAll(self):
+    if not self.scene.setSelectionAll():
+      self.warnTooManyStored()
+
+  @QtCore.pyqtSlot()
+  def invertSelection(self):
+    if not self.scene.invertSelection():
+      self.warnTooManyStored()
+
+  def warnTooManyStored(self):
+    self.statusbar.showMessage('Too many tiles to select at once; only those near the view were included.', 5000)
+
   def newDocument(self):
     self._log.trace('entering')
+    self.scene.setTileStore(None)
     self.scene.setSelectionAll()
     self.scene.removeSelection()
+    self.scene.undoStack.clear()
     self.on_actionViewReset_triggered()
     self.setWindowFilePath('')
     self.setWindowModified(False)
@@ -227,6 +440,9 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     self.toss(t, pos=pos, variance=variance)
     return t
   def addPolygon(self, polygon, color=None, pos=None, variance=None):
+    return self.addPolygons([polygon], color=color, pos=pos, variance=variance)[0]
+  def addPolygons(self, polygons, color=None, pos=None, variance=(3,3)):
+    'Add a tile for each polygon, and make them the selection.'
     if pos is None:
       #viewRect = self.graphicsView.rect()
       viewRect = self.graphicsView.viewport().rect()
@@ -234,16 +450,16 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
       pos = self.graphicsView.mapToScene(viewRect.center())
       pos = QtCore.QPointF(round(pos.x(),1), round(pos.y(),1))
     self._log.trace('pos={}', pos)
-    self.scene.clearSelection()
-    it = PolygonTileItem(polygon=polygon, color=color)
-    self.colorToss(it, color=color, pos=pos, variance=variance)
-    self.scene.addItem(it)
-    it.setSelected(True)
-    return it
-  def addPolygons(self, polygons, color=None, pos=None, variance=(3,3)):
-    self.scene.clearSelection()
-    tiles = [self.addPolygon(p, color=color, pos=pos, variance=variance) for p in polygons]
-    for it in tiles: it.setSelected(True)
+    tiles = []
+    with self.scene.batch():
+      self.scene.clearSelection()
+      for p in polygons:
+        it = PolygonTileItem(polygon=p, color=color)
+        self.colorToss(it, color=color, pos=pos, variance=variance)
+        self.scene.addItem(it)
+        tiles.append(it)
+      for it in tiles: it.setSelected(True)
+    return tiles
 
   def createShapeAddMenuEntries(self):
     no_columns = (platform.system() == 'Darwin')
@@ -338,49 +554,28 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     self.menuAdd.addAction('Ruler', lambda: self.scene.addItem(tileitems.RulerTileItem()))
 
   def addBackgroundItems(self):
-    titleItem = QtWidgets.QGraphicsSimpleTextItem(app_title)
-    titleItem.setScale(.1)
-    titleItem.moveBy(-titleItem.sceneBoundingRect().width()/2, -9)
-    titleItem.setBrush(QtGui.QColor.fromHsv(300,5,127,31))
-    titleItem.setPen(QtGui.QPen(QtGui.QColor.fromHsv(300,5,127,31),0))
-    self.scene.addItem(titleItem)
-
-    # Add (non-tile, background) lines
-    hLines = [ QtWidgets.QGraphicsLineItem(-10,y,10,y) for y in range(-10,11) ]
-    vLines = [ QtWidgets.QGraphicsLineItem(x,-10,x,10) for x in range(-10,11) ]
-    circles = [ QtWidgets.QGraphicsEllipseItem(-r,-r,2*r,2*r) for r in range(1,11) ]
-    radii   = [ QtWidgets.QGraphicsLineItem(.5*math.cos(r),.5*math.sin(r),10*math.cos(r),10*math.sin(r))
-                for r in [math.radians(d) for d in range(0,360,5)] ]
-    linePen = QtGui.QPen(QtGui.QColor.fromHsv(0,0,127,31), 0)
-    for it in hLines + vLines + circles + radii:
-      it.setPen(linePen)
-      self.scene.addItem(it)
-
-    zeroLines = [ QtWidgets.QGraphicsLineItem(-.5,0,.5,0)
-                , QtWidgets.QGraphicsLineItem(0,-.5,0,.5)
-                ]
-    for it in zeroLines:
-      it.setPen(QtGui.QPen(QtGui.QColor(127,127,127,63), 0))
-      self.scene.addItem(it)
+    # The guide lines are painted by the scene, rather than being items in it.
+    self.scene.setBackgroundGuide(BackgroundGuide(app_title))
 
   def addInitialTiles(self):
-    # Create some initial tiles
-    self.addPolygons(tileitems.TriominoPolySet(), variance=INITIAL_VARIANCE)
-    self.addPolygons(tileitems.TetrominoPolySet(), variance=INITIAL_VARIANCE)
-    self.addPolygons(tileitems.PentominoPolySet(), variance=INITIAL_VARIANCE)
-    self.addPolygons(tileitems.TetriamondPolySet(), variance=INITIAL_VARIANCE)
-    self.addPolygons(tileitems.PentiamondPolySet(), variance=INITIAL_VARIANCE)
-    self.addPolygons(tileitems.HexiamondPolySet(), variance=INITIAL_VARIANCE)
-    self.addPenroseBatch()
-    self.addPolygons(tileitems.TangramPolySet(), color=QtCore.Qt.green, variance=INITIAL_VARIANCE)
-    self.addRegularPolygons()
-    self.addPolygons(list(tileitems.Rhombus(45) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
-    self.addPolygons(list(tileitems.Rhombus(360/14) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
-    self.addPolygons(list(tileitems.Rhombus(2*360.0/14) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
-    self.addPolygons(list(tileitems.Rhombus(3*360.0/14) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
-    self.addPolygons(list(tileitems.HalfDiamond() for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
-    self.addMiscellaneousTiles()
-    self.scene.clearSelection()
+    with self.scene.batch():
+      # Create some initial tiles
+      self.addPolygons(tileitems.TriominoPolySet(), variance=INITIAL_VARIANCE)
+      self.addPolygons(tileitems.TetrominoPolySet(), variance=INITIAL_VARIANCE)
+      self.addPolygons(tileitems.PentominoPolySet(), variance=INITIAL_VARIANCE)
+      self.addPolygons(tileitems.TetriamondPolySet(), variance=INITIAL_VARIANCE)
+      self.addPolygons(tileitems.PentiamondPolySet(), variance=INITIAL_VARIANCE)
+      self.addPolygons(tileitems.HexiamondPolySet(), variance=INITIAL_VARIANCE)
+      self.addPenroseBatch()
+      self.addPolygons(tileitems.TangramPolySet(), color=QtCore.Qt.green, variance=INITIAL_VARIANCE)
+      self.addRegularPolygons()
+      self.addPolygons(list(tileitems.Rhombus(45) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
+      self.addPolygons(list(tileitems.Rhombus(360/14) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
+      self.addPolygons(list(tileitems.Rhombus(2*360.0/14) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
+      self.addPolygons(list(tileitems.Rhombus(3*360.0/14) for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
+      self.addPolygons(list(tileitems.HalfDiamond() for i in range(4)), color=randomColor(), variance=INITIAL_VARIANCE)
+      self.addMiscellaneousTiles()
+      self.scene.clearSelection()
 
   def addMiscellaneousTiles(self):
     ellipses = [ tileitems.EllipseTileItem(QtCore.QRectF(-1,-1,2,2))
@@ -468,60 +663,78 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     self.scene.render(painter)
     del painter
 
-  def toSvg(self, onlySelected=False):
-    'Return selected or all items in the scene as an SVG document string'
+  def documentTiles(self, onlySelected=False):
+    'Return the selected or all items in the scene that can be saved, bottom to top'
     if onlySelected:
       self._log.trace('selectionGroup: pos={}, transform={}'
                      , self.scene.selectionGroup.pos()
                      , q2str.FormatQTransform(self.scene.selectionGroup.transform()) )
-    svg_attribs = \
-      { 'xmlns'       : SVG_ns
-      , 'xmlns:tiles' : TILES_ns
-      , 'version'     : '1.1'
-      , 'width'       : str(self.scene.sceneRect().width())
-      , 'height'      : str(self.scene.sceneRect().height())
-      }
-    doc = ET.Element('svg', attrib=svg_attribs)
+    return [ it for it in self.scene.items(order=QtCore.Qt.AscendingOrder)
+             if (it.isSelected() or not onlySelected) and hasattr(it, 'writeSvg') ]
+
+  def writeSvg(self, f, onlySelected=False):
+    'Write selected or all items in the scene to text stream f as an SVG document'
+    items = self.documentTiles(onlySelected)
+    writer = SVGWriter(f)
+    writer.declaration(XML_decl)
+    writer.start('svg',
+      [ ('xmlns'       , SVG_ns)
+      , ('xmlns:tiles' , TILES_ns)
+      , ('xmlns:xlink' , XLINK_ns)
+      , ('version'     , '1.1')
+      , ('width'       , str(self.scene.sceneRect().width()))
+      , ('height'      , str(self.scene.sceneRect().height()))
+      ])
+    store = None if onlySelected else self.scene.tileStore()
+    # Each distinct shape is written once, then drawn by reference.
+    writer.start('defs')
+    for it in items:
+      it.writeSvgDefs(writer)
+    storeShapes = []  # (shape, define()d key) of each stored shape index
+    if not store is None:
+      for shape in store.shapes():
+        key = tilesfile.StoredShapeKey(shape)
+        if isinstance(shape, QtGui.QPolygonF):
+          writer.define(key, 'polygon', [('points', key.svgPoints())])
+        storeShapes.append((shape, key))
+    writer.end()
     svg_xlate = 'translate({x} {y})'.format( x=self.graphicsView.horizontalScrollBar().value()
                                            , y=self.graphicsView.verticalScrollBar().value() )
     svg_matrix = q2str.FormatQTransformSVGMatrix(self.graphicsView.transform())
-    scene_g = ET.SubElement(doc, 'g', transform='{} {}'.format(svg_xlate, svg_matrix))
-    scene_g.attrib['tiles:type'] = 'MagneticTileView'
-    for it in self.scene.items(order=QtCore.Qt.AscendingOrder):
-      if it.isSelected() or not onlySelected:
-        if hasattr(it, 'toSvg'):
-          e = it.toSvg(scene_g)
-          scene_g.append(e)
-    contents = '\n'.join([XML_decl] + ET.tostringlist(doc, encoding='unicode'))
+    # Tiles all share one outline, so it's given once, for the tiles to inherit.
+    writer.start('g',
+      [ ('transform'    , '{} {}'.format(svg_xlate, svg_matrix))
+      , ('tiles:type'   , 'MagneticTileView')
+      , ('stroke'       , self.scene.tilePen().color().name())
+      , ('stroke-width' , '.03px')
+      ])
+    for it in items:
+      it.writeSvg(writer)
+    if not store is None:
+      # Stored tiles are below any promoted ones, but reading back restacks them equivalently.
+      for r in store.records():
+        (shape, key) = storeShapes[r.shape]
+        tilesfile.WriteSvgRecord(writer, r, shape, key)
+    writer.close()
+
+  def toSvg(self, onlySelected=False):
+    'Return selected or all items in the scene as an SVG document string'
+    f = io.StringIO()
+    self.writeSvg(f, onlySelected)
+    contents = f.getvalue()
     self._log.trace('{}', contents)
     return contents
 
   def fromSvg(self, svg):
-    #etdoc = ET.parse(io.StringIO(svg))
-    #doc = etdoc.getroot()
-    doc = ET.fromstring(svg)
-    #self._log.debug('dir({}) = {}', doc.__class__, dir(doc))
-    #remove_namespace(doc, SVG_ns)
-    rename_namespace(doc, u'{%s}'%SVG_ns, '')
-    rename_namespace(doc, u'{%s}'%TILES_ns, 'tiles:')
-    #def dump(t, indent=''):
-    #  self._log.trace('{}{}: {}', indent, t.tag, t.attrib)
-    #  for s in t: dump(s, indent+'  ')
-    #dump(doc)
-    #def search(p):
-    #  #self._log.trace('searching "{}":', p)
-    #  for e in doc.findall(p): #, namespaces=ET_nss):
-    #    dump(e)
-    #search('polygon')
-    #search('svg:polygon')
-    #search('{http://www.w3.org/2000/svg}polygon')
-    #search('.')
-    #search('svg')
-    reader = SVGReader(self._log, doc)
-    items = reader.get_items()
-    for it in items:
-      self.scene.addItem(it)
-      #it.setSelected(True)
+    'Add the tiles in an SVG document (str or bytes) to the scene, and return them.'
+    if isinstance(svg, str):
+      svg = svg.encode()
+    reader = SVGReader(self._log)
+    items = []
+    with self.scene.batch():
+      for it in reader.iterItems(io.BytesIO(bytes(svg))):
+        self.scene.addItem(it)
+        items.append(it)
     if False: #reader.get_view_transforms():
       self._log.trace("loading view transform from SVG")
       self.graphicsView.setTransform( QtGui.QTransform(), combine=False )
@@ -535,9 +748,9 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
           self.graphicsView.setTransform(t, combine=True)
     return items
 
-  @QtCore.pyqtSlot()
+  @QtCore.pyqtSlot(object)
   def registerChange(self, what=None):
-    self._log.debug('changed')
+    self._log.debug('changed: {}', what)
     self.setWindowModified(True)
 
   @QtCore.pyqtSlot()
@@ -558,7 +771,8 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
   def on_actionCut_triggered(self):
     self._log.debug("actionCut_triggered")
     self.on_actionCopy_triggered()
-    self.on_actionDelete_triggered()
+    with self.scene.undoStack.record('Cut', ()):
+      self.on_actionDelete_triggered()
 
   @QtCore.pyqtSlot()
   def on_actionPaste_triggered(self):
@@ -572,10 +786,11 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
           open('tiles-debug-pasted-mimedata.svg','wb').write(md)
         except:
           pass
-        self.scene.clearSelection()
-        items = self.fromSvg(md)
-        for it in items:
-          it.setSelected(True)
+        with self.scene.undoStack.record('Paste', ()), self.scene.batch():
+          self.scene.clearSelection()
+          items = self.fromSvg(md)
+          for it in items:
+            it.setSelected(True)
         #self.scene.selectionGroup.autoscale()
         # TODO: auto-center or figure the f*ck out about SVG units
         break
@@ -614,11 +829,11 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
 
   def getSaveFileName(self):
     (name, selectedFilter) = QtWidgets.QFileDialog.getSaveFileName(self,
-      filter="SVG files (*.svg)",
+      filter=SAVE_FILTERS,
       options=QtWidgets.QFileDialog.HideNameFilterDetails)
     if name:
-      if not name.lower().endswith('.svg'):
-        name = name + '.svg'
+      if not name.lower().endswith(('.svg', '.tiles')):
+        name = name + ('.tiles' if '.tiles' in selectedFilter else '.svg')
       if os.path.exists(name):
         stdBtnId = QtWidgets.QMessageBox.question(self, 'Overwrite file?',
           'A file named "{}" already exists.  Are you sure you want to overwrite it?'.format(name))
@@ -639,19 +854,37 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     self.setWindowTitle(title)
 
   def saveTo(self, filename):
+    'Save the document, as .tiles if filename ends with that, otherwise as SVG'
+    binary = filename.lower().endswith('.tiles')
+    # Write a temporary file, then replace the original with it, since
+    # a lazily loaded document is still reading from the original.  The
+    # store lets go of the original first, as a mapped file can't be
+    # replaced on some platforms.
+    tmpname = filename + '.tmp'
     try:
-      f = open(filename, 'wt')
+      if binary:
+        f = open(tmpname, 'wb')
+      else:
+        f = open(tmpname, 'wt', encoding='utf-8')
     except:
       QtWidgets.QMessageBox.critical(self, 'Error', 'Error opening {}'.format(filename))
       return False
     if not f:
       return False
-    contents = self.toSvg()
     try:
-      f.write(contents)
-      f.close()
+      with f:
+        if binary:
+          tilesfile.WriteTiles(f, self.documentTiles(), self.scene.tileStore())
+        else:
+          self.writeSvg(f)
+      store = self.scene.tileStore()
+      if not store is None and store.isMapping(filename):
+        store.detach()
+      os.replace(tmpname, filename)
     except:
       QtWidgets.QMessageBox.critical(self, 'Error', 'Error writing {}'.format(filename))
+      if os.path.exists(tmpname):
+        os.remove(tmpname)
       return False
     self._log.info('saved to {}', filename)
     self.setWindowModified(False)
@@ -662,20 +895,74 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
   def on_actionOpen_triggered(self):
     self._log.debug("actionOpen_triggered")
     if self.readyToClose():
-      (name, _selectedFilter) = QtWidgets.QFileDialog.getOpenFileName(self, filter="SVG files (*.svg)")
+      (name, _selectedFilter) = QtWidgets.QFileDialog.getOpenFileName(self, filter=OPEN_FILTERS)
       if name:
         self.open(name)
 
   def open(self, name):
+    'Start loading a file; the tiles are added to the scene over the next moments.'
     self.newDocument()
     try:
-      f = open(name)
+      f = open(name, 'rb')
     except FileNotFoundError:
       QtWidgets.QMessageBox.critical(self, 'Error', 'File not found: {}'.format(name))
       return
-    self.fromSvg(f.read())
-    self.setSaveFileName(name)
-    self.setWindowModified(False)
+    if not self._loader is None:
+      self._loader.cancel()
+    if tilesfile.IsTilesFile(f) and self.openLazily(name):
+      f.close()
+      return
+    progress = QtWidgets.QProgressDialog('Loading {}'.format(os.path.basename(name)), 'Cancel'
+                                        , 0, max(1, os.path.getsize(name) // 1024), self)
+    progress.setWindowModality(QtCore.Qt.WindowModal)
+    progress.setMinimumDuration(500)  # don't flash up for small files
+    self._loader = DocumentLoader(self._log, self.scene, f, progress, parent=self)
+    self._loader.finished.connect(lambda ok: self.openFinished(name, ok))
+    self._loader.start()
+
+  def isRecovering(self, name):
+    return name == self._recoveredPath
+
+  def openLazily(self, name):
+    '''If .tiles file name is big enough, open it as a TileStore, so its tiles
+       become items only as they're viewed, and return True.'''
+    if tilestore.numpy is None:
+      return False
+    try:
+      store = tilestore.TileStore(self._log, open(name, 'rb'))
+    except (ValueError, OSError) as e:
+      QtWidgets.QMessageBox.critical(self, 'Error', 'Error reading {}:\n{}'.format(name, e))
+      return True
+    if len(store) < tilestore.LAZY_LOAD_TILES:
+      store.close()
+      return False
+    self._log.info('opened {} tiles lazily', len(store))
+    self.scene.setTileStore(store)
+    self.openSucceeded(name)
+    self.updateWindowTitle()
+    return True
+
+  def openSucceeded(self, name):
+    if self.isRecovering(name):
+      # The recovered tiles are as yet unsaved.
+      self.setSaveFileName('')
+      self.setWindowModified(True)
+    else:
+      self.setSaveFileName(name)
+      self.setWindowModified(False)
+
+  def openFinished(self, name, ok):
+    loader = self._loader
+    self._loader = None
+    loader.deleteLater()
+    if ok:
+      self.openSucceeded(name)
+    else:
+      if loader.error is None:
+        self.newDocument()  # canceled
+      else:
+        QtWidgets.QMessageBox.critical(self, 'Error', 'Error reading {}:\n{}'.format(name, loader.error))
+      self.setWindowModified(False)
     self.updateWindowTitle()
 
   @QtCore.pyqtSlot()
@@ -717,6 +1004,26 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
     self._log.debug('actionSnapAngles_toggled')
     self.scene.snapToAnglesEnabled = not self.scene.snapToAnglesEnabled
 
+  def initSnapModeMenu(self):
+    'Add a View submenu to choose what dragged tiles snap to.'
+    self.menuSnapMode = QtWidgets.QMenu('Snap &To', self)
+    self.snapModeGroup = QtWidgets.QActionGroup(self)
+    for (text, mode) in ( ('&Corners', self.scene.SNAP_POINTS)
+                        , ('Corners That &Fit', self.scene.SNAP_CORNERS)
+                        , ('&Edges', self.scene.SNAP_EDGES) ):
+      action = self.menuSnapMode.addAction(text)
+      action.setCheckable(True)
+      action.setChecked(mode == self.scene.snapMode)
+      action.setData(mode)
+      self.snapModeGroup.addAction(action)
+    self.snapModeGroup.triggered.connect(self.snapModeTriggered)
+    self.menuView.insertMenu(self.actionSnapSettings, self.menuSnapMode)
+
+  @QtCore.pyqtSlot(QtWidgets.QAction)
+  def snapModeTriggered(self, action):
+    self._log.debug('snapModeTriggered')
+    self.scene.setSnapMode(action.data())
+
   @QtCore.pyqtSlot()
   def on_actionSnapSettings_triggered(self):
     self._log.debug('actionSnapSettings_triggered')
@@ -779,6 +1086,12 @@ class MagneticTilesMainWindow(Ui_MagneticTilesMainWindow, QtWidgets.QMainWindow)
 
   def closeEvent(self, evt):
     if self.readyToClose():
+      # Nothing is left unsaved, so the autosaves aren't needed for recovery.
+      self.autoSaver.stop()
+      try:
+        self.autoSaver.ring().discard()
+      except OSError as e:
+        self._log.warning('could not discard autosaves: {}', e)
       evt.accept()
     else:
       evt.ignore()
@@ -802,6 +1115,7 @@ def main(argv):
   logger = tilelog.NotLogger()
   tileitems.logger = logger
   svgparsing.logger = logger
+  svgwriting.logger = logger
   p = argparse.ArgumentParser()
   p.add_argument('--call') # call the named member of mainWnd and exit
   p.add_argument('--debug', action='store_true')
@@ -815,6 +1129,8 @@ def main(argv):
   app = QtWidgets.QApplication(argv[:1] + argv_remaining)
   mainWnd = MagneticTilesMainWindow(logger)
   mainWnd.show()
+  if len(argv_remaining) < 1 and opts.call is None:
+    mainWnd.offerRecovery()
   icn = QtGui.QIcon('resources/pentomino-t-rgbyc-48px.svg')
   app.setWindowIcon(icn)
   if not opts.call is None:
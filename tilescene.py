@@ -1,7 +1,112 @@
 
-import math
-from PyQt5 import QtCore, QtGui, QtWidgets
-import tileselection
+import math, contextlib
+from PyQt5 import QtCore, QtGui, QtWidgets, sip
+import tileselection, tilesnap, tileundo
+from tileitems import BlackOrWhiteCompliment
+
+
+class SceneExtent(object):
+  '''The bounding rectangle of a set of items, maintained incrementally.
+     Items that moved are marked dirty, and sync() re-reads just those.
+     Growing the bounds is O(1) per item, but when an item that was on the
+     boundary moves inward or is removed, the bounds can only shrink by
+     recompute()ing the union of all items, so the caller is told (isStale())
+     and can do that later.
+  '''
+
+  LEFT, TOP, RIGHT, BOTTOM = 1, 2, 4, 8
+
+  def __init__(self):
+    self._rects = {}           # item -> sceneBoundingRect() as of the last sync()
+    self._bounds = QtCore.QRectF()
+    self._dirty = set()
+    self._stale = False
+
+  def __len__(self):
+    return len(self._rects)
+
+  def bounds(self):
+    'Return a rect containing all items (but perhaps larger, if isStale()).'
+    return QtCore.QRectF(self._bounds)
+
+  def isStale(self):
+    return self._stale
+
+  def markDirty(self, item):
+    self._dirty.add(item)
+
+  def _edges(self, r):
+    'Return which edges of the bounds r touches.'
+    b = self._bounds
+    return ( (r.left() <= b.left() and self.LEFT)
+           | (r.top() <= b.top() and self.TOP)
+           | (r.right() >= b.right() and self.RIGHT)
+           | (r.bottom() >= b.bottom() and self.BOTTOM) )
+
+  def sync(self, isTracked):
+    'Update dirty items, dropping those for which isTracked(item) is false.  Return True if the bounds grew.'
+    grew = False
+    for item in self._dirty:
+      old = self._rects.pop(item, None)
+      r = None
+      if isTracked(item):
+        r = item.sceneBoundingRect()
+        if r.isEmpty():
+          r = None
+        else:
+          self._rects[item] = r
+          if not self._bounds.contains(r):
+            self._bounds |= r
+            grew = True
+      if not old is None and self._edges(old) & ~(0 if r is None else self._edges(r)):
+        self._stale = True  # the bounds may shrink
+    self._dirty.clear()
+    return grew
+
+  def recompute(self):
+    'Recalculate the bounds from scratch.  Return True if they changed.'
+    b = QtCore.QRectF()
+    for r in self._rects.values():
+      b |= r
+    self._stale = False
+    changed = b != self._bounds
+    self._bounds = b
+    return changed
+
+
+class TileChange(object):
+  '''A summary of which tiles were added, removed, or otherwise modified,
+     as carried by TileScene.tileChanged.  Changes can be accumulated with
+     update(), in which case a tile added and then removed cancels out.
+  '''
+
+  def __init__(self, added=(), removed=(), modified=()):
+    self.added = set(added)
+    self.removed = set(removed)
+    self.modified = set(modified) - self.added
+
+  def __bool__(self):
+    return bool(self.added or self.removed or self.modified)
+
+  def __repr__(self):
+    return 'TileChange({} added, {} removed, {} modified)'.format(
+      len(self.added), len(self.removed), len(self.modified))
+
+  def update(self, other):
+    'Accumulate another TileChange (that happened after this one).'
+    for it in other.added:
+      if it in self.removed:
+        self.removed.discard(it)
+        self.modified.add(it)
+      else:
+        self.added.add(it)
+    for it in other.removed:
+      if it in self.added:
+        self.added.discard(it)
+      else:
+        self.removed.add(it)
+        self.modified.discard(it)
+    self.modified |= other.modified - self.added
 
 
 class TileScene(QtWidgets.QGraphicsScene):
@@ -9,11 +114,16 @@ class TileScene(QtWidgets.QGraphicsScene):
   RENDER_PLAIN = 0
   RENDER_OUTLINE = 1
 
+  SNAP_POINTS = 0   # snap any vertex (snap point) to any other
+  SNAP_CORNERS = 1  # snap only corners that fit into the gap left at a vertex
+  SNAP_EDGES = 2    # turn and slide an edge to lie flush along another
+
   # A tile magnetically snapped - app might want to make a clicking sound
   snapped = QtCore.pyqtSignal()
 
   # One or more tiles permanantly changed their shape, transformation, color, existence, etc.
-  tileChanged = QtCore.pyqtSignal()
+  # Carries a TileChange.  Changes made during a batch() are emitted together at its end.
+  tileChanged = QtCore.pyqtSignal(object)
 
   def __init__(self, logger, sceneRect=None, parent=None):
     self._log = logger
@@ -29,80 +139,313 @@ class TileScene(QtWidgets.QGraphicsScene):
     #bSetExisting = self.setProperty("snapToTilesEnabled", True)
     #self._log.debug('bSetExisting = {}', bSetExisting)
     self.snapDist = .25
+    self.dragFrameRate = 60  # maximum drag updates per second; extra mouse moves are merged
+    self.snapMode = self.SNAP_POINTS
+    self._snapGrid = tilesnap.SnapGrid(self.snapDist)      # snap points of unselected tiles, for SNAP_POINTS
+    self._cornerGrid = tilesnap.CornerGrid(self.snapDist)  # their vertices, for SNAP_CORNERS
+    self._edgeGrid = tilesnap.EdgeGrid()                   # their edges, for SNAP_EDGES
     self.renderMode = self.RENDER_PLAIN
     self.borderColor = QtGui.QColor(0,0,0)
+    self._backgroundGuide = None  # drawn by drawBackground(), not an item
+    self._tileStore = None        # tiles of a lazily loaded document, also drawn by drawBackground()
+    self._batchDepth = 0          # nesting level of batch()
+    self._batchChange = None      # TileChange accumulated during a batch()
+    # The scene rect tracks the tiles' extent: grown right away, shrunk after a pause.
+    self._extent = SceneExtent()
+    self._extentTimer = QtCore.QTimer(self)
+    self._extentTimer.setSingleShot(True)
+    self._extentTimer.timeout.connect(self.syncSceneRect)
+    self._shrinkTimer = QtCore.QTimer(self)
+    self._shrinkTimer.setSingleShot(True)
+    self._shrinkTimer.setInterval(500)
+    self._shrinkTimer.timeout.connect(self.recalcSceneRect)
     self.selectionGroup = tileselection.SelectionGroup(logger)
     self.addItem(self.selectionGroup)
     self.selectionGroup.setZValue(1) # everything else defaults to 0
     self.selectionGroup.setSelected(True)
-    self.changed.connect(self.recalcSceneRect)
+    self.undoStack = tileundo.UndoStack(self)
     self.marchingAntsOffset = 0
     #self.startTimer(500)
 
   @QtCore.pyqtSlot()
   def recalcSceneRect(self):
     # Force sceneRect to shrink, as well as grow.
-    self.setSceneRect(self.itemsBoundingRect())
+    self._shrinkTimer.stop()
+    self._extent.sync(self._tracksExtent)
+    self._extent.recompute()
+    self.applySceneRect()
+
+  @QtCore.pyqtSlot()
+  def syncSceneRect(self):
+    'Grow the sceneRect to include moved items; schedule shrinking it if needed.'
+    if self._extent.sync(self._tracksExtent):
+      self.applySceneRect()
+    if self._extent.isStale():
+      self._shrinkTimer.start()  # (re)start, so this waits for things to settle
+
+  def applySceneRect(self):
+    r = self._extent.bounds()
+    if not self._backgroundGuide is None:
+      r |= self._backgroundGuide.boundingRect()
+    if not self._tileStore is None:
+      r |= self._tileStore.bounds()
+    if r != self.sceneRect():
+      self.setSceneRect(r)
+
+  def _tracksExtent(self, item):
+    # Selected tiles are covered by the selectionGroup's extent.
+    return ( item.scene() is self and item.parentItem() is None
+             and (item is self.selectionGroup or hasattr(item, 'sceneSnapPoints')) )
+
+  def markExtentDirty(self, item):
+    'Note that item (and so its parent) may have moved, been added, or been removed.'
+    self._extent.markDirty(item)
+    parent = item.parentItem()
+    if not parent is None:
+      self._extent.markDirty(parent)
+    if not self._batchDepth and not self._extentTimer.isActive():
+      self._extentTimer.start(0)
+
+  def backgroundGuide(self):
+    return self._backgroundGuide
+
+  def setBackgroundGuide(self, guide):
+    'Set an object with boundingRect() and paint(painter, rect) to draw behind all items.'
+    self._backgroundGuide = guide
+    self.recalcSceneRect()
+    self.invalidate(QtCore.QRectF(), QtWidgets.QGraphicsScene.BackgroundLayer)
+
+  PROMOTE_LIMIT = 5000  # most stored tiles to turn into items for a view, at once
+
+  def tileStore(self):
+    return self._tileStore
+
+  def setTileStore(self, store):
+    '''Set a tilestore.TileStore whose tiles are drawn by drawBackground(),
+       and turned into items only as they're viewed or selected.
+       Any previous store is closed; its unpromoted tiles are gone.'''
+    if not self._tileStore is None:
+      self._tileStore.close()
+    self._tileStore = store
+    self.recalcSceneRect()
+    self.invalidate(QtCore.QRectF(), QtWidgets.QGraphicsScene.BackgroundLayer)
+
+  def promoteStoredTiles(self, rect=None, limit=None):
+    '''Turn the stored tiles within rect (all of them if rect is None) into items.
+       Do nothing and return False if there are more than limit of them.'''
+    store = self._tileStore
+    if store is None:
+      return True
+    idx = store.allIndices() if rect is None else store.indicesIn(rect)
+    if not limit is None and len(idx) > limit:
+      return False
+    if len(idx):
+      with self.batch(suspendIndex=len(idx) > 1000):
+        for i in idx.tolist():
+          self.addItem(store.promote(i), suppressChange=True)
+      self.invalidate(QtCore.QRectF(), QtWidgets.QGraphicsScene.BackgroundLayer)
+    return True
+
+  def syncStoredTiles(self, visibleRect):
+    '''Promote the stored tiles in and around visibleRect (if not too many),
+       and demote those well outside it that haven't been changed since.'''
+    store = self._tileStore
+    if store is None:
+      return
+    (w, h) = (visibleRect.width(), visibleRect.height())
+    far = visibleRect + QtCore.QMarginsF(w, h, w, h)
+    with self.batch():
+      demoted = 0
+      for (i, it) in store.promotedItems():
+        if not it.scene() is self:
+          store.forget(i)  # deleted
+        elif ( not far.intersects(it.sceneBoundingRect()) and store.isUnchanged(i, it)
+               and not self.undoStack.isTracked(it) ):
+          self.removeItem(it)
+          store.demote(i)
+          demoted += 1
+      if demoted:
+        self.invalidate(QtCore.QRectF(), QtWidgets.QGraphicsScene.BackgroundLayer)
+      self.promoteStoredTiles(visibleRect + QtCore.QMarginsF(w/2, h/2, w/2, h/2), self.PROMOTE_LIMIT)
+
+  @contextlib.contextmanager
+  def batch(self, suspendIndex=False):
+    '''A context for making many changes at once:
+         with scene.batch():
+           for it in items: scene.addItem(it)
+       tileChanged is emitted just once, at the end of the outermost batch,
+       with all the changes, and the sceneRect is updated just once.
+       With suspendIndex, the scene's BSP index is also turned off and
+       rebuilt afterward, which is faster when adding or moving very many items.
+    '''
+    self._batchDepth += 1
+    if self._batchDepth == 1:
+      self._batchChange = TileChange()
+    indexMethod = self.itemIndexMethod()
+    if suspendIndex and indexMethod != QtWidgets.QGraphicsScene.NoIndex:
+      self.setItemIndexMethod(QtWidgets.QGraphicsScene.NoIndex)
+    try:
+      yield self._batchChange
+    finally:
+      if self.itemIndexMethod() != indexMethod:
+        self.setItemIndexMethod(indexMethod)
+      self._batchDepth -= 1
+      if not self._batchDepth:
+        change = self._batchChange
+        self._batchChange = None
+        self.syncSceneRect()
+        if change:
+          self.tileChanged.emit(change)
+
+  def isBatching(self):
+    return self._batchDepth > 0
+
+  def recordChange(self, added=(), removed=(), modified=()):
+    'Emit tileChanged for these tiles, or remember them until the end of the current batch().'
+    change = TileChange(added, removed, modified)
+    if self._batchDepth:
+      self._batchChange.update(change)
+    elif change:
+      self.tileChanged.emit(change)
 
   def addItem(self, item, suppressChange=False):
     super().addItem(item)
+    self.markSnapDirty(item)
+    self.markExtentDirty(item)
     if not suppressChange:
-      self.tileChanged.emit()
+      self.recordChange(added=(item,))
+
+  def removeItem(self, item):
+    super().removeItem(item)
+    self.markSnapDirty(item)
+    self.markExtentDirty(item)
+
+  def markSnapDirty(self, item):
+    'Note that item may have been added, removed, (de)selected, or moved, so must be re-indexed for snapping.'
+    if hasattr(item, 'sceneSnapPoints'):
+      self._activeSnapGrid().markDirty(item)
+
+  def _isSnapTarget(self, item):
+    return item.scene() is self and not item.isSelected()
+
+  def _activeSnapGrid(self):
+    if self.snapMode == self.SNAP_CORNERS:
+      return self._cornerGrid
+    if self.snapMode == self.SNAP_EDGES:
+      return self._edgeGrid
+    return self._snapGrid
+
+  def setSnapMode(self, mode):
+    'Change snapMode, indexing the tiles afresh for it (only the grid in use is kept up to date).'
+    if mode == self.snapMode:
+      return
+    self._activeSnapGrid().clear()
+    self.snapMode = mode
+    for it in self.items():
+      self.markSnapDirty(it)
+
+  def snapGrid(self):
+    'Return the up-to-date SnapGrid of unselected tile snap points.'
+    if self._snapGrid.cellSize() != self.snapDist:
+      self._snapGrid.setCellSize(self.snapDist)
+    self._snapGrid.sync(self._isSnapTarget)
+    return self._snapGrid
+
+  def cornerGrid(self):
+    'Return the up-to-date CornerGrid of unselected tile vertices.'
+    if self._cornerGrid.cellSize() != self.snapDist:
+      self._cornerGrid.setCellSize(self.snapDist)
+    self._cornerGrid.sync(self._isSnapTarget)
+    return self._cornerGrid
+
+  def edgeGrid(self):
+    '''Return the up-to-date EdgeGrid of unselected tile edges.
+       Its cells are kept about as big as a typical edge (but no smaller
+       than snapDist), re-binning only when that is off by more than double.'''
+    grid = self._edgeGrid
+    grid.sync(self._isSnapTarget)
+    cellSize = max(self.snapDist, grid.meanLength())
+    if not .5 <= cellSize / grid.cellSize() <= 2:
+      grid.setCellSize(cellSize)
+    return grid
 
   def keepItem(self, item):
-    assert item.scene() == self
-    # Sometimes items disappear from the scene even though they're in the scene!
-    self.removeItem(item)
-    # Calling this without the above removeItem() generates a complaint,
-    # but not calling it leaves the item disappeared.
-    self.addItem(item, suppressChange=True)
+    '''Give ownership of item, just taken out of the selectionGroup, back to the scene.
+       (Otherwise PyQt deletes it, and it disappears from the scene, when
+       Python no longer refers to it.)  This is what addItem() would do,
+       without removing and re-indexing it.'''
+    assert item.scene() is self
+    sip.transferto(item, self)
 
-  @QtCore.pyqtSlot()
-  def clearSelection(self):
-    self._log.trace('entering')
-    for it in self.selectionGroup.childItems():
-      assert not it is self.selectionGroup
-      p0 = it.pos()
-      flags0 = it.flags()
-      self.selectionGroup.removeFromGroup(it)
-      self.removeItem(it)
-      self.addItem(it, suppressChange=True)
-      it.setSelected(False)
-      assert not it.scene() in (None,0)
-      assert it.scene() is self
-      #self._log.trace('pos: {} -> {}', p0, it.pos())
-      if flags0 != it.flags():
-        self._log.trace('flags: {} -> {}', flags0, it.flags())
+  def isSelectable(self, item):
+    return ( not item is self.selectionGroup and item.isEnabled()
+             and bool(item.flags() & QtWidgets.QGraphicsItem.ItemIsSelectable) )
+
+  def selectItems(self, items):
+    'Add the (selectable) items to the selection, all at once.'
+    self.selectionGroup.addTiles([ it for it in items if self.isSelectable(it) ])
+    self.checkSelection()
+
+  def deselectItems(self, items):
+    'Remove the items from the selection, all at once.'
+    self.selectionGroup.removeTiles(items)
+    self.checkSelection()
+
+  def checkSelection(self):
+    '''When debugging, check that every selected item is in the selectionGroup.
+       This scans the whole scene, so is skipped otherwise.'''
+    if not self._log.isEnabledFor('debug'):
+      return
+    group = self.selectionGroup
     for it in self.items():
-      if not it is self.selectionGroup and it.isSelected():
+      if not it is group and it.isSelected() != (it.group() is group):
         self._log.warning('found selected item not in selectionGroup')
         it.setSelected(False)
+
+  @QtCore.pyqtSlot()
+  def clearSelection(self):
+    self._log.trace('entering')
+    self.deselectItems(self.selectionGroup.childItems())
     self._log.trace('returning')
 
   @QtCore.pyqtSlot()
   def removeSelection(self):
     'Remove all selected items from scene'
-    changed = False
-    for it in self.selectionGroup.childItems():
-      assert not it is self.selectionGroup
-      self.selectionGroup.removeFromGroup(it)
-      self.removeItem(it)
-      changed = True
-    for it in self.selectedItems():
-      if not it is self.selectionGroup:
-        self._log.warning('found selected item not in selectionGroup')
+    group = self.selectionGroup
+    with self.batch():
+      removed = group.childItems()
+      # Deselect them first, keeping their transformations (for undo).
+      group.removeTiles(removed)
+      for it in self.selectedItems():
+        if not it is group:
+          self._log.warning('found selected item not in selectionGroup')
+          removed.append(it)
+      for it in removed:
         self.removeItem(it)
-        changed = True
-    if changed:
-      self.selectionGroup.cancelDrag()
-      self.tileChanged.emit()
+      if removed:
+        group.cancelDrag()
+        self.recordChange(removed=removed)
 
   @QtCore.pyqtSlot()
   def setSelectionAll(self):
-    for it in self.items():
-      if it.isEnabled() and it.flags() & QtWidgets.QGraphicsItem.ItemIsSelectable and not it is self.selectionGroup:
-        it.setSelected(True)
-        self.selectionGroup.addToGroup(it)
+    '''Select every item.  Stored tiles are turned into items to select them,
+       unless there are more than PROMOTE_LIMIT; then only the items are
+       selected, and False is returned.'''
+    complete = self.promoteStoredTiles(limit=self.PROMOTE_LIMIT)
+    self.selectItems(self.items())
+    return complete
+
+  @QtCore.pyqtSlot()
+  def invertSelection(self):
+    '''Select every unselected item, and deselect every selected one.
+       Stored tiles are promoted to be selected as by setSelectionAll().'''
+    complete = self.promoteStoredTiles(limit=self.PROMOTE_LIMIT)
+    group = self.selectionGroup
+    with self.batch():
+      unselected = [ it for it in self.items() if it.group() is None and self.isSelectable(it) ]
+      self.deselectItems(group.childItems())
+      self.selectItems(unselected)
+    return complete
 
   def numSelected(self):
     return len(self.selectionGroup.childItems())
@@ -123,8 +466,19 @@ class TileScene(QtWidgets.QGraphicsScene):
     if c.isValid() and c != self.borderColor:
       self.borderColor = c
 
+  def tilePen(self):
+    'Return the pen that tiles outline themselves with.'
+    if self.renderMode == self.RENDER_OUTLINE:
+      return QtGui.QPen(BlackOrWhiteCompliment(self.backgroundBrush().color()), 0)
+    else:
+      return QtGui.QPen(self.borderColor, 0)
+
   def drawBackground(self, painter, rect):
     super().drawBackground(painter, rect)
+    if not self._backgroundGuide is None:
+      self._backgroundGuide.paint(painter, rect)
+    if not self._tileStore is None:
+      self._tileStore.paint(painter, rect, self.tilePen(), self.renderMode != self.RENDER_OUTLINE)
     if self._log.isEnabledFor('debug'):
       self.paintSceneRect(painter)
 
@@ -3,6 +3,8 @@
 import os, math, random, unittest
 from PyQt5 import QtCore, QtGui, QtWidgets
 from q2str import *
+import tilesnap
+from framepacer import FramePacer
 
 # TODO:
 #   Fix so that multiple types of transformation can happen
@@ -100,6 +102,9 @@ DRAG_XLATE  = 1
 DRAG_ROTATE = 2
 DRAG_SCALE  = 3
 
+# Undo/redo names of the drag types
+drag_names = { DRAG_XLATE: 'Move', DRAG_ROTATE: 'Rotate', DRAG_SCALE: 'Scale' }
+
 def mapDragButton(button):
   'Return the drag mode corresponding to the given mouse button.'
   if   button == QtCore.Qt.LeftButton  : return DRAG_XLATE
@@ -132,6 +137,125 @@ def _snapKey(s):
   'Return the sort key for the given snap tuple.'
   return ( s[1].x(),s[1].y(), s[2].x(),s[2].y() )
 
+class ChildIndex(object):
+  '''A uniform grid of the bounding rects of the children of an item (in its
+     coordinates), so that a hit test need only try the few children whose
+     bounds it touches.  Children spanning more than maxCells cells are kept
+     aside and always tried.
+     Like SnapGrid, children are (re)indexed lazily: callers markDirty() a
+     child whenever it is added or removed, and sync() before querying.
+  '''
+
+  def __init__(self, cellSize=2.0, maxCells=64):
+    self._invCellSize = 1.0 / cellSize
+    self._maxCells = maxCells
+    self._cells = {}       # (i,j) -> list of children
+    self._entries = {}     # child -> (order, (x0, y0, x1, y1), cell keys or None if large)
+    self._large = set()
+    self._dirty = {}       # children to (re)index, in the order they were marked
+    self._order = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _span(self, x0, y0, x1, y1):
+    s = self._invCellSize
+    return (math.floor(x0 * s), math.floor(y0 * s), math.floor(x1 * s), math.floor(y1 * s))
+
+  def insert(self, child, rect):
+    'Index child, whose bounding rect is the QRectF rect.'
+    self.remove(child)
+    box = (rect.left(), rect.top(), rect.right(), rect.bottom())
+    (i0, j0, i1, j1) = self._span(*box)
+    if (i1 - i0 + 1) * (j1 - j0 + 1) > self._maxCells:
+      keys = None
+      self._large.add(child)
+    else:
+      keys = [ (i, j) for i in range(i0, i1+1) for j in range(j0, j1+1) ]
+      cells = self._cells
+      for k in keys:
+        c = cells.get(k)
+        if c is None:
+          cells[k] = c = []
+        c.append(child)
+    self._entries[child] = (self._order, box, keys)
+    self._order += 1
+
+  def remove(self, child):
+    e = self._entries.pop(child, None)
+    if e is None: return
+    keys = e[2]
+    if keys is None:
+      self._large.discard(child)
+      return
+    cells = self._cells
+    for k in keys:
+      c = cells[k]
+      c.remove(child)
+      if not c:
+        del cells[k]
+
+  def markDirty(self, child):
+    'Note that child has been added or removed.'
+    self._dirty.pop(child, None)  # keep the order of the latest change
+    self._dirty[child] = None
+
+  def sync(self, rectOf):
+    '''(Re)index every dirty child.
+       rectOf(child) returns its bounding rect, or None if it no longer belongs in the index.
+    '''
+    if not self._dirty: return
+    dirty = self._dirty
+    self._dirty = {}
+    for child in dirty:
+      r = rectOf(child)
+      if r is None:
+        self.remove(child)
+      else:
+        self.insert(child, r)
+
+  def query(self, rect):
+    '''Return the children whose bounding rects intersect the QRectF rect,
+       most recently indexed (topmost) first.'''
+    (x0, y0, x1, y1) = (rect.left(), rect.top(), rect.right(), rect.bottom())
+    (i0, j0, i1, j1) = self._span(x0, y0, x1, y1)
+    if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+      candidates = self._entries.keys()
+    else:
+      candidates = set(self._large)
+      cells = self._cells
+      for i in range(i0, i1+1):
+        for j in range(j0, j1+1):
+          c = cells.get((i, j))
+          if c:
+            candidates.update(c)
+    entries = self._entries
+    found = []
+    for child in candidates:
+      (order, (a0, b0, a1, b1), _keys) = entries[child]
+      if a0 <= x1 and x0 <= a1 and b0 <= y1 and y0 <= b1:
+        found.append((order, child))
+    found.sort(key=lambda e: e[0], reverse=True)
+    return [ child for (_order, child) in found ]
+
+class TestChildIndex(unittest.TestCase):
+  def test_ChildIndex(self):
+    rects = { 'a': QtCore.QRectF(0, 0, 1, 1), 'b': QtCore.QRectF(.5, .5, 1, 1)
+            , 'c': QtCore.QRectF(10, 10, 1, 1), 'big': QtCore.QRectF(-100, -100, 200, 200) }
+    index = ChildIndex(cellSize=2.0, maxCells=16)
+    for k in ('a', 'b', 'c', 'big'):
+      index.markDirty(k)
+    index.sync(rects.get)
+    self.assertEqual(len(index), 4)
+    self.assertEqual(index.query(QtCore.QRectF(.75, .75, 0, 0)), ['big', 'b', 'a'])
+    self.assertEqual(index.query(QtCore.QRectF(5, 5, 1, 1)), ['big'])
+    self.assertEqual(index.query(QtCore.QRectF(-1e3, -1e3, 2e3, 2e3)), ['big', 'c', 'b', 'a'])
+    del rects['b']
+    index.markDirty('b')
+    index.markDirty('a')  # re-added: now the topmost
+    index.sync(rects.get)
+    self.assertEqual(index.query(QtCore.QRectF(.75, .75, 0, 0)), ['a', 'big'])
+
 class SelectionGroup(QtWidgets.QGraphicsItemGroup):
   '''A selection of TileItems that is being transformed.
     In this application, all selected Tiles are added to this SelectionGroup,
@@ -140,7 +264,11 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
   '''
 
   def __init__(self, logger, parent=None):
-    self._shape = None  # a cached QPainterPath that is the union of all selected Tiles, for collision/hit-testing
+    self._shape = None  # a cached QPainterPath that is the union of all selected Tiles, built only when asked for
+    self._childIndex = None  # a ChildIndex of the selected Tiles, for hit testing
+    self._corners = None     # cached (snap distance, corners of the selected Tiles in Item coordinates)
+    self._edges = None       # cached outline edges of the selected Tiles in Item coordinates
+    self._bulkChange = False  # adding/removing many Tiles, so don't flush the shape for each one
     self._log = logger
     super().__init__(parent=parent)
     self.setFlags( self.flags()
@@ -150,6 +278,8 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
                  | QtWidgets.QGraphicsItem.ItemSendsGeometryChanges
                  )
     self._drag_timer = QtCore.QElapsedTimer()
+    # Mouse moves only record the latest position; the drag is updated once per frame.
+    self._drag_pacer = FramePacer(self.updateDragTo)
     self._nearSnapsDebug = None
     self.initDragXform()
 
@@ -204,29 +334,34 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
              , options=QtWidgets.QColorDialog.ShowAlphaChannel )
         #|QtWidgets.QColorDialog.DontUseNativeDialog)
       if c2.isValid() and (c2 != c or heterogeneous):
-        for it in self.childItems():
-          it.setColor(c2)
-        self.scene().tileChanged.emit()
+        with self.scene().undoStack.record('Color', self.childItems(), transforms=False, colors=True):
+          for it in self.childItems():
+            it.setColor(c2)
+          self.scene().recordChange(modified=self.childItems())
 
   def randomize_hsva(self, hue_randomness, sat_randomness, val_randomness, alpha_randomness):
-    for it in self.childItems():
-      c = it.color()
-      h,s,v,a = c.hue(), c.saturation(), c.value(), c.alpha()
-      h = random.randrange(h-hue_randomness, h+hue_randomness+1) % 360
-      s = random.randrange( max(0, s-sat_randomness), min(s+sat_randomness+1, 256) )
-      v = random.randrange( max(0, v-val_randomness), min(v+val_randomness+1, 256) )
-      a = random.randrange( max(0, a-alpha_randomness), min(a+alpha_randomness+1, 256) )
-      it.setColor(QtGui.QColor.fromHsv(h,s,v,a))
+    with self.scene().undoStack.record('Randomize Colors', self.childItems(), transforms=False, colors=True):
+      for it in self.childItems():
+        c = it.color()
+        h,s,v,a = c.hue(), c.saturation(), c.value(), c.alpha()
+        h = random.randrange(h-hue_randomness, h+hue_randomness+1) % 360
+        s = random.randrange( max(0, s-sat_randomness), min(s+sat_randomness+1, 256) )
+        v = random.randrange( max(0, v-val_randomness), min(v+val_randomness+1, 256) )
+        a = random.randrange( max(0, a-alpha_randomness), min(a+alpha_randomness+1, 256) )
+        it.setColor(QtGui.QColor.fromHsv(h,s,v,a))
+      self.scene().recordChange(modified=self.childItems())
 
   def randomize_rgba(self, r_randomness, g_randomness, b_randomness, alpha_randomness):
-    for it in self.childItems():
-      c = it.color()
-      r,g,b,a = c.red(), c.green(), c.blue(), c.alpha()
-      r = random.randrange( max(0, r-r_randomness), min(r+r_randomness+1, 256) )
-      g = random.randrange( max(0, g-g_randomness), min(g+g_randomness+1, 256) )
-      b = random.randrange( max(0, b-b_randomness), min(b+b_randomness+1, 256) )
-      a = random.randrange( max(0, a-alpha_randomness), min(a+alpha_randomness+1, 256) )
-      it.setColor(QtGui.QColor.fromRgb(r,g,b,a))
+    with self.scene().undoStack.record('Randomize Colors', self.childItems(), transforms=False, colors=True):
+      for it in self.childItems():
+        c = it.color()
+        r,g,b,a = c.red(), c.green(), c.blue(), c.alpha()
+        r = random.randrange( max(0, r-r_randomness), min(r+r_randomness+1, 256) )
+        g = random.randrange( max(0, g-g_randomness), min(g+g_randomness+1, 256) )
+        b = random.randrange( max(0, b-b_randomness), min(b+b_randomness+1, 256) )
+        a = random.randrange( max(0, a-alpha_randomness), min(a+alpha_randomness+1, 256) )
+        it.setColor(QtGui.QColor.fromRgb(r,g,b,a))
+      self.scene().recordChange(modified=self.childItems())
 
   def autoscale(self):
     'Scale the selection so as to make at least some lines unit length.'
@@ -253,7 +388,10 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
       self.applyDragXforms()
 
   def shape(self):
-    'Return a QPainterPath (in Item coordinates) for collision/hit testing.'
+    '''Return a QPainterPath (in Item coordinates): the union of all selected Tiles.
+       Hit testing doesn't need this (see contains() and collidesWithPath()),
+       so it is only built when something really asks for it.
+    '''
     if self._shape is None:
       self._shape = QtGui.QPainterPath()
       i = 0
@@ -265,9 +403,97 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
     return QtGui.QPainterPath(self._shape)
 
   def flushShape(self):
-    'A Tile is being added or removed, so forget the cached shape union.'
+    'The selected Tiles have been transformed, so forget the cached shape union and child index.'
     self.prepareGeometryChange()
     self._shape = None
+    self._childIndex = None
+    self._corners = None
+    self._edges = None
+
+  def childIndex(self):
+    'Return the ChildIndex of the selected Tiles, up to date.'
+    if self._childIndex is None:
+      self._childIndex = ChildIndex()
+      for it in self.childItems():
+        self._childIndex.markDirty(it)
+    self._childIndex.sync(lambda it: self.mapRectFromItem(it, it.boundingRect())
+                                       if it.parentItem() is self else None)
+    return self._childIndex
+
+  def childrenAt(self, rect):
+    'Return the selected Tiles whose bounding rects intersect rect (in Item coordinates), topmost first.'
+    return self.childIndex().query(rect)
+
+  def childAt(self, point):
+    'Return the topmost selected Tile containing point (in Item coordinates), or None.'
+    for it in self.childrenAt(QtCore.QRectF(point, point)):
+      if it.contains(self.mapToItem(it, point)):
+        return it
+    return None
+
+  def contains(self, point):
+    return not self.childAt(point) is None
+
+  def collidesWithPath(self, path, mode=QtCore.Qt.IntersectsItemShape):
+    '''Return whether path (in Item coordinates) collides with the selected Tiles,
+       asking only those whose bounds it touches (or, to contain them, all of them).'''
+    if mode in (QtCore.Qt.ContainsItemShape, QtCore.Qt.ContainsItemBoundingRect):
+      children = self.childItems()
+      return bool(children) and all(it.collidesWithPath(self.mapToItem(it, path), mode) for it in children)
+    return any( it.collidesWithPath(self.mapToItem(it, path), mode)
+                for it in self.childrenAt(path.controlPointRect()) )
+
+  def addTiles(self, tiles):
+    '''Select many (unselected) Tiles at once.
+       Equivalent to calling setSelected(True) on each, but much cheaper.
+    '''
+    tiles = [it for it in tiles if it.group() is None]
+    if not tiles: return
+    self._bulkChange = True
+    try:
+      with self.scene().batch():
+        for it in tiles:
+          QtWidgets.QGraphicsItem.setSelected(it, True)
+          self.addToGroup(it)
+    finally:
+      self._bulkChange = False
+    self.prepareGeometryChange()
+
+  def removeTiles(self, tiles):
+    '''Deselect many Tiles in this group at once.
+       Equivalent to calling setSelected(False) on each, but much cheaper.
+    '''
+    tiles = [it for it in tiles if it.group() is self]
+    if not tiles: return
+    scene = self.scene()
+    self._bulkChange = True
+    try:
+      with scene.batch():
+        for it in tiles:
+          # Same as removeFromGroup(), which would recalculate the
+          # childrenBoundingRect() of the whole group for each Tile.
+          xform = it.sceneTransform()
+          pos = it.scenePos()
+          it.setParentItem(None)
+          it.setPos(pos)
+          it.setTransform(xform * QtGui.QTransform.fromTranslate(-pos.x(), -pos.y()))
+          QtWidgets.QGraphicsItem.setSelected(it, False)
+          scene.keepItem(it)
+        self.refreshBoundingRect()
+    finally:
+      self._bulkChange = False
+    if not self.childItems():
+      self.resetTransforms()
+    else:
+      self.prepareGeometryChange()
+
+  def refreshBoundingRect(self):
+    '''QGraphicsItemGroup caches its bounding rect, only growing it in addToGroup()
+       and recalculating it in removeFromGroup(), so remove and re-add a child.'''
+    children = self.childItems()
+    if children:
+      self.removeFromGroup(children[-1])
+      self.addToGroup(children[-1])
 
   def resetTransforms(self):
     '''Reset the transformations of this SelectionGroup.
@@ -285,13 +511,21 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
        This effectively propagates the group transforms to each child.
        Used to apply/finalize a drag transformation.
     '''
+    # Rather than removeFromGroup() and addToGroup() each child, which
+    # reparents it twice and recalculates the group's bounding rect each
+    # time, multiply the group transform into each child's own QTransform,
+    # leaving its pos alone:  transform' * T(pos) = transform * T(pos) * G
+    g = self.transform() * QtGui.QTransform.fromTranslate(self.pos().x(), self.pos().y())
+    if g.isIdentity():
+      return
     self.prepareGeometryChange()
-    children = self.childItems()
-    for it in children:
-      self.removeFromGroup(it)
-    self.resetTransforms()
-    for it in children:
-      self.addToGroup(it)
+    with self.scene().batch():
+      for it in self.childItems():
+        p = it.pos()
+        (x, y) = (p.x(), p.y())
+        it.setTransform(it.transform() * QtGui.QTransform(1, 0, 0, 1, x, y) * g * QtGui.QTransform(1, 0, 0, 1, -x, -y))
+      self.resetTransforms()
+      self.refreshBoundingRect()
 
   #def snapShape(self):
   #  "Return QPainterPath (in Item coordinates) for snapping"
@@ -307,111 +541,120 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
       self.cancelDrag()
     self.prepareGeometryChange()
     self._log.trace('{} children', len(self.childItems()))
-    for it in self.childItems():
-      it.resetTransform()
-      it.setPos(0,0)
-      self.removeFromGroup(it)
-      self.addToGroup(it)
-    self.resetTransforms()
-    self._log.trace('emitting tileChanged')
-    self.scene().tileChanged.emit()
+    with self.scene().undoStack.record('Reset Shapes', self.childItems()):
+      for it in self.childItems():
+        it.resetTransform()
+        it.setPos(0,0)
+        self.removeFromGroup(it)
+        self.addToGroup(it)
+      self.resetTransforms()
+      self._log.trace('emitting tileChanged')
+      self.scene().recordChange(modified=self.childItems())
+
+  def commitKbdXform(self, name, coalesce=None):
+    'Finish a keyboard transformation, unless it is part of a drag.'
+    if self._drag_type is DRAG_NONE:
+      # The children haven't moved, only this group, until normalized.
+      with self.scene().undoStack.record(name, self.childItems(), coalesce=coalesce):
+        self.normalizeTransforms()
+      self.initDragXform()
+      self.scene().recordChange(modified=self.childItems())
 
   def rotateBy(self, deg):
     self._kbd_rotate -= deg
     self.applyDragXforms()
-    if self._drag_type is DRAG_NONE:
-      self.normalizeTransforms()
-      self.initDragXform()
+    self.commitKbdXform('Rotate', 'rotate')
 
   def scaleBy(self, factor):
     self._kbd_scale *= factor
     self.applyDragXforms()
-    if self._drag_type is DRAG_NONE:
-      self.normalizeTransforms()
-      self.initDragXform()
+    self.commitKbdXform('Scale', 'scale')
 
   def mirror(self):
     'Flip this selection horizontally about the center.'
     self._drag_mirror = -self._drag_mirror
     self.applyDragXforms()
-    if self._drag_type is DRAG_NONE:
-      self.normalizeTransforms()
-      self.initDragXform()
-    self.scene().tileChanged.emit()
+    self.commitKbdXform('Mirror')
 
   def nearestSnaps(self, snap_dist, excludePt=None):
     '''Return a list of (equally) closest snap-tuples, in scene coordinates.
        Parameters are in scene coordinates.
        Returned tuples are (distance squared, QPointF p from self, QPointF q from other)
     '''
-    # This never seems to take more than a couple dozen ms, but nevertheless
-    # performance is very sluggish, because Qt5 sends all mouse events
-    # without compression no matter how long it takes to respond.
-
+    # Each child snap point is only compared with the unselected snap points
+    # in the surrounding 3x3 cells of the scene's SnapGrid, so the cost depends
+    # on the number of selected points, not on how many tiles are nearby.
+    # Large selections are searched with NumPy, if available.
+    # When snapping only corners that fit, each is only compared with the
+    # vertices whose gap it fits into, which excludes those already
+    # surrounded by tiles.
+
+    scene = self.scene()
+    corners = scene.snapMode == scene.SNAP_CORNERS
+    grid = scene.cornerGrid() if corners else scene.snapGrid()
+    if not len(grid):
+      return []
     search_timer = QtCore.QElapsedTimer()
     search_timer.start()
-    snap_margins = QtCore.QMarginsF(snap_dist*1.001,snap_dist*1.001,snap_dist*1.001,snap_dist*1.001)
-    nearest_dist2 = snap_dist ** 2         # Use squared distances to avoid calling sqrt
-    nearest = []  # list of nearby pairs of points
-
-    # Before looping through all child items, first check if any snapping is possible at all.
-    snap_search_rect = self.sceneBoundingRect().marginsAdded(snap_margins)
-    nearby_items = self.scene().items(snap_search_rect)
-    nearby_tiles = [it for it in nearby_items if not it.isSelected() and hasattr(it, "sceneSnapPoints")]
-    if not nearby_tiles:
+    exclude = None if excludePt is None else (excludePt.x(), excludePt.y())
+    if corners:
+      ps = self.snapCorners(snap_dist)
+      pairs = tilesnap.NearestCornerPairs(grid, ps, snap_dist, exclude, search_timer)
+    else:
+      ps = tilesnap.GatherPoints(child.sceneSnapPoints() for child in self.childItems())
+      pairs = tilesnap.NearestSnapPairs(grid, ps, snap_dist, exclude, search_timer)
+    if search_timer.hasExpired(tilesnap.SEARCH_TIMEOUT_MS):
+      self._log.info('aborting slow search: {} ms', search_timer.elapsed())
       return []
-
-    # It's distinctly faster to let QGraphicsScene compare each child tile with
-    # other tiles than to ask it to compare all child points with other tiles,
-    # though this still ends up O(n*n) when dragging many tiles over many tiles.
-    for child in self.childItems():
-      snap_search_rect = child.sceneBoundingRect().marginsAdded(snap_margins)
-      nearby_items = self.scene().items(snap_search_rect)
-      nearby_tiles = [it for it in nearby_items if not it.isSelected() and hasattr(it, "sceneSnapPoints")]
-      if nearby_tiles:
-        self._log.trace('{} nearby tiles', len(nearby_tiles))
-        for other_tile in nearby_tiles:
-          for p in child.sceneSnapPoints():
-            assert isinstance(p, QtCore.QPointF)
-            if excludePt is None or QtCore.QLineF(p, excludePt).length() > snap_dist/100.0:
-              for q in other_tile.sceneSnapPoints():
-                assert isinstance(q, QtCore.QPointF)
-                if excludePt is None or QtCore.QLineF(q, excludePt).length() > snap_dist/100.0:
-                  pq = q - p
-                  pq2 = pq.x()**2 + pq.y()**2
-                  if pq2 <= nearest_dist2:
-                    #assert pq.x() <= snap_dist
-                    #assert pq.x() >= -snap_dist
-                    #assert pq.y() <= snap_dist
-                    #assert pq.y() >= -snap_dist
-                    if pq2 < nearest_dist2:
-                      nearest_dist2 = pq2
-                      nearest = []
-                      # TODO: shrink snap_margins ?
-                    assert isinstance(q, QtCore.QPointF)
-                    # ** BUGFIX **
-                    # There appears to be a bug such that if I do not make a copy of q here,
-                    # it sometimes mysteriously changes by the end of the function.
-                    # Bug was seldom if ever visible under Linux, Windows, or OS 10.10
-                    # Debugged under OS X 10.14, Python 3.8.3, PyQt 5.15.2, 2021-Feb
-                    nearest.append( (pq2, QtCore.QPointF(p), QtCore.QPointF(q)) )
-                    #self._log.trace('nearest = {}', nearest)
-      if search_timer.hasExpired(250):
-        self._log.info('aborting slow search: {} ms', search_timer.elapsed())
-        return []
-
     #self._log.info('{} children searched in {} ms', len(self.childItems()), search_timer.elapsed())
-    #self._log.trace('final nearest = {}', nearest)
-    #for pq2,p,q in nearest:
-    #  assert isinstance(p, QtCore.QPointF)
-    #  assert isinstance(q, QtCore.QPointF)
-    #  pq = q - p
-    #  assert pq.x() <= snap_dist
-    #  assert pq.x() >= -snap_dist
-    #  assert pq.y() <= snap_dist
-    #  assert pq.y() >= -snap_dist
-
-    return nearest
+    return [ (pq2, QtCore.QPointF(*p), QtCore.QPointF(*q)) for (pq2, p, q) in pairs ]
+
+  def snapCorners(self, snap_dist):
+    '''Return the corners of the selected Tiles (see tilesnap.GatherCorners()), in scene coordinates.
+       While dragging, only this group's transform changes, so they are
+       gathered once in Item coordinates, then just mapped.
+    '''
+    t = self.sceneTransform()
+    if not tilesnap.SimilarityScale(t):
+      return tilesnap.GatherCorners((child.sceneCorners() for child in self.childItems()), snap_dist)
+    if self._corners is None or self._corners[0] != snap_dist:
+      corners = tilesnap.GatherCorners((child.sceneCorners() for child in self.childItems()), snap_dist)
+      self._corners = (snap_dist, tilesnap.MapCorners(corners, t.inverted()[0]))
+    return tilesnap.MapCorners(self._corners[1], t)
+
+  def snapEdges(self):
+    '''Return the outline edges of the selected Tiles (see tilesnap.GatherEdges()), in scene coordinates.
+       Like snapCorners(), they are gathered once in Item coordinates, then just mapped.
+    '''
+    t = self.sceneTransform()
+    if self._edges is None:
+      edges = tilesnap.GatherEdges(child.sceneEdges() for child in self.childItems())
+      self._edges = tilesnap.MapEdges(edges, t.inverted()[0])
+    return tilesnap.MapEdges(self._edges, t)
+
+  def snapToEdges(self, originPt=None):
+    '''Turn (about originPt, if given) and move such that an edge of this
+       selection lies flush along the nearest unselected Tile edge (if its
+       ends are within snapDist of it), with the nearest ends lined up if
+       they are that close too.  Return True if snapped.
+    '''
+    # The scene's EdgeGrid lists each open edge in the cells its bounding
+    # box touches, so only the edges near each selected one are compared.
+    scene = self.scene()
+    grid = scene.edgeGrid()
+    if not len(grid):
+      return False
+    search_timer = QtCore.QElapsedTimer()
+    search_timer.start()
+    best = tilesnap.NearestFlushEdges(grid, self.snapEdges(), scene.snapDist, search_timer)
+    if search_timer.hasExpired(tilesnap.SEARCH_TIMEOUT_MS):
+      self._log.info('aborting slow search: {} ms', search_timer.elapsed())
+      return False
+    if best is None:
+      return False
+    (_score, a, b) = best
+    self.setTransform(self.transform() * tilesnap.FlushTransform(a, b, scene.snapDist, originPt))
+    return True
 
   def snapByXlation(self, originPt, p, q):
     '''Translate such that p aligns with q.'''
@@ -483,7 +726,13 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
                  )
     self.setTransform(drag_xforms * kbd_xforms)
     if invert_snap != bool(self.scene().snapToTilesEnabled): #property("snapEnabled"):
-      if self._drag_type == DRAG_XLATE:
+      if self.scene().snapMode == self.scene().SNAP_EDGES:
+        # Lie flush along an edge, maybe.  Scaling would change its length, so isn't snapped.
+        if self._drag_type == DRAG_XLATE:
+          self.snapToEdges()
+        elif self._drag_type == DRAG_ROTATE:
+          self.snapToEdges(self._dragXformCenter)
+      elif self._drag_type == DRAG_XLATE:
         # Xlate a little more, maybe.  Returns snap point
         q = self.snapToTiles(self.snapByXlation, None)
         if not q is None:
@@ -497,9 +746,9 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
         self.snapToTiles(self.snapByScaling, self._dragXformCenter)
         # TODO: scale about the first snap to match a second
 
-  def isSnappingInverted(self, gsMouseEvt):
-    'Return True if the user was holding down the snap-modifier key.'
-    return bool(gsMouseEvt.modifiers() & QtCore.Qt.ControlModifier)
+  def isSnappingInverted(self, modifiers):
+    'Return True if the given keyboard modifiers include the snap-modifier key.'
+    return bool(modifiers & QtCore.Qt.ControlModifier)
 
   def startDrag(self, gsMouseEvt, drag_type):
     'Initialize and remember the beginning of a drag operation'
@@ -511,14 +760,28 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
     self._drag_type = drag_type
     self._drag_start_scenePos = gsMouseEvt.scenePos()  # Remember starting mouse position
     self._drag_start_scene_vector = QtCore.QLineF(self._dragXformCenter, self._drag_start_scenePos)
+    self._drag_pacer.setFrameRate(self.scene().dragFrameRate)
+    self._drag_pacer.resetCounters()
 
   def updateDrag(self, gsMouseEvt):
-    'Modify the current drag transformation, given a mouse movement.'
-    invert_snap = self.isSnappingInverted(gsMouseEvt)
+    '''Note a mouse movement.  The drag transformation is updated (and snapped)
+       at the next frame, using only the latest position.
+    '''
+    self._drag_pacer.post(gsMouseEvt.scenePos(), gsMouseEvt.modifiers())
+    if False:
+      mimedata = QtCore.QMimeData()
+      mimedata.setData(MIME_TYPE_SVG, dummySVG)
+      drag = QtGui.QDrag(gsMouseEvt.widget())
+      drag.setMimeData(mimedata)
+      drag.exec_()
+
+  def updateDragTo(self, scenePos, modifiers):
+    'Modify the current drag transformation, given the mouse position and keyboard modifiers.'
+    invert_snap = self.isSnappingInverted(modifiers)
     if self._drag_type == DRAG_XLATE:
-      self._drag_xlate = gsMouseEvt.scenePos() - self._drag_start_scenePos
+      self._drag_xlate = scenePos - self._drag_start_scenePos
     elif self._drag_type == DRAG_ROTATE:
-      move_vector = QtCore.QLineF(self._drag_start_scene_vector.p1(), gsMouseEvt.scenePos())
+      move_vector = QtCore.QLineF(self._drag_start_scene_vector.p1(), scenePos)
       self._drag_rotate = move_vector.angleTo(self._drag_start_scene_vector)
       if invert_snap != bool(self.scene().snapToAnglesEnabled):
         angular_resolution = 120
@@ -527,7 +790,7 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
         del q
       del move_vector
     elif self._drag_type == DRAG_SCALE:
-      move_vector = QtCore.QLineF(self._drag_start_scene_vector.p1(), gsMouseEvt.scenePos())
+      move_vector = QtCore.QLineF(self._drag_start_scene_vector.p1(), scenePos)
       self._drag_scale = move_vector.length() / self._drag_start_scene_vector.length()
       if not invert_snap:
         # TODO: round to integral multiples/fractions of: 1, sqrt(2), phi, sqrt(3), e, pi
@@ -540,24 +803,23 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
       #self.setTransform( self._drag_xformer.Transform() )
       return
     self.applyDragXforms(invert_snap)
-    if False:
-      mimedata = QtCore.QMimeData()
-      mimedata.setData(MIME_TYPE_SVG, dummySVG)
-      drag = QtGui.QDrag(gsMouseEvt.widget())
-      drag.setMimeData(mimedata)
-      drag.exec_()
 
   def stopDrag(self, gsMouseEvt):
     '''Finish the current drag transformation, keeping the dragged transforms.
     '''
     self._log.trace('entering')
+    self._drag_pacer.flush()  # catch up to the final mouse position
+    self._log.debug('{} mouse moves, {} merged, {} frames'
+                   , self._drag_pacer.posted, self._drag_pacer.merged, self._drag_pacer.frames)
     xforms = self.transformations()
     if xforms              : self._log.warning('{} transformations set!', len(xforms))
     if self.rotation() != 0: self._log.warning('rotation() = {}!', self.rotation())
     if self.scale()    != 1: self._log.warning('scale() = {}!', self.scale())
-    self.normalizeTransforms()
+    # Consecutive drags of the same tiles are undone together.
+    with self.scene().undoStack.record(drag_names.get(self._drag_type, 'Move'), self.childItems(), coalesce='drag'):
+      self.normalizeTransforms()
     self._log.trace('emitting tileChanged')
-    self.scene().tileChanged.emit()
+    self.scene().recordChange(modified=self.childItems())
     if self.scene().mouseGrabberItem() is self:
       self.ungrabMouse()
     for view in self.scene().views():
@@ -569,6 +831,7 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
        reverting to the transforms in effect when the drag started.
     '''
     self._log.trace('entering')
+    self._drag_pacer.cancel()
     if self.scene().mouseGrabberItem() is self:
       self.ungrabMouse()
     if self._drag_type != DRAG_NONE:
@@ -582,11 +845,33 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
     'Some aspect of this SelectionGroup has changed. Adjust accordingly.'
     if change in ( QtWidgets.QGraphicsItem.ItemChildAddedChange
                  , QtWidgets.QGraphicsItem.ItemChildRemovedChange ):
-      self._log.trace('{}:{}:clearing shape cache', change,value)
-      self.flushShape()
-      if change == QtWidgets.QGraphicsItem.ItemChildRemovedChange and not len(self.childItems()):
+      # The other Tiles haven't moved, so only the one is re-indexed.
+      self._shape = None
+      self._corners = None
+      self._edges = None
+      if not self._childIndex is None:
+        self._childIndex.markDirty(value)
+      if not self._bulkChange:
+        self._log.trace('{}:{}:clearing shape cache', change,value)
+        self.prepareGeometryChange()
+      if self.scene():
+        # A Tile entering the selection no longer snaps others; one leaving it does again.
+        self.scene().markSnapDirty(value)
+        self.scene().markExtentDirty(self)
+      if (    change == QtWidgets.QGraphicsItem.ItemChildRemovedChange and not self._bulkChange
+          and not len(self.childItems()) ):
         self._log.trace('no children left')
         self.resetTransforms()
+    elif change in ( QtWidgets.QGraphicsItem.ItemPositionHasChanged
+                   , QtWidgets.QGraphicsItem.ItemTransformHasChanged ):
+      if self.scene():
+        self.scene().markExtentDirty(self)
+    elif change == QtWidgets.QGraphicsItem.ItemSceneChange:
+      # Nothing is dragged once out of the scene, so the pacer mustn't call back.
+      self._drag_pacer.cancel()
+    elif change == QtWidgets.QGraphicsItem.ItemSceneHasChanged:
+      # The scene owns the pacer, so its timer can't outlive the scene (and this).
+      self._drag_pacer.setParent(value)
     else:
       self._log.trace('ItemSelectedHasChanged:{}',value)
     return super().itemChange(change, value)
@@ -604,11 +889,9 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
     shiftmod = (gsMouseEvt.modifiers() & QtCore.Qt.ShiftModifier)
     if shiftmod:
       # Un-select a currently selected individual tile
-      mpos = gsMouseEvt.scenePos()
-      for it in reversed(self.childItems()):
-        if it.contains(it.mapFromScene(mpos)):
-          it.setSelected(False)
-          break
+      it = self.childAt(self.mapFromScene(gsMouseEvt.scenePos()))
+      if not it is None:
+        it.setSelected(False)
     else:
       # Start or stop a drag.
       if self._drag_type is DRAG_NONE:
@@ -692,5 +975,18 @@ class SelectionGroup(QtWidgets.QGraphicsItemGroup):
           q = self.mapFromScene(snapTup[2])
           painter.drawEllipse(p, .25, .25)
 
+class TestSelectionGroup(unittest.TestCase):
+  def test_DragPacerOwner(self):
+    import tilelog
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([__file__])
+    scene = QtWidgets.QGraphicsScene()
+    group = SelectionGroup(tilelog.NotLogger())
+    scene.addItem(group)
+    self.assertIs(group._drag_pacer.parent(), scene)
+    group._drag_pacer.post(QtCore.QPointF(), QtCore.Qt.NoModifier)
+    scene.removeItem(group)
+    self.assertFalse(group._drag_pacer.isPending())
+    self.assertIsNone(group._drag_pacer.parent())
+
 if __name__=='__main__': unittest.main()
 
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+'''The native binary document format, ".tiles".
+
+All values are little-endian.  A file is:
+
+  header    HEADER: magic, format version, (reserved), number of shapes, number of tiles
+  shapes    for each shape, SHAPE: kind, number of doubles; followed by that many doubles:
+              SHAPE_POLYGON: x,y of each vertex
+              SHAPE_ELLIPSE: x,y,width,height of the bounding rectangle
+  tiles     for each tile, one fixed size TILE record (see TileRecord)
+
+Tile records are unpacked with struct, in blocks, so reading never
+parses text and takes time proportional to the number of tiles.
+'''
+
+import array, io, struct, sys, unittest
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import QPointF, QRectF
+from PyQt5.QtGui import QPolygonF, QTransform
+
+import svgparsing
+from tileitems import ShapePrototype, PolygonTileItem, PenroseTileItem, RulerTileItem, EllipseTileItem
+from svgwriting import SVGWriter, FormatTransform
+
+MAGIC = b'TILES\r\n\x1a'  # the CR LF & ^Z detect text-mode mangling, as in PNG
+VERSION = 1
+
+HEADER = struct.Struct('<8sHHII')
+SHAPE = struct.Struct('<B3xI')
+TILE = struct.Struct('<IBBxx6d4Bd')
+
+SHAPE_POLYGON, SHAPE_ELLIPSE = range(2)
+TYPE_POLYGON, TYPE_PENROSE, TYPE_RULER, TYPE_ELLIPSE = range(4)
+
+tile_types = \
+  { PolygonTileItem : TYPE_POLYGON
+  , PenroseTileItem : TYPE_PENROSE
+  , RulerTileItem   : TYPE_RULER
+  , EllipseTileItem : TYPE_ELLIPSE
+  }
+
+RECORDS_PER_READ = 4096
+
+def _LittleEndian(values):
+  'Byte swap an array, in place, if need be to convert between native and little-endian order.'
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values
+
+class TileRecord(object):
+  'The fields of one unpacked TILE record.'
+  __slots__ = ('shape', 'type', 'penroseShape', 'matrix', 'rgba', 'penroseSize')
+
+  def __init__(self, fields):
+    self.shape = fields[0]         # index into the shape table
+    self.type = fields[1]          # one of TYPE_*
+    self.penroseShape = fields[2]  # PenroseTileItem shape number
+    self.matrix = fields[3:9]      # m11, m12, m21, m22, dx, dy (including the item position)
+    self.rgba = fields[9:13]
+    self.penroseSize = fields[13]
+
+  def transform(self):
+    return QTransform(*self.matrix)
+
+  def color(self):
+    return QtGui.QColor(*self.rgba)
+
+class ShapeTable(object):
+  'The shape table of a .tiles file being written: each distinct shape gets the next index.'
+
+  def __init__(self):
+    self._indices = {}  # ShapePrototype or ellipse rect tuple -> index
+    self.data = []      # (kind, array('d')), by index
+
+  def __len__(self):
+    return len(self.data)
+
+  def index(self, key):
+    'Return the index of shape key (as from TileShapeKey()), adding it if need be.'
+    i = self._indices.get(key)
+    if i is None:
+      i = self._indices[key] = len(self.data)
+      if isinstance(key, ShapePrototype):
+        values = array.array('d')
+        values.frombytes(key.polygon.data().asstring(len(key.polygon) * 16))
+        self.data.append((SHAPE_POLYGON, values))
+      else:
+        self.data.append((SHAPE_ELLIPSE, array.array('d', key)))
+    return i
+
+def TileShapeKey(it):
+  'Return the shape of TileItem it as a ShapeTable key: its ShapePrototype, or its ellipse rect as a tuple.'
+  if type(it) is EllipseTileItem:
+    r = it.rect()
+    return (r.x(), r.y(), r.width(), r.height())
+  return it.prototype()
+
+def PackTile(buf, offset, it, shapes):
+  'Pack TileItem it (of a type in tile_types) into buf at offset as a TILE record, using ShapeTable shapes.'
+  tt = tile_types[type(it)]
+  (penroseShape, penroseSize) = (0, 0.0)
+  if tt == TYPE_PENROSE:
+    (penroseShape, penroseSize) = (it._shape, it._size)
+  t = it.transform()
+  pos = it.pos()
+  TILE.pack_into(buf, offset, shapes.index(TileShapeKey(it)), tt, penroseShape
+                , t.m11(), t.m12(), t.m21(), t.m22(), t.dx() + pos.x(), t.dy() + pos.y()
+                , *it.color().getRgb(), penroseSize)
+
+def WriteHeader(f, shapeData, nTiles):
+  'Write the header and shape table (a sequence of ShapeTable.data entries) for nTiles tiles.'
+  f.write(HEADER.pack(MAGIC, VERSION, 0, len(shapeData), nTiles))
+  for (kind, values) in shapeData:
+    f.write(SHAPE.pack(kind, len(values)))
+    f.write(_LittleEndian(array.array('d', values)).tobytes())
+
+def WriteTiles(f, tiles, store=None):
+  '''Write tiles (those of a type in tile_types) to binary file f in .tiles format,
+     followed by the unpromoted records of tilestore.TileStore store, if any.'''
+  shapes = ShapeTable()
+  tiles = [ it for it in tiles if type(it) in tile_types ]
+  records = bytearray(TILE.size * len(tiles))
+  for (i, it) in enumerate(tiles):
+    PackTile(records, i * TILE.size, it, shapes)
+  nTiles = len(tiles)
+  if not store is None:
+    # The store's records are copied as they are, with their shapes renumbered.
+    shapeMap = [ shapes.index(StoredShapeKey(s)) for s in store.shapes() ]
+    nTiles += len(store)
+  WriteHeader(f, shapes.data, nTiles)
+  f.write(records)
+  if not store is None:
+    f.write(store.packRecords(shapeMap))
+
+def StoredShapeKey(s):
+  'Return the key a TileItem of shape s (as from TilesReader.shapes()) would have: a ShapePrototype or ellipse rect tuple.'
+  if isinstance(s, QRectF):
+    return (s.x(), s.y(), s.width(), s.height())
+  return ShapePrototype.get(s)
+
+def IsTilesFile(f):
+  'Return whether buffered binary file f starts with the .tiles magic number, without consuming it.'
+  return f.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+
+class TilesReader(object):
+  '''Reads a .tiles file, yielding TileItems, like SVGReader.'''
+
+  def __init__(self, logger):
+    self._log = logger
+    self._shapes = []  # index -> QPolygonF or QRectF
+    self.found_native_tiles = True
+
+  def get_view_transforms(self): return []
+
+  def _read(self, f, n):
+    data = f.read(n)
+    if len(data) != n:
+      raise ValueError('truncated .tiles file')
+    return data
+
+  def readHeader(self, f):
+    'Read the header and shape table, returning the number of tiles that follow.'
+    (magic, version, _reserved, nShapes, nTiles) = HEADER.unpack(self._read(f, HEADER.size))
+    if magic != MAGIC:
+      raise ValueError('not a .tiles file')
+    if version > VERSION:
+      raise ValueError('.tiles format version {} is newer than this program (version {})'.format(version, VERSION))
+    self._shapes = []
+    for i in range(nShapes):
+      (kind, n) = SHAPE.unpack(self._read(f, SHAPE.size))
+      values = array.array('d')
+      values.frombytes(self._read(f, n * values.itemsize))
+      _LittleEndian(values)
+      if kind == SHAPE_POLYGON:
+        self._shapes.append(svgparsing.ArrayToQPolygonF(values))
+      elif kind == SHAPE_ELLIPSE and n == 4:
+        self._shapes.append(QRectF(*values))
+      else:
+        raise ValueError('unknown .tiles shape kind {}'.format(kind))
+    return nTiles
+
+  def shapes(self):
+    return self._shapes
+
+  def iterRecords(self, f):
+    'Given a binary file object of .tiles, yield a TileRecord for each tile.'
+    nTiles = self.readHeader(f)
+    while nTiles:
+      n = min(nTiles, RECORDS_PER_READ)
+      for fields in TILE.iter_unpack(self._read(f, n * TILE.size)):
+        if fields[0] >= len(self._shapes):
+          raise ValueError('.tiles shape index out of range')
+        yield TileRecord(fields)
+      nTiles -= n
+
+  def iterItems(self, source):
+    'Given a binary file object of .tiles, yield the TileItems as they are read.'
+    for r in self.iterRecords(source):
+      it = self.newItem(r)
+      if not it is None:
+        yield it
+
+  def newItem(self, r):
+    'Construct the TileItem described by TileRecord r, or return None'
+    shape = self._shapes[r.shape]
+    if r.type == TYPE_POLYGON:
+      it = PolygonTileItem(polygon=shape, color=r.color())
+    elif r.type == TYPE_PENROSE:
+      it = PenroseTileItem(shape=r.penroseShape, size=r.penroseSize, polygon=shape, color=r.color())
+    elif r.type == TYPE_RULER:
+      it = RulerTileItem(color=r.color())
+    elif r.type == TYPE_ELLIPSE:
+      it = EllipseTileItem(shape, color=r.color())
+    else:
+      self._log.warning('unknown .tiles tile type {}', r.type)
+      return None
+    it.setTransform(r.transform())
+    return it
+
+def ConvertToSvg(src, dst, xmlDecl='<?xml version="1.0" encoding="utf-8" standalone="no"?>'):
+  '''Convert .tiles file src to SVG file dst, directly, without creating any TileItems.'''
+  reader = TilesReader(None)
+  with open(src, 'rb') as f:
+    records = list(reader.iterRecords(f))
+  shapes = reader.shapes()
+  bounds = QRectF()
+  for r in records:
+    s = shapes[r.shape]
+    bounds |= r.transform().mapRect(s if isinstance(s, QRectF) else s.boundingRect())
+  with open(dst, 'wt', encoding='utf-8') as out:
+    writer = SVGWriter(out)
+    writer.declaration(xmlDecl)
+    writer.start('svg',
+      [ ('xmlns'       , 'http://www.w3.org/2000/svg')
+      , ('xmlns:tiles' , 'http://tiles/tiles')
+      , ('xmlns:xlink' , 'http://www.w3.org/1999/xlink')
+      , ('version'     , '1.1')
+      , ('viewBox'     , '{!r} {!r} {!r} {!r}'.format(bounds.x(), bounds.y(), bounds.width(), bounds.height()))
+      ])
+    writer.start('defs')
+    for (i, s) in enumerate(shapes):
+      if isinstance(s, QPolygonF):
+        writer.define(i, 'polygon', [('points', ' '.join('%r,%r' % (p.x(), p.y()) for p in s))])
+    writer.end()
+    writer.start('g', [('tiles:type', 'MagneticTileView'), ('stroke', '#000000'), ('stroke-width', '.03px')])
+    for r in records:
+      WriteSvgRecord(writer, r, shapes[r.shape], r.shape)
+    writer.close()
+
+_origin = QPointF()
+
+def WriteSvgRecord(writer, r, shape, key):
+  '''Write TileRecord r as an SVG element, given its shape (from TilesReader.shapes()),
+     and, for a polygon, the key it was define()d with.'''
+  attribs = [('transform', FormatTransform(_origin, r.transform()))]
+  if r.type == TYPE_PENROSE:
+    attribs += [ ('tiles:type', 'PenroseTileItem')
+               , ('tiles:shapeno', str(r.penroseShape))
+               , ('tiles:size', str(r.penroseSize)) ]
+  elif r.type == TYPE_RULER:
+    attribs.append(('tiles:type', 'RulerTileItem'))
+  if isinstance(shape, QRectF):
+    c = shape.center()
+    writer.element('ellipse'
+                  , [ ('cx', repr(c.x())), ('cy', repr(c.y()))
+                    , ('rx', repr(shape.width() / 2)), ('ry', repr(shape.height() / 2)) ] + attribs
+                  , writer.fillStyle(r.color()))
+  else:
+    writer.element('use', [('xlink:href', writer.reference(key))] + attribs, writer.fillStyle(r.color()))
+
+class TestTilesFile(unittest.TestCase):
+
+  def setUp(self):
+    import tilelog, tileitems, svgwriting
+    self.logger = tilelog.NotLogger()
+    tileitems.logger = svgparsing.logger = svgwriting.logger = self.logger
+
+  def roundTrip(self, tiles):
+    f = io.BytesIO()
+    WriteTiles(f, tiles)
+    f = io.BufferedReader(io.BytesIO(f.getvalue()))
+    self.assertTrue(IsTilesFile(f))
+    return list(TilesReader(self.logger).iterItems(f))
+
+  def test_RoundTrip(self):
+    from tileitems import RegularPolygon
+    a = PolygonTileItem(polygon=RegularPolygon(5), color=QtGui.QColor(1,2,3,4))
+    a.setTransform(QTransform().rotate(30))
+    a.setPos(5, -6)
+    b = PenroseTileItem(shape=PenroseTileItem.KITE)
+    c = PolygonTileItem(polygon=RegularPolygon(5))
+    (a2, b2, c2) = self.roundTrip([a, b, c])
+    self.assertEqual(a2.color().getRgb(), (1,2,3,4))
+    self.assertEqual(list(a2.polygon()), list(a.polygon()))
+    self.assertEqual(a2.transform(), a.transform() * QTransform.fromTranslate(5, -6))
+    self.assertIs(a2.prototype(), c2.prototype())
+    self.assertIsInstance(b2, PenroseTileItem)
+    self.assertEqual((b2._shape, b2._size), (b._shape, b._size))
+
+  def test_BadFiles(self):
+    reader = TilesReader(self.logger)
+    self.assertRaises(ValueError, list, reader.iterRecords(io.BytesIO(b'<svg/>' + bytes(20))))
+    f = io.BytesIO()
+    WriteTiles(f, [PolygonTileItem(polygon=QPolygonF([QPointF(0,0), QPointF(1,0), QPointF(0,1)]))])
+    self.assertRaises(ValueError, list, reader.iterRecords(io.BytesIO(f.getvalue()[:-1])))
+
+if __name__=='__main__':
+  if len(sys.argv) == 4 and sys.argv[1] == '--svg':
+    ConvertToSvg(sys.argv[2], sys.argv[3])
+  else:
+    unittest.main()
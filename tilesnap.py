@@ -0,0 +1,1047 @@
+#!/usr/bin/env python3
+
+import math, unittest
+from PyQt5 import QtCore, QtGui
+
+try:
+  import numpy
+except ImportError:
+  numpy = None  # fall back to pure Python snap searches
+
+class SnapGrid(object):
+  '''A uniform spatial hash of the scene-space snap points of (unselected) tiles.
+     Cells are cellSize square, so with cellSize >= the snap distance,
+     every point close enough to snap to lies in the 3x3 block of cells
+     around the query point.
+     Tiles are (re)indexed lazily: callers markDirty() a tile whenever it is
+     added, removed, or moved, and sync() before querying.
+  '''
+
+  def __init__(self, cellSize=.25):
+    self._cells = {}       # (i,j) -> list of (x, y, tile)
+    self._tilePoints = {}  # tile -> list of (x, y) as indexed
+    self._dirty = set()
+    self._count = 0
+    self._arrays = None    # cached (keys, points) sorted by cell, for NumPy searches
+    self.setCellSize(cellSize)
+
+  def __len__(self):
+    'Return the number of indexed points.'
+    return self._count
+
+  def cellSize(self):
+    return self._cellSize
+
+  def setCellSize(self, cellSize):
+    'Change the cell size, re-binning all indexed points.'
+    self._cellSize = float(cellSize)
+    self._invCellSize = 1.0 / self._cellSize
+    tilePoints = self._tilePoints
+    self._arrays = None
+    self._cells = {}
+    self._tilePoints = {}
+    self._count = 0
+    for tile, pts in tilePoints.items():
+      self._insert(tile, pts)
+
+  def _key(self, x, y):
+    return (math.floor(x * self._invCellSize), math.floor(y * self._invCellSize))
+
+  def _insert(self, tile, pts):
+    cells = self._cells
+    for xy in pts:
+      k = self._key(*xy)
+      c = cells.get(k)
+      if c is None:
+        cells[k] = c = []
+      c.append((xy[0], xy[1], tile))
+    self._tilePoints[tile] = pts
+    self._count += len(pts)
+    self._arrays = None
+
+  def _remove(self, tile):
+    pts = self._tilePoints.pop(tile, None)
+    if pts is None: return
+    cells = self._cells
+    for xy in pts:
+      k = self._key(*xy)
+      c = cells[k]
+      c[:] = [e for e in c if not e[2] is tile]
+      if not c:
+        del cells[k]
+    self._count -= len(pts)
+    self._arrays = None
+
+  def __contains__(self, tile):
+    return tile in self._tilePoints
+
+  def markDirty(self, tile):
+    'Note that the given tile has been added, removed, or moved.'
+    self._dirty.add(tile)
+
+  def clear(self):
+    self._cells = {}
+    self._tilePoints = {}
+    self._dirty = set()
+    self._count = 0
+    self._arrays = None
+
+  def sync(self, isIndexable):
+    '''Re-index every dirty tile.
+       isIndexable(tile) returns True if the tile's points belong in the index.
+    '''
+    if not self._dirty: return
+    dirty = self._dirty
+    self._dirty = set()
+    for tile in dirty:
+      self._remove(tile)
+      if isIndexable(tile):
+        self._insert(tile, [(p.x(), p.y()) for p in tile.sceneSnapPoints()])
+
+  def neighbors(self, x, y):
+    'Return a list of (x, y, tile) entries in the 3x3 block of cells around (x,y).'
+    (i, j) = self._key(x, y)
+    cells = self._cells
+    found = []
+    for k in ( (i-1,j-1), (i,j-1), (i+1,j-1)
+             , (i-1,j  ), (i,j  ), (i+1,j  )
+             , (i-1,j+1), (i,j+1), (i+1,j+1) ):
+      c = cells.get(k)
+      if c:
+        found.extend(c)
+    return found
+
+  def sortedArrays(self):
+    '''Return (keys, points): NumPy arrays of all indexed points, (M,2) float64,
+       sorted by their packed cell keys (see PackCellKeys).
+    '''
+    if self._arrays is None:
+      pts = numpy.array([e[:2] for c in self._cells.values() for e in c], dtype=numpy.float64).reshape(-1,2)
+      keys = PackCellKeys(numpy.floor(pts * self._invCellSize))
+      order = numpy.argsort(keys, kind='stable')
+      self._arrays = (keys[order], pts[order])
+    return self._arrays
+
+def PackCellKeys(ij):
+  'Pack an (N,2) array of integral cell indices into int64 keys that sort by column, then row.'
+  ij = ij.astype(numpy.int64)
+  return (ij[:,0] << 32) + (ij[:,1] + (1 << 31))
+
+# Below this many points, NumPy call overhead exceeds the plain Python loop.
+NUMPY_MIN_POINTS = 48
+# Compare at most this many points from ps at a time, to bound memory use.
+NUMPY_BLOCK_POINTS = 4096
+SEARCH_TIMEOUT_MS = 250
+
+def GatherPoints(pointSeqs):
+  '''Concatenate sequences of QPointF (such as QPolygonF) into an (N,2) NumPy array,
+     or a list of (x,y) tuples if NumPy is unavailable.
+  '''
+  if numpy is None:
+    return [ (p.x(), p.y()) for seq in pointSeqs for p in seq ]
+  arrays = []
+  keepalive = []
+  for seq in pointSeqs:
+    if isinstance(seq, QtGui.QPolygonF):
+      # Read the contiguous QPointF (double x, double y) storage directly.
+      n = seq.size()
+      if n:
+        buf = seq.data()
+        buf.setsize(n * 16)
+        arrays.append(numpy.frombuffer(buf, dtype=numpy.float64))
+        keepalive.append(seq)  # until copied by concatenate()
+    else:
+      arrays.append(numpy.array([ (p.x(), p.y()) for p in seq ], dtype=numpy.float64).ravel())
+  if not arrays:
+    return numpy.empty((0,2))
+  return numpy.concatenate(arrays).reshape(-1,2)  # concatenate() copies
+
+def NearestSnapPairs(grid, ps, snap_dist, exclude=None, timer=None):
+  '''Return a list of (equally) closest (distance squared, (px,py), (qx,qy)) tuples
+     pairing points ps with points in the SnapGrid grid no farther than snap_dist.
+     ps is a list of (x,y) tuples or an (N,2) array from GatherPoints().
+     Points within snap_dist/100 of exclude are ignored.
+     Returns [] if QElapsedTimer timer expires first.
+  '''
+  if not numpy is None and len(ps) >= NUMPY_MIN_POINTS:
+    return _NearestSnapPairsNumpy(grid, ps, snap_dist, exclude)
+  if not isinstance(ps, list):
+    ps = [ tuple(p) for p in ps.tolist() ]
+  nearest_dist2 = snap_dist ** 2  # Use squared distances to avoid calling sqrt
+  nearest = []
+  if exclude is None:
+    exclude_dist2 = None
+  else:
+    (ex, ey) = exclude
+    exclude_dist2 = (snap_dist/100.0) ** 2
+  for (i, (px, py)) in enumerate(ps):
+    if not exclude_dist2 is None and (px-ex)**2 + (py-ey)**2 <= exclude_dist2:
+      continue
+    for (qx, qy, _tile) in grid.neighbors(px, py):
+      if not exclude_dist2 is None and (qx-ex)**2 + (qy-ey)**2 <= exclude_dist2:
+        continue
+      pq2 = (qx-px)**2 + (qy-py)**2
+      if pq2 <= nearest_dist2:
+        if pq2 < nearest_dist2:
+          nearest_dist2 = pq2
+          nearest = []
+        nearest.append( (pq2, (px, py), (qx, qy)) )
+    if not timer is None and i % 64 == 63 and timer.hasExpired(SEARCH_TIMEOUT_MS):
+      return []
+  return nearest
+
+def _NeighborPairs(keys, P, invCellSize):
+  '''Return (pIdx, qIdx): index arrays pairing each of points P with every
+     point, of those sorted by their cell keys, in the surrounding 3x3 cells.
+     Return None if there are no such pairs.'''
+  ij = numpy.floor(P * invCellSize)
+  # For each of the 3 neighboring columns, the 3 neighboring rows form one
+  # contiguous run of sorted keys.
+  pIdx = []
+  qIdx = []
+  for di in (-1, 0, 1):
+    lo = numpy.searchsorted(keys, PackCellKeys(ij + (di, -1)), 'left')
+    hi = numpy.searchsorted(keys, PackCellKeys(ij + (di,  1)), 'right')
+    counts = hi - lo
+    total = int(counts.sum())
+    if not total: continue
+    starts = numpy.cumsum(counts) - counts
+    pIdx.append(numpy.repeat(numpy.arange(len(P)), counts))
+    qIdx.append(numpy.arange(total) - numpy.repeat(starts - lo, counts))
+  if not pIdx:
+    return None
+  return (numpy.concatenate(pIdx), numpy.concatenate(qIdx))
+
+def _NearestSnapPairsNumpy(grid, ps, snap_dist, exclude):
+  'A vectorized NearestSnapPairs(), considering only pairs in neighboring grid cells.'
+  (keys, Q) = grid.sortedArrays()
+  if not len(Q): return []
+  P = numpy.asarray(ps, dtype=numpy.float64).reshape(-1,2)
+  nearest_dist2 = snap_dist ** 2
+  if not exclude is None:
+    exclude_dist2 = (snap_dist/100.0) ** 2
+    E = numpy.array(exclude, dtype=numpy.float64)
+    e = P - E
+    P = P[e[:,0]*e[:,0] + e[:,1]*e[:,1] > exclude_dist2]
+  best = None
+  bestPairs = []
+  for b in range(0, len(P), NUMPY_BLOCK_POINTS):
+    Pb = P[b:b+NUMPY_BLOCK_POINTS]
+    pairs = _NeighborPairs(keys, Pb, grid._invCellSize)
+    if pairs is None: continue
+    (pIdx, qIdx) = pairs
+    Qc = Q[qIdx]
+    d = Qc - Pb[pIdx]
+    d2 = d[:,0]*d[:,0] + d[:,1]*d[:,1]
+    ok = d2 <= nearest_dist2
+    if not exclude is None:
+      e = Qc - E
+      ok &= e[:,0]*e[:,0] + e[:,1]*e[:,1] > exclude_dist2
+    hits = numpy.flatnonzero(ok)
+    if not len(hits): continue
+    m = d2[hits].min()
+    if best is None or m < best:
+      best = m
+      bestPairs = []
+    if m == best:
+      hits = hits[d2[hits] == m]
+      bestPairs.extend(zip(Pb[pIdx[hits]].tolist(), Qc[hits].tolist()))
+  return [ (float(best), tuple(p), tuple(q)) for (p, q) in bestPairs ]
+
+#==== Snapping only corners that fit
+
+CORNER_ANGLE_TOL = 1.0    # degrees by which a corner may overfill a gap and still fit
+CORNER_LENGTH_TOL = 1e-4  # relative difference within which edge lengths match
+
+def PolygonCorners(points):
+  '''Return a list of (interior angle in degrees, length of the edge before,
+     length of the edge after) for each of a polygon's vertices, a sequence
+     of QPointF.  A closing vertex (repeating the first) is left out, so as
+     not to count that corner twice.
+  '''
+  xys = [ (p.x(), p.y()) for p in points ]
+  if len(xys) > 1 and xys[0] == xys[-1]:
+    xys.pop()
+  n = len(xys)
+  if n < 3:
+    return [ (0.0, 0.0, 0.0) ] * n
+  corners = []
+  for k in range(n):
+    (x, y) = xys[k]
+    (ux, uy) = (xys[k-1][0] - x, xys[k-1][1] - y)
+    (vx, vy) = (xys[(k+1)%n][0] - x, xys[(k+1)%n][1] - y)
+    a = math.degrees(math.atan2(vx*uy - vy*ux, vx*ux + vy*uy)) % 360
+    corners.append((a, math.hypot(ux, uy), math.hypot(vx, vy)))
+  # Those are the angles on one side; the interior angles sum to (n-2)*180.
+  if sum(c[0] for c in corners) > n * 180:
+    corners = [ ((360 - a) % 360, la, lb) for (a, la, lb) in corners ]
+  return corners
+
+def SimilarityScale(t):
+  '''Return the factor by which QTransform t scales lengths, if it preserves
+     angles (only rotating, uniformly scaling, mirroring and translating),
+     otherwise None.'''
+  (a, b, c, d) = (t.m11(), t.m12(), t.m21(), t.m22())
+  tol = 1e-9 * (abs(a) + abs(b) + abs(c) + abs(d))
+  if (abs(a - d) <= tol and abs(b + c) <= tol) or (abs(a + d) <= tol and abs(b - c) <= tol):
+    return math.sqrt(abs(a*d - b*c))
+  return None
+
+def _SharesLength(lengths, others):
+  return any( math.isclose(l, m, rel_tol=CORNER_LENGTH_TOL) for l in lengths for m in others )
+
+class _Vertex(object):
+  'Where corners of one or more tiles coincide.'
+  __slots__ = ('x', 'y', 'gap', 'lengths', 'corners')
+
+  def __init__(self, x, y):
+    (self.x, self.y) = (x, y)
+    self.gap = 360.0    # degrees not yet filled by a corner
+    self.lengths = []   # of the edges meeting here
+    self.corners = 0
+
+class CornerGrid(object):
+  '''A uniform spatial hash, like SnapGrid, of the vertices of (unselected)
+     tiles, each with the signature of the corners that meet there: the angle
+     still free around it (its gap) and the lengths of the edges meeting there.
+     Corners of different tiles within cellSize/100 of each other are merged
+     into one vertex, so a vertex surrounded by tiles has no gap, and no
+     corner can snap to it.
+     Tiles are (re)indexed lazily, with their sceneCorners().
+  '''
+
+  def __init__(self, cellSize=.25):
+    self._cells = {}        # (i,j) -> list of _Vertex
+    self._tileCorners = {}  # tile -> list of (vertex, angle, lengths) as indexed
+    self._dirty = set()
+    self._count = 0
+    self._arrays = None     # cached (keys, points, gaps) sorted by cell, for NumPy searches
+    self.setCellSize(cellSize)
+
+  def __len__(self):
+    'Return the number of indexed vertices.'
+    return self._count
+
+  def cellSize(self):
+    return self._cellSize
+
+  def setCellSize(self, cellSize):
+    'Change the cell size, re-binning all indexed vertices.'
+    self._cellSize = float(cellSize)
+    self._invCellSize = 1.0 / self._cellSize
+    self._mergeDist2 = (self._cellSize / 100) ** 2
+    tileCorners = self._tileCorners
+    self._arrays = None
+    self._cells = {}
+    self._tileCorners = {}
+    self._count = 0
+    for tile, corners in tileCorners.items():
+      self._insert(tile, [ (v.x, v.y, a, ls) for (v, a, ls) in corners ])
+
+  def _key(self, x, y):
+    return (math.floor(x * self._invCellSize), math.floor(y * self._invCellSize))
+
+  def _insert(self, tile, corners):
+    cells = self._cells
+    indexed = []
+    for (x, y, a, ls) in corners:
+      v = None
+      for u in self.neighbors(x, y):
+        if (u.x - x)**2 + (u.y - y)**2 <= self._mergeDist2:
+          v = u
+          break
+      if v is None:
+        v = _Vertex(x, y)
+        k = self._key(x, y)
+        c = cells.get(k)
+        if c is None:
+          cells[k] = c = []
+        c.append(v)
+        self._count += 1
+      v.gap -= a
+      v.lengths.extend(ls)
+      v.corners += 1
+      indexed.append((v, a, ls))
+    self._tileCorners[tile] = indexed
+    self._arrays = None
+
+  def _remove(self, tile):
+    indexed = self._tileCorners.pop(tile, None)
+    if indexed is None: return
+    cells = self._cells
+    for (v, a, ls) in indexed:
+      v.gap += a
+      for l in ls:
+        v.lengths.remove(l)
+      v.corners -= 1
+      if not v.corners:
+        k = self._key(v.x, v.y)
+        c = cells[k]
+        c.remove(v)
+        if not c:
+          del cells[k]
+        self._count -= 1
+    self._arrays = None
+
+  def __contains__(self, tile):
+    return tile in self._tileCorners
+
+  def markDirty(self, tile):
+    'Note that the given tile has been added, removed, or moved.'
+    self._dirty.add(tile)
+
+  def clear(self):
+    self._cells = {}
+    self._tileCorners = {}
+    self._dirty = set()
+    self._count = 0
+    self._arrays = None
+
+  def sync(self, isIndexable):
+    '''Re-index every dirty tile.
+       isIndexable(tile) returns True if the tile's corners belong in the index.
+    '''
+    if not self._dirty: return
+    dirty = self._dirty
+    self._dirty = set()
+    for tile in dirty:
+      self._remove(tile)
+    for tile in dirty:
+      if isIndexable(tile):
+        self._insert(tile, tile.sceneCorners())
+
+  def neighbors(self, x, y):
+    'Return a list of the vertices in the 3x3 block of cells around (x,y).'
+    (i, j) = self._key(x, y)
+    cells = self._cells
+    found = []
+    for k in ( (i-1,j-1), (i,j-1), (i+1,j-1)
+             , (i-1,j  ), (i,j  ), (i+1,j  )
+             , (i-1,j+1), (i,j+1), (i+1,j+1) ):
+      c = cells.get(k)
+      if c:
+        found.extend(c)
+    return found
+
+  def sortedArrays(self):
+    '''Return (keys, points, gaps): NumPy arrays of the vertices with any gap
+       left, sorted by their packed cell keys (see PackCellKeys).
+    '''
+    if self._arrays is None:
+      vs = [ v for c in self._cells.values() for v in c if v.gap > CORNER_ANGLE_TOL ]
+      pts = numpy.array([ (v.x, v.y) for v in vs ], dtype=numpy.float64).reshape(-1,2)
+      gaps = numpy.array([ v.gap for v in vs ], dtype=numpy.float64)
+      keys = PackCellKeys(numpy.floor(pts * self._invCellSize))
+      order = numpy.argsort(keys, kind='stable')
+      self._arrays = (keys[order], pts[order], gaps[order], [ vs[i] for i in order.tolist() ])
+    return self._arrays[:3]
+
+  def sortedVertices(self):
+    'Return the _Vertex of each of sortedArrays().'
+    self.sortedArrays()
+    return self._arrays[3]
+
+def GatherCorners(cornerSeqs, snap_dist):
+  '''Concatenate sequences of (x, y, angle, lengths) corners, such as from
+     sceneCorners(), merging those within snap_dist/100 of each other
+     (where selected tiles meet) into one corner, with their angles summed.
+  '''
+  merged = {}
+  s = 100.0 / snap_dist
+  for seq in cornerSeqs:
+    for (x, y, a, ls) in seq:
+      k = (round(x * s), round(y * s))
+      c = merged.get(k)
+      if c is None:
+        merged[k] = [x, y, a, tuple(ls)]
+      else:
+        c[2] += a
+        c[3] += tuple(ls)
+  return [ tuple(c) for c in merged.values() ]
+
+def MapCorners(corners, t):
+  '''Return corners (as from GatherCorners()) mapped by QTransform t,
+     which must only rotate, uniformly scale, mirror and translate.'''
+  s = SimilarityScale(t)
+  (m11, m12, m21, m22, dx, dy) = (t.m11(), t.m12(), t.m21(), t.m22(), t.dx(), t.dy())
+  return [ (x*m11 + y*m21 + dx, x*m12 + y*m22 + dy, a, tuple(l*s for l in ls)) for (x, y, a, ls) in corners ]
+
+def NearestCornerPairs(grid, corners, snap_dist, exclude=None, timer=None):
+  '''Like NearestSnapPairs(), but pairing corners (from GatherCorners()) with
+     vertices of the CornerGrid grid, and only where the corner fits into the
+     vertex's gap.  Pairs whose edge lengths match are preferred over closer
+     pairs whose don't.
+  '''
+  if not numpy is None and len(corners) >= NUMPY_MIN_POINTS:
+    return _NearestCornerPairsNumpy(grid, corners, snap_dist, exclude)
+  nearest_dist2 = snap_dist ** 2
+  best = None  # (rank, distance squared) of the nearest
+  nearest = []
+  if exclude is None:
+    exclude_dist2 = None
+  else:
+    (ex, ey) = exclude
+    exclude_dist2 = (snap_dist/100.0) ** 2
+  for (i, (px, py, a, ls)) in enumerate(corners):
+    if not exclude_dist2 is None and (px-ex)**2 + (py-ey)**2 <= exclude_dist2:
+      continue
+    for v in grid.neighbors(px, py):
+      if v.gap + CORNER_ANGLE_TOL < a:
+        continue
+      (qx, qy) = (v.x, v.y)
+      if not exclude_dist2 is None and (qx-ex)**2 + (qy-ey)**2 <= exclude_dist2:
+        continue
+      pq2 = (qx-px)**2 + (qy-py)**2
+      if pq2 <= nearest_dist2:
+        rank = (0 if _SharesLength(ls, v.lengths) else 1, pq2)
+        if best is None or rank < best:
+          best = rank
+          nearest = []
+        if rank == best:
+          nearest.append( (pq2, (px, py), (qx, qy)) )
+    if not timer is None and i % 64 == 63 and timer.hasExpired(SEARCH_TIMEOUT_MS):
+      return []
+  return nearest
+
+def _NearestCornerPairsNumpy(grid, corners, snap_dist, exclude):
+  'A vectorized NearestCornerPairs(): only the pairs near enough that fit are ranked in Python.'
+  (keys, Q, G) = grid.sortedArrays()
+  if not len(Q): return []
+  vertices = grid.sortedVertices()
+  P = numpy.array([ c[:2] for c in corners ], dtype=numpy.float64).reshape(-1,2)
+  A = numpy.array([ c[2] for c in corners ], dtype=numpy.float64)
+  nearest_dist2 = snap_dist ** 2
+  if not exclude is None:
+    exclude_dist2 = (snap_dist/100.0) ** 2
+    E = numpy.array(exclude, dtype=numpy.float64)
+  best = None
+  nearest = []
+  for b in range(0, len(P), NUMPY_BLOCK_POINTS):
+    Pb = P[b:b+NUMPY_BLOCK_POINTS]
+    pairs = _NeighborPairs(keys, Pb, grid._invCellSize)
+    if pairs is None: continue
+    (pIdx, qIdx) = pairs
+    Qc = Q[qIdx]
+    d = Qc - Pb[pIdx]
+    d2 = d[:,0]*d[:,0] + d[:,1]*d[:,1]
+    ok = (d2 <= nearest_dist2) & (G[qIdx] + CORNER_ANGLE_TOL >= A[b + pIdx])
+    if not exclude is None:
+      for R in (Qc, Pb[pIdx]):
+        e = R - E
+        ok &= e[:,0]*e[:,0] + e[:,1]*e[:,1] > exclude_dist2
+    for k in numpy.flatnonzero(ok).tolist():
+      (px, py, _a, ls) = corners[b + int(pIdx[k])]
+      v = vertices[int(qIdx[k])]
+      pq2 = float(d2[k])
+      rank = (0 if _SharesLength(ls, v.lengths) else 1, pq2)
+      if best is None or rank < best:
+        best = rank
+        nearest = []
+      if rank == best:
+        nearest.append( (pq2, (px, py), (v.x, v.y)) )
+  return nearest
+
+#==== Snapping edges flush
+
+def OrientedEdges(lines):
+  '''Return (x1, y1, x2, y2) for each QLineF edge of a polygon, all running
+     the same way around it (with positive signed area), so that the edges of
+     two tiles lying flush against each other run in opposite directions.
+  '''
+  edges = [ (l.x1(), l.y1(), l.x2(), l.y2()) for l in lines ]
+  if sum(x1*y2 - x2*y1 for (x1, y1, x2, y2) in edges) < 0:
+    edges = [ (x2, y2, x1, y1) for (x1, y1, x2, y2) in edges ]
+  return edges
+
+def _EdgeKey(x1, y1, x2, y2):
+  'Return a key identifying an edge (to within 1e-6), whichever way it runs.'
+  a = (round(x1 * 1e6), round(y1 * 1e6))
+  b = (round(x2 * 1e6), round(y2 * 1e6))
+  return (a, b) if a <= b else (b, a)
+
+class EdgeGrid(object):
+  '''A uniform spatial hash of the scene-space edges of (unselected) tiles.
+     Each edge is listed in every cell it passes through.  An edge
+     shared by two indexed tiles is closed: nothing can lie flush against it.
+     Tiles are (re)indexed lazily, with their sceneEdges(), as with SnapGrid.
+     The cell size is best about the length of a typical edge (see meanLength()).
+  '''
+
+  def __init__(self, cellSize=1.0):
+    self._cellSize = float(cellSize)
+    self._invCellSize = 1.0 / self._cellSize
+    self._cells = {}      # (i,j) -> list of (x1, y1, x2, y2, key)
+    self._tileEdges = {}  # tile -> list of (edge, cell keys) as indexed
+    self._shared = {}     # _EdgeKey -> number of indexed edges with it
+    self._dirty = set()
+    self._count = 0
+    self._totalLength = 0.0
+
+  def __len__(self):
+    'Return the number of indexed edges.'
+    return self._count
+
+  def cellSize(self):
+    return self._cellSize
+
+  def setCellSize(self, cellSize):
+    'Change the cell size, re-binning all indexed edges.'
+    self._cellSize = float(cellSize)
+    self._invCellSize = 1.0 / self._cellSize
+    tileEdges = self._tileEdges
+    self._cells = {}
+    self._tileEdges = {}
+    self._shared = {}
+    self._count = 0
+    self._totalLength = 0.0
+    for tile, indexed in tileEdges.items():
+      self._insert(tile, [ e[:4] for (e, _keys) in indexed ])
+
+  def meanLength(self):
+    'Return the mean length of the indexed edges (0 if none).'
+    return self._totalLength / self._count if self._count else 0.0
+
+  def _cellKeys(self, x0, y0, x1, y1):
+    'Return the keys of the cells the box touches.'
+    s = self._invCellSize
+    (i0, i1) = (math.floor(x0 * s), math.floor(x1 * s))
+    (j0, j1) = (math.floor(y0 * s), math.floor(y1 * s))
+    return [ (i, j) for i in range(i0, i1+1) for j in range(j0, j1+1) ]
+
+  def _segmentKeys(self, x1, y1, x2, y2):
+    'Return the keys of the cells the segment passes through, a column of cells at a time.'
+    s = self._invCellSize
+    (x1, y1, x2, y2) = (x1 * s, y1 * s, x2 * s, y2 * s)
+    if x1 > x2:
+      (x1, y1, x2, y2) = (x2, y2, x1, y1)
+    keys = []
+    for i in range(math.floor(x1), math.floor(x2) + 1):
+      if x2 == x1:
+        (ya, yb) = (y1, y2)
+      else:
+        slope = (y2 - y1) / (x2 - x1)
+        (ya, yb) = (y1 + (max(x1, i) - x1) * slope, y1 + (min(x2, i + 1) - x1) * slope)
+      keys.extend( (i, j) for j in range(math.floor(min(ya, yb)), math.floor(max(ya, yb)) + 1) )
+    return keys
+
+  def _insert(self, tile, edges):
+    cells = self._cells
+    shared = self._shared
+    indexed = []
+    for (x1, y1, x2, y2) in edges:
+      key = _EdgeKey(x1, y1, x2, y2)
+      e = (x1, y1, x2, y2, key)
+      keys = self._segmentKeys(x1, y1, x2, y2)
+      for k in keys:
+        c = cells.get(k)
+        if c is None:
+          cells[k] = c = []
+        c.append(e)
+      shared[key] = shared.get(key, 0) + 1
+      self._totalLength += math.hypot(x2 - x1, y2 - y1)
+      indexed.append((e, keys))
+    self._tileEdges[tile] = indexed
+    self._count += len(indexed)
+
+  def _remove(self, tile):
+    indexed = self._tileEdges.pop(tile, None)
+    if indexed is None: return
+    cells = self._cells
+    shared = self._shared
+    for (e, keys) in indexed:
+      for k in keys:
+        c = cells[k]
+        c.remove(e)
+        if not c:
+          del cells[k]
+      n = shared[e[4]] - 1
+      if n:
+        shared[e[4]] = n
+      else:
+        del shared[e[4]]
+      self._totalLength -= math.hypot(e[2] - e[0], e[3] - e[1])
+    self._count -= len(indexed)
+
+  def __contains__(self, tile):
+    return tile in self._tileEdges
+
+  def markDirty(self, tile):
+    'Note that the given tile has been added, removed, or moved.'
+    self._dirty.add(tile)
+
+  def clear(self):
+    self._cells = {}
+    self._tileEdges = {}
+    self._shared = {}
+    self._dirty = set()
+    self._count = 0
+    self._totalLength = 0.0
+
+  def sync(self, isIndexable):
+    '''Re-index every dirty tile.
+       isIndexable(tile) returns True if the tile's edges belong in the index.
+    '''
+    if not self._dirty: return
+    dirty = self._dirty
+    self._dirty = set()
+    for tile in dirty:
+      self._remove(tile)
+      if isIndexable(tile):
+        self._insert(tile, OrientedEdges(tile.sceneEdges()))
+
+  def near(self, x0, y0, x1, y1):
+    '''Return the open edges (x1, y1, x2, y2, key) that pass through the
+       cells the given box touches, and whose bounding boxes touch it,
+       nearest the middle of the box first (then by key, so ties are
+       always broken the same way).'''
+    cells = self._cells
+    shared = self._shared
+    found = set()
+    for k in self._cellKeys(x0, y0, x1, y1):
+      c = cells.get(k)
+      if c:
+        found.update(c)
+    (cx, cy) = ((x0 + x1) / 2, (y0 + y1) / 2)
+    return sorted( ( e for e in found
+                     if shared[e[4]] == 1 and min(e[0], e[2]) <= x1 and x0 <= max(e[0], e[2])
+                                          and min(e[1], e[3]) <= y1 and y0 <= max(e[1], e[3]) )
+                 , key=lambda e: (_SegmentDistance2(cx, cy, *e[:4]), e[4]) )
+
+def _SegmentDistance2(px, py, x1, y1, x2, y2):
+  'Return the squared distance from point (px, py) to the segment from (x1, y1) to (x2, y2).'
+  (dx, dy) = (x2 - x1, y2 - y1)
+  d2 = dx*dx + dy*dy
+  t = 0.0 if not d2 else min(1.0, max(0.0, ((px - x1)*dx + (py - y1)*dy) / d2))
+  (ex, ey) = (x1 + t*dx - px, y1 + t*dy - py)
+  return ex*ex + ey*ey
+
+def GatherEdges(edgeSeqs):
+  '''Concatenate the edges of some polygons (sequences of QLineF, such as from
+     sceneEdges()) as OrientedEdges(), leaving out those two of them share:
+     only the outline of the group can lie flush against another tile.
+  '''
+  edges = []
+  for seq in edgeSeqs:
+    edges.extend(OrientedEdges(seq))
+  counts = {}
+  for e in edges:
+    k = _EdgeKey(*e)
+    counts[k] = counts.get(k, 0) + 1
+  return [ e for e in edges if counts[_EdgeKey(*e)] == 1 ]
+
+def MapEdges(edges, t):
+  'Return edges (as from GatherEdges()) mapped by QTransform t, still running the same way around.'
+  (m11, m12, m21, m22, dx, dy) = (t.m11(), t.m12(), t.m21(), t.m22(), t.dx(), t.dy())
+  mapped = [ (x1*m11 + y1*m21 + dx, x1*m12 + y1*m22 + dy, x2*m11 + y2*m21 + dx, x2*m12 + y2*m22 + dy)
+             for (x1, y1, x2, y2) in edges ]
+  if m11*m22 - m12*m21 < 0:
+    mapped = [ (x2, y2, x1, y1) for (x1, y1, x2, y2) in mapped ]  # mirrored
+  return mapped
+
+def NearestFlushEdges(grid, edges, snap_dist, timer=None):
+  '''Return (score, a, b): the edge a of edges (from GatherEdges()) that
+     would lie flush against an open edge b of the EdgeGrid grid by moving
+     each end of it the least, no more than snap_dist.  They must run in
+     opposite directions and overlap.  Return None if there is none, or if
+     QElapsedTimer timer expires first.
+  '''
+  best = None
+  min_overlap = snap_dist / 100.0
+  for (i, a) in enumerate(edges):
+    (ax1, ay1, ax2, ay2) = a
+    for b in grid.near( min(ax1, ax2) - snap_dist, min(ay1, ay2) - snap_dist
+                      , max(ax1, ax2) + snap_dist, max(ay1, ay2) + snap_dist ):
+      (bx1, by1, bx2, by2) = b[:4]
+      length = math.hypot(bx2 - bx1, by2 - by1)
+      if not length: continue
+      (ux, uy) = ((bx2 - bx1) / length, (by2 - by1) / length)
+      if (ax2 - ax1)*ux + (ay2 - ay1)*uy >= 0:
+        continue  # not running the opposite way
+      # Distances of a's ends from the line through b.
+      d1 = (ay1 - by1)*ux - (ax1 - bx1)*uy
+      d2 = (ay2 - by1)*ux - (ax2 - bx1)*uy
+      if abs(d1) > snap_dist or abs(d2) > snap_dist:
+        continue
+      t1 = (ax1 - bx1)*ux + (ay1 - by1)*uy
+      t2 = (ax2 - bx1)*ux + (ay2 - by1)*uy
+      if min(max(t1, t2), length) - max(min(t1, t2), 0) <= min_overlap:
+        continue
+      score = abs(d1) + abs(d2)
+      if best is None or score < best[0]:
+        best = (score, a, b[:4])
+    if not timer is None and i % 64 == 63 and timer.hasExpired(SEARCH_TIMEOUT_MS):
+      return None
+  return best
+
+def FlushTransform(a, b, snap_dist, originPt=None):
+  '''Return a QTransform (in scene coordinates) that turns edge a parallel to
+     edge b, about originPt (or the middle of a), then, unless originPt is
+     given, moves it onto the line through b, and slides it along to line up
+     an end with an end of b, if that is no farther than snap_dist.
+  '''
+  (ax1, ay1, ax2, ay2) = a
+  (bx1, by1, bx2, by2) = b
+  theta = math.degrees(math.atan2(by1 - by2, bx1 - bx2) - math.atan2(ay2 - ay1, ax2 - ax1))
+  if originPt is None:
+    (ox, oy) = ((ax1 + ax2) / 2, (ay1 + ay2) / 2)
+  else:
+    (ox, oy) = (originPt.x(), originPt.y())
+  t = QtGui.QTransform.fromTranslate(ox, oy).rotate(theta).translate(-ox, -oy)
+  if not originPt is None:
+    return t
+  length = math.hypot(bx2 - bx1, by2 - by1)
+  (ux, uy) = ((bx2 - bx1) / length, (by2 - by1) / length)
+  d = (oy - by1)*ux - (ox - bx1)*uy
+  (dx, dy) = (d * uy, -d * ux)  # back onto the line
+  slide = None
+  for p in (t.map(QtCore.QPointF(ax1, ay1)), t.map(QtCore.QPointF(ax2, ay2))):
+    s = (p.x() - bx1)*ux + (p.y() - by1)*uy
+    for delta in (-s, length - s):
+      if abs(delta) <= snap_dist and (slide is None or abs(delta) < abs(slide)):
+        slide = delta
+  if not slide is None:
+    (dx, dy) = (dx + slide * ux, dy + slide * uy)
+  return t * QtGui.QTransform.fromTranslate(dx, dy)
+
+class _FakeTile(object):
+  def __init__(self, *xys):
+    self.pts = [QtCore.QPointF(*xy) for xy in xys]
+  def sceneSnapPoints(self):
+    return self.pts
+
+class TestSnapGrid(unittest.TestCase):
+
+  def test_neighbors(self):
+    g = SnapGrid(.25)
+    a = _FakeTile((0,0), (1,0), (1,1))
+    b = _FakeTile((.2,.1), (5,5))
+    for t in (a, b): g.markDirty(t)
+    g.sync(lambda t: True)
+    self.assertEqual(len(g), 5)
+    near = g.neighbors(.1, .1)
+    self.assertIn((0.0, 0.0, a), near)
+    self.assertIn((.2, .1, b), near)
+    self.assertFalse(any(e[0] == 5 for e in near))
+    # Anything within cellSize is always found.
+    for (x,y) in ((-.24,0), (.24,.24), (0,-.249)):
+      self.assertIn((0.0, 0.0, a), g.neighbors(x, y))
+
+  def test_reindex(self):
+    g = SnapGrid(.25)
+    a = _FakeTile((0,0), (1,0))
+    g.markDirty(a)
+    g.sync(lambda t: True)
+    a.pts = [QtCore.QPointF(3,3)]
+    g.markDirty(a)
+    g.sync(lambda t: True)
+    self.assertEqual(len(g), 1)
+    self.assertEqual(g.neighbors(0, 0), [])
+    self.assertEqual(len(g.neighbors(3, 3)), 1)
+    g.markDirty(a)
+    g.sync(lambda t: False)
+    self.assertEqual(len(g), 0)
+    self.assertNotIn(a, g)
+
+  def test_setCellSize(self):
+    g = SnapGrid(.25)
+    a = _FakeTile((0,0), (.9,0))
+    g.markDirty(a)
+    g.sync(lambda t: True)
+    self.assertEqual(len(g.neighbors(0, 0)), 1)
+    g.setCellSize(1)
+    self.assertEqual(len(g), 2)
+    self.assertEqual(len(g.neighbors(0, 0)), 2)
+
+class TestNearestSnapPairs(unittest.TestCase):
+
+  def setUp(self):
+    import random
+    rnd = random.Random(3)
+    self.grid = SnapGrid(.25)
+    for i in range(200):
+      t = _FakeTile(*[(rnd.uniform(0,10), rnd.uniform(0,10)) for j in range(4)])
+      self.grid.markDirty(t)
+    # Include an exact duplicate distance, to exercise ties.
+    self.grid.markDirty(_FakeTile((20,20), (20.1,20)))
+    self.grid.sync(lambda t: True)
+    self.ps = [(rnd.uniform(0,10), rnd.uniform(0,10)) for i in range(300)] + [(20.05,20)]
+
+  def test_GatherPoints(self):
+    polys = [ QtGui.QPolygonF([QtCore.QPointF(1,2), QtCore.QPointF(3,4)])
+            , (QtCore.QPointF(5,6),)
+            , QtGui.QPolygonF() ]
+    ps = GatherPoints(polys)
+    self.assertEqual([tuple(p) for p in (ps if numpy is None else ps.tolist())], [(1,2),(3,4),(5,6)])
+
+  def test_python(self):
+    r = NearestSnapPairs(self.grid, self.ps[:NUMPY_MIN_POINTS-1], .25)
+    self.assertTrue(r)
+    self.assertTrue(all(t[0] == r[0][0] and t[0] <= .25**2 for t in r))
+
+  @unittest.skipIf(numpy is None, 'NumPy not installed')
+  def test_numpy_matches_python(self):
+    global numpy
+    for exclude in (None, self.ps[5], (20,20)):
+      for ps in (self.ps, self.ps[-1:]*NUMPY_MIN_POINTS):
+        vectorized = NearestSnapPairs(self.grid, ps, .25, exclude)
+        saved, numpy = numpy, None
+        try:
+          plain = NearestSnapPairs(self.grid, ps, .25, exclude)
+        finally:
+          numpy = saved
+        self.assertTrue(plain)
+        self.assertEqual(sorted(vectorized), sorted(plain))
+
+class _FakeCornerTile(object):
+  def __init__(self, *xys):
+    poly = QtGui.QPolygonF([QtCore.QPointF(*xy) for xy in xys])
+    self.corners = [ (p.x(), p.y(), a, (la, lb)) for (p, (a, la, lb)) in zip(poly, PolygonCorners(poly)) ]
+  def sceneCorners(self):
+    return self.corners
+
+class TestCorners(unittest.TestCase):
+
+  def test_PolygonCorners(self):
+    def angles(*xys):
+      return [ round(a, 6) for (a, _la, _lb) in PolygonCorners([QtCore.QPointF(*xy) for xy in xys]) ]
+    self.assertEqual(angles((0,0), (1,0), (1,1), (0,1)), [90]*4)
+    self.assertEqual(angles((0,1), (1,1), (1,0), (0,0)), [90]*4)
+    self.assertEqual(angles((0,0), (2,0), (2,1), (1,1), (1,2), (0,2)), [90, 90, 90, 270, 90, 90])
+    h = math.sqrt(3)/2
+    self.assertEqual(angles((0,0), (1,0), (.5,h), (0,0)), [60]*3)
+    (_a, la, lb) = PolygonCorners([QtCore.QPointF(*xy) for xy in ((0,0), (2,0), (2,1), (0,1))])[1]
+    self.assertEqual((la, lb), (2, 1))
+
+  def test_SimilarityScale(self):
+    self.assertAlmostEqual(SimilarityScale(QtGui.QTransform().rotate(30).scale(2,2).translate(5,6)), 2)
+    self.assertAlmostEqual(SimilarityScale(QtGui.QTransform().scale(-3,3).rotate(10)), 3)
+    self.assertIsNone(SimilarityScale(QtGui.QTransform().scale(1,2)))
+    self.assertIsNone(SimilarityScale(QtGui.QTransform().shear(.5,0)))
+
+  def test_CornerGrid(self):
+    g = CornerGrid(.25)
+    squares = [ _FakeCornerTile((x,y), (x+1,y), (x+1,y+1), (x,y+1)) for (x, y) in ((0,0), (1,0), (0,1)) ]
+    for t in squares: g.markDirty(t)
+    g.sync(lambda t: True)
+    self.assertEqual(len(g), 8)  # the corners at (1,1), (1,0) and (0,1) are shared
+    gaps = { (v.x, v.y): v.gap for c in g._cells.values() for v in c }
+    self.assertEqual(gaps[(1,1)], 90)
+    self.assertEqual(gaps[(1,2)], 270)
+    # Only a square corner fits the remaining gap at (1,1); one at (1.1,1.1) snaps there.
+    corner = [ (1.1, 1.1, 90.0, (1.0, 1.0)) ]
+    self.assertEqual(NearestCornerPairs(g, corner, .25)[0][2], (1, 1))
+    self.assertEqual(NearestCornerPairs(g, [ (1.1, 1.1, 120.0, (1.0, 1.0)) ], .25), [])
+    g.markDirty(squares[1])
+    g.sync(lambda t: False)
+    self.assertEqual(len(g), 6)
+    self.assertEqual({ (v.x, v.y): v.gap for v in g.neighbors(1, 1) }[(1,1)], 180)
+    self.assertNotIn(squares[1], g)
+
+  def setUpTriangles(self):
+    import random
+    rnd = random.Random(5)
+    g = CornerGrid(.25)
+    h = math.sqrt(3)/2
+    for i in range(20):
+      for j in range(20):
+        (x, y) = (i + (j % 2) / 2, j * h)
+        for t in ( _FakeCornerTile((x,y), (x+1,y), (x+.5,y+h))
+                 , _FakeCornerTile((x+1,y), (x+1.5,y+h), (x+.5,y+h)) ):
+          g.markDirty(t)
+    g.sync(lambda t: True)
+    # Half near the bottom edge, where the vertices have a 180 degree gap.
+    corners = [ (rnd.uniform(0,20), rnd.choice((rnd.uniform(-.2,.2), rnd.uniform(0,17))), rnd.choice((60.0, 90.0, 240.0))
+               , (rnd.choice((1.0, 2.0)),)) for k in range(300) ]
+    return (g, corners)
+
+  def test_python(self):
+    (g, corners) = self.setUpTriangles()
+    # Interior vertices are surrounded, so only those along the edges have gaps.
+    self.assertTrue(all( v.gap <= 1e-6 for c in g._cells.values() for v in c
+                         if 2 < v.x < 19 and 1 < v.y < 16 ))
+    self.assertTrue(NearestCornerPairs(g, corners[:NUMPY_MIN_POINTS-1], .25))
+
+  @unittest.skipIf(numpy is None, 'NumPy not installed')
+  def test_numpy_matches_python(self):
+    global numpy
+    (g, corners) = self.setUpTriangles()
+    for exclude in (None, corners[3][:2]):
+      vectorized = NearestCornerPairs(g, corners, .25, exclude)
+      saved, numpy = numpy, None
+      try:
+        plain = NearestCornerPairs(g, corners, .25, exclude)
+      finally:
+        numpy = saved
+      self.assertTrue(plain)
+      self.assertEqual(sorted(vectorized), sorted(plain))
+
+
+class _FakeEdgeTile(object):
+  def __init__(self, *xys):
+    poly = QtGui.QPolygonF([QtCore.QPointF(*xy) for xy in xys])
+    self.edges = [ QtCore.QLineF(poly[k-1], poly[k]) for k in range(len(poly)) ]
+  def sceneEdges(self):
+    return self.edges
+
+class TestEdges(unittest.TestCase):
+
+  def square(self, x, y, xform=QtGui.QTransform()):
+    return _FakeEdgeTile(*[ (p.x(), p.y()) for p in
+                            (xform.map(QtCore.QPointF(*xy)) for xy in ((x,y), (x+1,y), (x+1,y+1), (x,y+1))) ])
+
+  def test_OrientedEdges(self):
+    cw = OrientedEdges(self.square(0, 0).sceneEdges())
+    ccw = OrientedEdges(_FakeEdgeTile((0,0), (0,1), (1,1), (1,0)).sceneEdges())
+    self.assertEqual(sorted(cw), sorted(ccw))
+    self.assertEqual(_EdgeKey(0, 0, 1, 0), _EdgeKey(1, 0, 0, 0))
+    self.assertEqual(len(GatherEdges([self.square(0, 0).sceneEdges(), self.square(1, 0).sceneEdges()])), 6)
+    mirrored = MapEdges(cw, QtGui.QTransform().scale(-1, 1))
+    self.assertEqual(sorted(mirrored), sorted(OrientedEdges(self.square(-1, 0).sceneEdges())))
+
+  def test_EdgeGrid(self):
+    g = EdgeGrid(.5)
+    squares = [ self.square(x, y) for (x, y) in ((0,0), (1,0), (0,1)) ]
+    for t in squares: g.markDirty(t)
+    g.sync(lambda t: True)
+    self.assertEqual(len(g), 12)
+    # The edge between the first two squares is shared, so nothing can lie flush against it.
+    self.assertEqual(g.near(.9, .2, 1.1, .8), [])
+    self.assertEqual(len(g.near(1.2, .9, 1.8, 1.1)), 1)
+    # A square dragged near the notch fits flush into it, corner to corner.
+    t = QtGui.QTransform.fromTranslate(1.5, 1.5).rotate(5).translate(-1.5, -1.5).translate(.05, .1)
+    edges = GatherEdges([self.square(1, 1, t).sceneEdges()])
+    (score, a, b) = NearestFlushEdges(g, edges, .25)
+    self.assertLess(score, .25)
+    flush = FlushTransform(a, b, .25)
+    for (p, xy) in zip(self.square(1, 1, t * flush).edges, ((1,1), (2,1), (2,2), (1,2))):
+      self.assertAlmostEqual(p.p2().x(), xy[0])
+      self.assertAlmostEqual(p.p2().y(), xy[1])
+    self.assertIsNone(NearestFlushEdges(g, GatherEdges([self.square(3, 3).sceneEdges()]), .25))
+    g.markDirty(squares[1])
+    g.sync(lambda t: False)
+    self.assertEqual(len(g), 8)
+    self.assertNotIn(squares[1], g)
+    self.assertEqual(len(g.near(.9, .2, 1.1, .8)), 1)
+
+  def test_EdgeGridCells(self):
+    g = EdgeGrid(1.0)
+    diagonal = _FakeEdgeTile((0,0), (10,10), (0,.1))
+    g.markDirty(diagonal)
+    g.sync(lambda t: True)
+    (e, keys) = [ ek for ek in g._tileEdges[diagonal] if ek[0][:4] in ((0,0,10,10), (10,10,0,0)) ][0]
+    self.assertLessEqual(len(keys), 31)  # only along the diagonal, not all 121 cells of its bounding box
+    self.assertEqual(len(g.near(4.9, 5.1, 5.1, 5.3)), 2)
+    self.assertAlmostEqual(g.meanLength(), (math.hypot(10, 10) + math.hypot(10, 9.9) + .1) / 3)
+    g.setCellSize(.25)
+    self.assertEqual(len(g), 3)
+    self.assertEqual(len(g.near(4.9, 5.1, 5.1, 5.3)), 2)
+    # Equally near edges always come in the same order.
+    g = EdgeGrid(1.0)
+    for t in (self.square(0, 0), self.square(1, 1)):
+      g.markDirty(t)
+    g.sync(lambda t: True)
+    found = g.near(.9, .9, 1.1, 1.1)
+    self.assertEqual(len(found), 4)
+    self.assertEqual(found, sorted(found, key=lambda e: e[4]))
+
+if __name__=='__main__': unittest.main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+import math, mmap, os, unittest
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import QRectF
+from PyQt5.QtGui import QPolygonF, QTransform
+
+try:
+  import numpy
+except ImportError:
+  numpy = None  # without numpy, documents are always loaded in full
+
+import tilesfile
+
+LAZY_LOAD_TILES = 20000  # open .tiles files with at least this many tiles lazily
+
+if not numpy is None:
+  # One tilesfile.TILE record.
+  RECORD_DTYPE = numpy.dtype(
+    [ ('shape', '<u4'), ('type', 'u1'), ('penroseShape', 'u1'), ('pad', 'V2')
+    , ('matrix', '<f8', (6,)), ('rgba', 'u1', (4,)), ('penroseSize', '<f8') ])
+  assert RECORD_DTYPE.itemsize == tilesfile.TILE.size
+
+def PackRecords(records, promoted, shapeMap):
+  '''Return the records not marked promoted as TILE records (bytes),
+     with shape indices translated by the sequence shapeMap.'''
+  recs = records[~promoted]  # a copy
+  recs['shape'] = numpy.asarray(shapeMap, dtype=numpy.uint32)[recs['shape']]
+  return recs.tobytes()
+
+class TileStore(object):
+  '''The tiles of a memory-mapped .tiles document, kept as compact records
+     rather than as QGraphicsItems.
+     Records are indexed by a uniform grid, keyed on the cell of each
+     record's bounding box center; queries widen their rect by the largest
+     half-extent so nothing overlapping is missed.
+     A record can be promoted to a real TileItem (for the scene to own),
+     and, if the item is still exactly as it was, demoted again later.
+     The store paints only the records that aren't promoted.
+  '''
+
+  PAINT_LIMIT = 20000  # beyond this many records in view, paint averaged grid cells instead
+
+  def __init__(self, logger, f):
+    'f is a binary .tiles file object, which the store takes over and closes.'
+    self._log = logger
+    self._file = f
+    self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._buffer = self._mm  # where the records are: the mapped file, or a copy once detach()ed
+    self._reader = tilesfile.TilesReader(logger)
+    n = self._reader.readHeader(self._mm)
+    self._offset = offset = self._mm.tell()
+    if offset + n * RECORD_DTYPE.itemsize > len(self._mm):
+      self.close()
+      raise ValueError('truncated .tiles file')
+    self._records = numpy.frombuffer(self._mm, dtype=RECORD_DTYPE, count=n, offset=offset)
+    if n and int(self._records['shape'].max()) >= len(self._reader.shapes()):
+      self.close()
+      raise ValueError('.tiles shape index out of range')
+    self._promoted = numpy.zeros(n, dtype=numpy.bool_)  # promoted (or since deleted) records
+    self._items = {}   # record index -> promoted item
+    self._brushes = {} # packed RGBA -> QBrush
+    self.buildIndex()
+
+  def __len__(self):
+    'Return the number of records not promoted.'
+    return len(self._records) - int(numpy.count_nonzero(self._promoted))
+
+  def close(self):
+    self._records = None  # release the buffer before unmapping
+    self._buffer = None
+    self._unmap()
+
+  def _unmap(self):
+    if self._mm is None:
+      return
+    try:
+      self._mm.close()
+    except BufferError:
+      pass  # something still refers to it; it will be unmapped when that's collected
+    self._mm = None
+    self._file.close()
+
+  def isMapping(self, path):
+    'Return whether the store still maps the file at path.'
+    if self._mm is None:
+      return False
+    try:
+      return os.path.samestat(os.fstat(self._file.fileno()), os.stat(path))
+    except OSError:
+      return False
+
+  def detach(self):
+    '''Copy the records into memory and close the file, so that it can be
+       replaced, such as by saving over it.  (Windows can't replace a mapped file.)'''
+    if self._mm is None:
+      return
+    n = len(self._records)
+    buf = self._mm[self._offset : self._offset + n * RECORD_DTYPE.itemsize]
+    self._records = numpy.frombuffer(buf, dtype=RECORD_DTYPE, count=n)
+    (self._buffer, self._offset) = (buf, 0)
+    self._unmap()
+
+  def shapes(self):
+    'Return the shape table: a QPolygonF or (for ellipses) QRectF per shape index.'
+    return self._reader.shapes()
+
+  def buildIndex(self):
+    shapes = self.shapes()
+    sb = numpy.array([ (s if isinstance(s, QRectF) else s.boundingRect()).getCoords()
+                       for s in shapes ], dtype=numpy.float64).reshape(-1, 4)
+    if not len(self._records):
+      self._bounds = numpy.zeros((0, 4), dtype=numpy.float32)
+      self._cellSize = 1.0
+      self._keys = numpy.zeros(0, dtype=numpy.int64)
+      self._order = numpy.zeros(0, dtype=numpy.int64)
+      self._reach = 0.0
+      self._origin = (0.0, 0.0)
+      self._width = 1
+      self._height = 1
+      return
+    # Map each shape's bounding box corners through each record's matrix.
+    m = self._records['matrix']
+    b = sb[self._records['shape']]
+    xs = [ m[:,0]*x + m[:,2]*y + m[:,4] for (x,y) in ((b[:,0],b[:,1]), (b[:,2],b[:,1]), (b[:,0],b[:,3]), (b[:,2],b[:,3])) ]
+    ys = [ m[:,1]*x + m[:,3]*y + m[:,5] for (x,y) in ((b[:,0],b[:,1]), (b[:,2],b[:,1]), (b[:,0],b[:,3]), (b[:,2],b[:,3])) ]
+    bounds = numpy.empty((len(m), 4), dtype=numpy.float32)
+    bounds[:,0] = numpy.minimum.reduce(xs)
+    bounds[:,1] = numpy.minimum.reduce(ys)
+    bounds[:,2] = numpy.maximum.reduce(xs)
+    bounds[:,3] = numpy.maximum.reduce(ys)
+    self._bounds = bounds
+    extent = numpy.maximum(bounds[:,2] - bounds[:,0], bounds[:,3] - bounds[:,1])
+    self._cellSize = max(4 * float(numpy.median(extent)), 1e-3)
+    self._reach = float(extent.max()) / 2
+    self._origin = (float(bounds[:,0].min()), float(bounds[:,1].min()))
+    self._width = int((bounds[:,2].max() - self._origin[0]) / self._cellSize) + 2
+    self._height = int((bounds[:,3].max() - self._origin[1]) / self._cellSize) + 2
+    keys = self.cellKeys((bounds[:,0] + bounds[:,2]) / 2, (bounds[:,1] + bounds[:,3]) / 2)
+    self._order = numpy.argsort(keys, kind='stable')
+    self._keys = keys[self._order]
+
+  def cellKeys(self, x, y):
+    ix = ((x - self._origin[0]) / self._cellSize).astype(numpy.int64)
+    iy = ((y - self._origin[1]) / self._cellSize).astype(numpy.int64)
+    return iy * self._width + ix
+
+  def bounds(self):
+    'Return the bounding rect of all the records (promoted or not).'
+    if not len(self._bounds):
+      return QRectF()
+    b = self._bounds
+    return QRectF(QtCore.QPointF(b[:,0].min(), b[:,1].min()), QtCore.QPointF(b[:,2].max(), b[:,3].max()))
+
+  def indicesIn(self, rect):
+    'Return an array of the indices of unpromoted records whose bounds intersect rect.'
+    if not len(self._keys) or rect.isEmpty():
+      return numpy.zeros(0, dtype=numpy.int64)
+    r = self._reach
+    (x0, y0) = (rect.left() - r - self._origin[0], rect.top() - r - self._origin[1])
+    (x1, y1) = (rect.right() + r - self._origin[0], rect.bottom() + r - self._origin[1])
+    c = self._cellSize
+    ix0 = max(0, int(x0 // c))
+    ix1 = min(self._width - 1, int(x1 // c))
+    iy0 = max(0, int(y0 // c))
+    iy1 = min(self._height - 1, int(y1 // c))
+    if ix0 > ix1 or iy1 < iy0:
+      return numpy.zeros(0, dtype=numpy.int64)
+    # Each row of cells is one contiguous run of the sorted keys.
+    rows = numpy.arange(iy0, iy1 + 1, dtype=numpy.int64) * self._width
+    starts = numpy.searchsorted(self._keys, rows + ix0, 'left')
+    ends = numpy.searchsorted(self._keys, rows + ix1, 'right')
+    if len(rows) == 1:
+      idx = self._order[starts[0]:ends[0]]
+    else:
+      idx = numpy.concatenate([ self._order[s:e] for (s,e) in zip(starts, ends) if e > s ] or [numpy.zeros(0, dtype=numpy.int64)])
+    b = self._bounds[idx]
+    keep = ( (b[:,2] >= rect.left()) & (b[:,0] <= rect.right())
+           & (b[:,3] >= rect.top()) & (b[:,1] <= rect.bottom()) & ~self._promoted[idx] )
+    return idx[keep]
+
+  def allIndices(self):
+    return numpy.flatnonzero(~self._promoted)
+
+  def record(self, i):
+    return tilesfile.TileRecord(tilesfile.TILE.unpack_from(self._buffer, self._offset + i * tilesfile.TILE.size))
+
+  def records(self):
+    'Yield a TileRecord for each unpromoted record.'
+    for i in self.allIndices():
+      yield self.record(int(i))
+
+  def recordBounds(self, i):
+    return QRectF(QtCore.QPointF(*self._bounds[i][:2]), QtCore.QPointF(*self._bounds[i][2:]))
+
+  def promote(self, i):
+    'Return a new TileItem for record i, which the store will no longer paint.'
+    it = self._reader.newItem(self.record(i))
+    self._promoted[i] = True
+    self._items[i] = it
+    return it
+
+  def promotedItems(self):
+    'Return (record index, item) pairs of the items promoted, and not since deleted.'
+    return list(self._items.items())
+
+  def forget(self, i):
+    'Consider promoted record i to be gone for good, such as when its item has been deleted.'
+    self._items.pop(i, None)
+
+  def isUnchanged(self, i, it):
+    'Return whether promoted item it is still just as record i describes it.'
+    r = self.record(i)
+    return ( it.parentItem() is None and not it.isSelected()
+             and it.pos().isNull() and it.transform() == r.transform()
+             and it.color().getRgb() == tuple(r.rgba) )
+
+  def demote(self, i):
+    'Forget the item promoted from record i; the store paints the record again.'
+    del self._items[i]
+    self._promoted[i] = False
+
+  def packRecords(self, shapeMap):
+    '''Return the unpromoted records as TILE records (bytes),
+       with shape indices translated by the sequence shapeMap.'''
+    return PackRecords(self._records, self._promoted, shapeMap)
+
+  def snapshot(self):
+    '''Return (records, promoted) arrays for PackRecords() that stay valid,
+       and can be used from another thread, even after the store is closed.'''
+    return (self._records, self._promoted.copy())
+
+  def brush(self, rgba):
+    b = self._brushes.get(rgba)
+    if b is None:
+      b = self._brushes[rgba] = QtGui.QBrush(QtGui.QColor(*rgba))
+    return b
+
+  def paint(self, painter, rect, pen, fill=True):
+    'Paint the unpromoted records within rect (in scene coordinates), just outlined unless fill.'
+    idx = self.indicesIn(rect)
+    if not len(idx):
+      return
+    painter.save()
+    if len(idx) > self.PAINT_LIMIT and fill:
+      self.paintOverview(painter, idx)
+    else:
+      shapes = self.shapes()
+      world = painter.worldTransform()
+      painter.setPen(pen)
+      painter.setBrush(QtCore.Qt.NoBrush)
+      recs = self._records[idx]
+      for (shape, matrix, rgba) in zip(recs['shape'].tolist(), recs['matrix'].tolist(), recs['rgba'].tolist()):
+        painter.setWorldTransform(QTransform(*matrix) * world)
+        if fill:
+          painter.setBrush(self.brush(tuple(rgba)))
+        s = shapes[shape]
+        if isinstance(s, QRectF):
+          painter.drawEllipse(s)
+        else:
+          painter.drawPolygon(s)
+    painter.restore()
+
+  def paintOverview(self, painter, idx):
+    'Paint each grid cell (or block of cells) at least 4 pixels wide with the average color of its records.'
+    lod = QtWidgets.QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+    k = max(1, math.ceil(4 / (self._cellSize * max(lod, 1e-9))))
+    b = self._bounds[idx]
+    keys = self.cellKeys((b[:,0] + b[:,2]) / 2, (b[:,1] + b[:,3]) / 2)
+    (iy, ix) = (keys // self._width // k, keys % self._width // k)
+    blocks = iy * (self._width // k + 1) + ix
+    (blocks, first, inverse, counts) = numpy.unique(blocks, return_index=True, return_inverse=True, return_counts=True)
+    rgba = self._records['rgba'][idx].astype(numpy.float64)
+    means = numpy.stack([ numpy.bincount(inverse, weights=rgba[:,c]) / counts for c in range(4) ], axis=1)
+    span = self._cellSize * k
+    for (x, y, color) in zip(ix[first].tolist(), iy[first].tolist(), means.astype(numpy.int64).tolist()):
+      painter.fillRect(QRectF(self._origin[0] + x * span, self._origin[1] + y * span, span, span), QtGui.QColor(*color))
+
+class TestTileStore(unittest.TestCase):
+
+  def setUp(self):
+    import tempfile, tilelog, tileitems
+    from tileitems import PolygonTileItem, Polyomino
+    self.logger = tilelog.NotLogger()
+    tileitems.logger = self.logger
+    self.tiles = []
+    for i in range(30):
+      for j in range(20):
+        it = PolygonTileItem(polygon=Polyomino([[1]]), color=QtGui.QColor(i, j, 0))
+        it.setPos(i, j)
+        self.tiles.append(it)
+    self.f = tempfile.TemporaryFile()
+    tilesfile.WriteTiles(self.f, self.tiles)
+    self.f.seek(0)
+
+  @unittest.skipIf(numpy is None, 'requires numpy')
+  def test_query(self):
+    store = TileStore(self.logger, self.f)
+    self.assertEqual(len(store), 600)
+    self.assertEqual(store.bounds(), QRectF(-.5, -.5, 30, 20))
+    idx = store.indicesIn(QRectF(9.4, 4.4, .2, .2))  # touches the tiles centered on (9,4), (10,5) & between
+    self.assertEqual(sorted(store.record(i).rgba[:2] for i in idx), [(9,4), (9,5), (10,4), (10,5)])
+    it = store.promote(int(idx[0]))
+    self.assertEqual(len(store), 599)
+    self.assertEqual(len(store.indicesIn(QRectF(9.4, 4.4, .2, .2))), 3)
+    self.assertTrue(store.isUnchanged(int(idx[0]), it))
+    it.setColor(QtGui.QColor(1,2,3))
+    self.assertFalse(store.isUnchanged(int(idx[0]), it))
+    store.demote(int(idx[0]))
+    self.assertEqual(len(store.indicesIn(QRectF(-100, -100, 200, 200))), 600)
+    # Rows of cells beyond the records aren't visited.
+    self.assertEqual(len(store.indicesIn(QRectF(-100, -1e12, 200, 2e12))), 600)
+    self.assertEqual(len(store.indicesIn(QRectF(0, 1e6, 10, 1e12))), 0)
+    store.close()
+
+  @unittest.skipIf(numpy is None, 'requires numpy')
+  def test_detach(self):
+    store = TileStore(self.logger, self.f)
+    rgba = [ tuple(store.record(i).rgba) for i in range(len(store)) ]
+    store.detach()
+    self.assertTrue(self.f.closed)
+    self.assertEqual([ tuple(store.record(i).rgba) for i in range(len(store)) ], rgba)
+    self.assertEqual(len(store.indicesIn(QRectF(9.4, 4.4, .2, .2))), 4)
+    store.close()
+
+class TestSaveInPlace(unittest.TestCase):
+
+  @unittest.skipIf(numpy is None, 'requires numpy')
+  def test_SaveLazilyOpened(self):
+    import tempfile, tilelog, tileitems, tilemain
+    from tileitems import PolygonTileItem, Polyomino
+    tileitems.logger = tilelog.NotLogger()
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([__file__])
+    QtCore.QStandardPaths.setTestModeEnabled(True)
+    critical = QtWidgets.QMessageBox.critical
+    QtWidgets.QMessageBox.critical = lambda parent, title, text: self.fail(text)
+    lazyLoadTiles = tilemain.tilestore.LAZY_LOAD_TILES  # this module may be __main__
+    tilemain.tilestore.LAZY_LOAD_TILES = 100
+    try:
+      with tempfile.TemporaryDirectory() as d:
+        name = os.path.join(d, 'lazy.tiles')
+        tiles = [ PolygonTileItem(polygon=Polyomino([[1]])) for k in range(300) ]
+        for (k, it) in enumerate(tiles):
+          it.setPos(k % 20, k // 20)
+        with open(name, 'wb') as f:
+          tilesfile.WriteTiles(f, tiles)
+        w = tilemain.MagneticTilesMainWindow(tilelog.NotLogger())
+        w.newDocument()
+        self.assertTrue(w.openLazily(name))
+        store = w.scene.tileStore()
+        self.assertTrue(store.isMapping(name))
+        w.scene.promoteStoredTiles(QRectF(-1, -1, 2, 2), 10)
+        w.scene.PROMOTE_LIMIT = 100
+        self.assertFalse(w.scene.setSelectionAll())  # too many to promote
+        self.assertTrue(0 < w.scene.numSelected() <= 10)  # just those promoted
+        self.assertTrue(w.saveTo(name))
+        self.assertFalse(store.isMapping(name))
+        saved = TileStore(tilelog.NotLogger(), open(name, 'rb'))
+        self.assertEqual(len(saved), 300)
+        saved.close()
+        w.scene.setTileStore(None)
+        w.autoSaver.stop()
+        w.autoSaver.ring().discard()
+    finally:
+      tilemain.tilestore.LAZY_LOAD_TILES = lazyLoadTiles
+      QtWidgets.QMessageBox.critical = critical
+      QtCore.QStandardPaths.setTestModeEnabled(False)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+'''Undo and redo.
+
+A TileScene's UndoStack records each change as a compact delta, never as
+a copy of the whole document:  tiles are referred to by integer ids,
+their transformations are kept as 6 doubles each (m11 m12 m21 m22 dx dy,
+with the tile's pos folded into dx dy), their colors as packed ARGB ints,
+and tiles added or removed as references to the items themselves.
+'''
+
+import array, collections, contextlib, weakref, unittest
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+UNDO_MEMORY_LIMIT = 32 * 1024 * 1024  # default most bytes of history to keep
+ITEM_BYTES = 1024     # rough cost of keeping an added or removed tile alive for history
+BULK_TILES = 1000     # suspend the scene's index while undoing changes to more tiles than this
+
+def PackTransforms(tiles):
+  'Return an array of 6 doubles per tile: its transform, with its pos folded in.'
+  values = array.array('d')
+  for it in tiles:
+    t = it.transform()
+    p = it.pos()
+    values.extend((t.m11(), t.m12(), t.m21(), t.m22(), t.dx() + p.x(), t.dy() + p.y()))
+  return values
+
+def PackColors(tiles):
+  'Return an array of the ARGB color of each tile.'
+  return array.array('I', [ it.color().rgba() for it in tiles ])
+
+def UnpackTransforms(tiles, values):
+  'Set the transform (and pos) of each tile (or None) from an array made by PackTransforms().'
+  for (k, it) in enumerate(tiles):
+    if not it is None:
+      it.setPos(0, 0)
+      it.setTransform(QtGui.QTransform(*values[6*k : 6*k+6]))
+
+def UnpackColors(tiles, values):
+  for (it, rgba) in zip(tiles, values):
+    if not it is None:
+      it.setColor(QtGui.QColor.fromRgba(rgba))
+
+class UndoEntry(object):
+  'One undoable change: the state of some tiles before and after, and any tiles added or removed.'
+  __slots__ = ('name', 'coalesce', 'ids', 'before', 'after', 'beforeColors', 'afterColors', 'added', 'removed')
+
+  def __init__(self, name, coalesce=None):
+    self.name = name
+    self.coalesce = coalesce  # consecutive entries with the same (not None) value, for the same tiles, merge
+    self.ids = array.array('Q')
+    self.before = self.after = None              # PackTransforms() of the tiles with ids
+    self.beforeColors = self.afterColors = None  # PackColors() of the tiles with ids
+    self.added = []
+    self.removed = []
+
+  def __bool__(self):
+    return bool(self.before or self.beforeColors or self.added or self.removed)
+
+  def nbytes(self):
+    'Return roughly how much memory this entry keeps in use.'
+    n = 0
+    for a in (self.ids, self.before, self.after, self.beforeColors, self.afterColors):
+      if not a is None:
+        n += a.itemsize * len(a)
+    return n + ITEM_BYTES * (len(self.added) + len(self.removed))
+
+  def canMerge(self, later):
+    return ( not self.coalesce is None and self.coalesce == later.coalesce
+             and not (self.added or self.removed or later.added or later.removed)
+             and (self.before is None) == (later.before is None)
+             and (self.beforeColors is None) == (later.beforeColors is None)
+             and self.ids == later.ids )
+
+  def merge(self, later):
+    'Absorb a later change to the same tiles (for which canMerge() is True).'
+    if self.name != later.name:
+      self.name = 'Transform'
+    self.after = later.after
+    self.afterColors = later.afterColors
+
+class UndoStack(QtCore.QObject):
+  '''The undo history of a TileScene.
+     Changes to tiles' transforms and colors are recorded by doing them within
+     a record() context.  Tiles added to or removed from the scene are noticed
+     from tileChanged.  Changes made while suspended() are not recorded.
+     The oldest entries are discarded to keep the history within a memory limit.
+  '''
+
+  # The entries available to undo or redo changed.
+  changed = QtCore.pyqtSignal()
+
+  def __init__(self, scene):
+    super().__init__(scene)
+    self._scene = scene
+    self._undo = collections.deque()  # UndoEntry, oldest first
+    self._redo = []                   # UndoEntry, most recently undone last
+    self._nbytes = 0
+    self._limit = UNDO_MEMORY_LIMIT
+    self._suspended = 0
+    self._open = None        # the UndoEntry being record()ed
+    self._mayMerge = False   # whether the next entry may be merged into the last
+    self._ids = weakref.WeakKeyDictionary()    # tile -> id
+    self._tiles = weakref.WeakValueDictionary()  # id -> tile
+    self._refs = collections.Counter()         # id -> number of entries in the history with it
+    self._nextId = 0
+    scene.tileChanged.connect(self.noteChange)
+
+  def idOf(self, tile):
+    i = self._ids.get(tile)
+    if i is None:
+      i = self._ids[tile] = self._nextId
+      self._tiles[i] = tile
+      self._nextId += 1
+    return i
+
+  def isTracked(self, tile):
+    'Return whether any history refers to tile.'
+    return tile in self._ids and self._refs[self._ids[tile]] > 0
+
+  def _retain(self, entry):
+    'Note that entry, now in the history, refers to its tiles by id.'
+    self._refs.update(entry.ids)
+
+  def _release(self, entry):
+    'Note that entry has left the history.'
+    self._refs.subtract(entry.ids)
+    self._forget(entry.ids)
+
+  def _forget(self, ids):
+    'Drop those of ids that no entry in the history refers to.'
+    for i in set(ids):
+      if self._refs[i] <= 0:
+        del self._refs[i]
+        tile = self._tiles.pop(i, None)
+        if not tile is None:
+          self._ids.pop(tile, None)
+
+  def clear(self):
+    'Forget all history, such as when a document is opened.'
+    self._undo.clear()
+    self._redo.clear()
+    self._ids.clear()
+    self._tiles.clear()
+    self._refs.clear()
+    self._nbytes = 0
+    self._mayMerge = False
+    self.changed.emit()
+
+  def memoryLimit(self):
+    return self._limit
+
+  def setMemoryLimit(self, nbytes):
+    self._limit = nbytes
+    self.evict()
+
+  def memoryUsed(self):
+    return self._nbytes
+
+  def canUndo(self): return bool(self._undo)
+  def canRedo(self): return bool(self._redo)
+  def undoText(self): return self._undo[-1].name if self._undo else ''
+  def redoText(self): return self._redo[-1].name if self._redo else ''
+
+  @contextlib.contextmanager
+  def suspended(self):
+    'A context in which changes are not recorded.'
+    self._suspended += 1
+    try:
+      yield
+    finally:
+      self._suspended -= 1
+
+  @contextlib.contextmanager
+  def record(self, name, tiles, transforms=True, colors=False, coalesce=None):
+    '''A context for making an undoable change:
+         with scene.undoStack.record('Rotate', tiles):
+           for it in tiles: ...
+       The transforms and/or colors of tiles before and after are recorded as
+       one entry, along with any tiles added or removed (and tileChanged) meanwhile.
+       A record() within another is just part of the outer one.
+    '''
+    if self._suspended or not self._open is None:
+      yield
+      return
+    tiles = list(tiles)
+    entry = UndoEntry(name, coalesce)
+    entry.ids.extend(self.idOf(it) for it in tiles)
+    if transforms:
+      entry.before = PackTransforms(tiles)
+    if colors:
+      entry.beforeColors = PackColors(tiles)
+    self._open = entry
+    try:
+      yield
+    finally:
+      self._open = None
+    if transforms:
+      entry.after = PackTransforms(tiles)
+      if entry.after == entry.before:
+        entry.before = entry.after = None
+    if colors:
+      entry.afterColors = PackColors(tiles)
+      if entry.afterColors == entry.beforeColors:
+        entry.beforeColors = entry.afterColors = None
+    ids = entry.ids
+    if entry.before is None and entry.beforeColors is None:
+      entry.ids = array.array('Q')
+    self.push(entry)
+    self._forget(ids)  # if nothing changed, or merged into the last entry
+
+  @QtCore.pyqtSlot(object)
+  def noteChange(self, change):
+    if self._suspended:
+      return
+    # Only tiles are undoable, not the selectionGroup and such.
+    added = [ it for it in change.added if hasattr(it, 'sceneSnapPoints') ]
+    removed = [ it for it in change.removed if hasattr(it, 'sceneSnapPoints') ]
+    if not (added or removed):
+      return
+    entry = self._open
+    if entry is None:
+      entry = UndoEntry('Add' if added else 'Delete')
+    entry.added.extend(added)
+    entry.removed.extend(removed)
+    if not entry is self._open:
+      self.push(entry)
+
+  def push(self, entry):
+    if not entry:
+      return
+    if self._mayMerge and self._undo and self._undo[-1].canMerge(entry):
+      top = self._undo[-1]
+      self._nbytes -= top.nbytes()
+      top.merge(entry)
+      self._nbytes += top.nbytes()
+    else:
+      self._undo.append(entry)
+      self._nbytes += entry.nbytes()
+      self._retain(entry)
+    # Only now that entry holds its tiles' ids may those of the redo entries be dropped.
+    for e in self._redo:
+      self._nbytes -= e.nbytes()
+      self._release(e)
+    self._redo.clear()
+    self._mayMerge = True
+    self.evict()
+    self.changed.emit()
+
+  def evict(self):
+    'Discard the oldest history until within the memory limit (but always keep the latest entry).'
+    while self._nbytes > self._limit and len(self._undo) + len(self._redo) > 1:
+      entry = self._undo.popleft() if self._undo else self._redo.pop(0)
+      self._nbytes -= entry.nbytes()
+      self._release(entry)
+
+  @QtCore.pyqtSlot()
+  def undo(self):
+    if self._undo:
+      entry = self._undo.pop()
+      self.apply(entry, False)
+      self._redo.append(entry)
+      self._mayMerge = False
+      self.changed.emit()
+
+  @QtCore.pyqtSlot()
+  def redo(self):
+    if self._redo:
+      entry = self._redo.pop()
+      self.apply(entry, True)
+      self._undo.append(entry)
+      self._mayMerge = False
+      self.changed.emit()
+
+  def apply(self, entry, forward):
+    'Redo (if forward) or undo entry, all in one batch.'
+    scene = self._scene
+    group = scene.selectionGroup
+    group.cancelDrag()
+    (add, remove) = (entry.added, entry.removed) if forward else (entry.removed, entry.added)
+    transforms = entry.after if forward else entry.before
+    colors = entry.afterColors if forward else entry.beforeColors
+    tiles = [ self._tiles.get(i) for i in entry.ids ]
+    tiles = [ it if not it is None and it.scene() is scene else None for it in tiles ]
+    with self.suspended(), scene.batch(suspendIndex=len(tiles) + len(add) + len(remove) > BULK_TILES):
+      if remove:
+        group.removeTiles(remove)
+        for it in remove:
+          scene.removeItem(it)
+        scene.recordChange(removed=remove)
+      for it in add:
+        QtWidgets.QGraphicsItem.setSelected(it, False)
+        scene.addItem(it)
+      if not transforms is None:
+        UnpackTransforms(tiles, transforms)
+      if not colors is None:
+        UnpackColors(tiles, colors)
+      modified = [ it for it in tiles if not it is None ]
+      if any(it.group() is group for it in modified):
+        group.refreshBoundingRect()
+        group.flushShape()
+      scene.recordChange(modified=modified)
+
+class TestUndoEntry(unittest.TestCase):
+
+  def setUp(self):
+    import tilelog, tileitems
+    tileitems.logger = tilelog.NotLogger()
+
+  def test_PackTransforms(self):
+    from tileitems import PolygonTileItem, RegularPolygon
+    a = PolygonTileItem(polygon=RegularPolygon(4))
+    a.setTransform(QtGui.QTransform().rotate(30))
+    a.setPos(5, -6)
+    t = a.sceneTransform()
+    values = PackTransforms([a])
+    self.assertEqual(len(values), 6)
+    b = PolygonTileItem(polygon=RegularPolygon(4))
+    UnpackTransforms([b, None], values)
+    self.assertEqual(b.sceneTransform(), t)
+    b.setColor(QtGui.QColor(1,2,3,4))
+    UnpackColors([a], PackColors([b]))
+    self.assertEqual(a.color().getRgb(), (1,2,3,4))
+
+  def test_Merge(self):
+    def entry(ids, before, after, coalesce='drag'):
+      e = UndoEntry('Move', coalesce)
+      e.ids.extend(ids)
+      (e.before, e.after) = (array.array('d', [before] * 6 * len(ids)), array.array('d', [after] * 6 * len(ids)))
+      return e
+    a = entry([1, 2], 0, 1)
+    self.assertTrue(a)
+    self.assertEqual(a.nbytes(), 2*8 + 2*2*6*8)
+    b = entry([1, 2], 1, 2)
+    self.assertTrue(a.canMerge(b))
+    a.merge(b)
+    self.assertEqual((a.before[0], a.after[0]), (0, 2))
+    self.assertFalse(a.canMerge(entry([1, 3], 2, 3)))
+    self.assertFalse(a.canMerge(entry([1, 2], 2, 3, None)))
+    self.assertFalse(entry([1], 0, 1, None).canMerge(entry([1], 1, 2, None)))
+    self.assertFalse(UndoEntry('Nothing'))
+
+class TestUndoStack(unittest.TestCase):
+
+  def setUp(self):
+    import tilelog, tileitems
+    from tilescene import TileScene
+    from tileitems import PolygonTileItem, RegularPolygon
+    tileitems.logger = tilelog.NotLogger()
+    self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([__file__])
+    self.scene = TileScene(tilelog.NotLogger())
+    self.stack = self.scene.undoStack
+    self.tiles = [ PolygonTileItem(polygon=RegularPolygon(4)) for k in range(3) ]
+    with self.stack.suspended():
+      for it in self.tiles:
+        self.scene.addItem(it)
+    self.changes = []
+    self.scene.tileChanged.connect(self.changes.append)
+
+  def undoRedo(self, undone, redone):
+    'Undo, check undone(), redo, check redone(), each emitting tileChanged once.'
+    del self.changes[:]
+    self.stack.undo()
+    undone()
+    self.assertEqual(len(self.changes), 1)
+    self.stack.redo()
+    redone()
+    self.assertEqual(len(self.changes), 2)
+
+  def test_Move(self):
+    (a, b, _c) = self.tiles
+    with self.stack.record('Move', [a, b], coalesce='drag'):
+      a.setPos(2, 3)
+    with self.stack.record('Move', [a, b], coalesce='drag'):
+      b.setTransform(QtGui.QTransform().rotate(90))
+    self.assertEqual((len(self.stack._undo), self.stack.undoText()), (1, 'Move'))  # merged
+    t = b.sceneTransform()
+    self.undoRedo( lambda: self.assertEqual((a.sceneTransform(), b.sceneTransform()), (QtGui.QTransform(),)*2)
+                 , lambda: self.assertEqual((a.sceneTransform().dx(), b.sceneTransform()), (2, t)) )
+    with self.stack.record('Move', [a, b], coalesce='drag'):
+      a.setPos(1, 1)
+    self.assertEqual(len(self.stack._undo), 2)  # not merged across an undo
+
+  def test_Color(self):
+    a = self.tiles[0]
+    old = a.color().rgba()
+    with self.stack.record('Color', [a], transforms=False, colors=True):
+      a.setColor(QtGui.QColor(255, 0, 0))
+    self.undoRedo( lambda: self.assertEqual(a.color().rgba(), old)
+                 , lambda: self.assertEqual(a.color().getRgb(), (255, 0, 0, 255)) )
+
+  def test_Delete(self):
+    a = self.tiles[0]
+    a.setPos(1, 1)
+    self.scene.selectItems([a])
+    self.scene.removeSelection()
+    self.assertIsNone(a.scene())
+    self.assertEqual(self.stack.undoText(), 'Delete')
+    self.undoRedo( lambda: self.assertIs(a.scene(), self.scene)
+                 , lambda: self.assertIsNone(a.scene()) )
+    self.stack.undo()
+    self.assertEqual(a.sceneTransform().dx(), 1)
+    self.assertFalse(a.isSelected())
+
+  def test_ChangeAfterUndo(self):
+    a = self.tiles[0]
+    with self.stack.record('Move', [a]):
+      a.setPos(1, 0)
+    self.stack.undo()
+    with self.stack.record('Move', [a]):  # drops the redo entry, which has the same tile
+      a.setPos(5, 0)
+    self.assertTrue(self.stack.isTracked(a))
+    self.stack.undo()
+    self.assertEqual(a.sceneTransform(), QtGui.QTransform())
+    self.assertFalse(self.stack.canUndo())
+    self.stack.redo()
+    self.assertEqual(a.sceneTransform().dx(), 5)
+
+  def test_Evict(self):
+    (a, b, c) = self.tiles
+    with self.stack.record('Nothing', [c]):
+      pass
+    self.assertFalse(self.stack.canUndo())
+    self.assertFalse(self.stack.isTracked(c))
+    self.stack.setMemoryLimit(250)  # room for 2 entries for 1 tile each
+    for (k, it) in enumerate(self.tiles):
+      with self.stack.record('Move', [it]):
+        it.setPos(k, k)
+    self.assertLessEqual(self.stack.memoryUsed(), 250)
+    self.assertEqual(len(self.stack._undo), 2)
+    self.assertEqual([ self.stack.isTracked(it) for it in self.tiles ], [False, True, True])
+    self.stack.undo()
+    with self.stack.record('Move', [a]):  # drops the redo entry for c
+      a.setPos(5, 5)
+    self.assertEqual([ self.stack.isTracked(it) for it in self.tiles ], [True, True, False])
+    self.stack.clear()
+    self.assertFalse(any(self.stack.isTracked(it) for it in self.tiles))
+
+if __name__=='__main__':
+  unittest.main()
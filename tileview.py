@@ -1,6 +1,7 @@
 
 import math
 from PyQt5 import QtCore, QtGui, QtWidgets
+from framepacer import FramePacer
 
 UNIT_LINE = QtCore.QLineF( 0.0,0.0, 1.0,0.0 )
 
@@ -27,6 +28,10 @@ class TileView(QtWidgets.QGraphicsView):
     #self.dragMode = QtWidgets.QGraphicsView.ScrollHandDrag  # what to do wtih mouse clicks not caught by a GraphicsItem
     self._drag_type = self.DRAG_NONE
     self._drag_start_pos = None
+    # Mouse moves only record the latest position; the drag is updated once per frame.
+    self._drag_pacer = FramePacer(self.updateDragTo, parent=self)
+    # Stored tiles (of a lazily loaded document) are turned into items as they come into view.
+    self._store_pacer = FramePacer(self.syncStoredTiles, frameRate=10, parent=self)
     self._rubberBandItem = QtWidgets.QGraphicsPolygonItem()
     self._rubberBandItem.setZValue(2)
     self._rubberBandItem.setBrush(QtGui.QBrush(QtGui.QColor(255,255,0,31)))
@@ -58,6 +63,14 @@ class TileView(QtWidgets.QGraphicsView):
     self.ZoomRel(32)      # Unit square defaults to 32 px square view
     self.centerOn(0,0)    # QABstractScrollArea's panning overrides the QGraphicsView's transform translation.
 
+  def paintEvent(self, evt):
+    if not self.scene().tileStore() is None:
+      self._store_pacer.post()
+    super().paintEvent(evt)
+
+  def syncStoredTiles(self):
+    self.scene().syncStoredTiles(self.mapToScene(self.viewport().rect()).boundingRect())
+
   ZOOM_FACTOR=math.sqrt(2)
 
   def ZoomRel(self, f=1.0):
@@ -79,9 +92,22 @@ class TileView(QtWidgets.QGraphicsView):
     f = self.ZOOM_FACTOR ** (mouseEvt.angleDelta().y() / 120.0)  # 120 = 15 degrees = 1 typical wheel step
     self.ZoomRel(f)
 
+  def startDragPacing(self):
+    self._drag_pacer.cancel()
+    self._drag_pacer.setFrameRate(self.scene().dragFrameRate)
+    self._drag_pacer.resetCounters()
+
+  def updateDragTo(self, pos, modifiers):
+    'Continue whatever kind of dragging may be happening, given the latest mouse position.'
+    if self._drag_type == self.DRAG_SELECT:
+      self.updateSelectDrag(pos)
+    elif self._drag_type != self.DRAG_NONE:
+      self.updateXformDrag(pos, modifiers)
+
   def startXformDrag(self, mouseEvt, drag_type):
     'Start dragging a transformation of the view.'
     if drag_type == self.DRAG_NONE: return
+    self.startDragPacing()
     self._drag_type = drag_type
     self._drag_start_xform = self.transform()
     self._drag_start_scrollValues = (self.horizontalScrollBar().value(), self.verticalScrollBar().value())
@@ -89,15 +115,15 @@ class TileView(QtWidgets.QGraphicsView):
     self._drag_start_vector = QtCore.QLineF(self.rect().center(), self._drag_start_pos)
     self.setCursor(QtCore.Qt.ClosedHandCursor)
 
-  def updateXformDrag(self, mouseEvt):
-    'Continue dragging a transformation of the view.'
-    invert_snap = bool(mouseEvt.modifiers() & QtCore.Qt.ControlModifier)
+  def updateXformDrag(self, pos, modifiers):
+    'Continue dragging a transformation of the view, given the mouse position and keyboard modifiers.'
+    invert_snap = bool(modifiers & QtCore.Qt.ControlModifier)
     if self._drag_type == self.DRAG_PAN:
-      offset = mouseEvt.pos() - self._drag_start_pos
+      offset = pos - self._drag_start_pos
       self.horizontalScrollBar().setValue(self._drag_start_scrollValues[0] - offset.x())
       self.verticalScrollBar().setValue(self._drag_start_scrollValues[1] - offset.y())
     elif self._drag_type == self.DRAG_ROLL:
-      move_vector = QtCore.QLineF(self.rect().center(), mouseEvt.pos())
+      move_vector = QtCore.QLineF(self.rect().center(), pos)
       theta = move_vector.angleTo(self._drag_start_vector)
       if invert_snap != self.scene().snapToAnglesEnabled:
         q = 360.0 / self._angular_resolution
@@ -107,61 +133,67 @@ class TileView(QtWidgets.QGraphicsView):
 
   def stopXformDrag(self):
     'Finish dragging a transformation of the view, keeping the changes.'
+    self._drag_pacer.flush()
     self.setCursor(QtCore.Qt.ArrowCursor)
     self._drag_type = self.DRAG_NONE
 
   def cancelXformDrag(self):
     'Abort dragging a transformation of the view, reverting to what it was.'
+    self._drag_pacer.cancel()
     self.setTransform(QtGui.QTransform(self._drag_start_xform))
     self.stopXformDrag()
 
   def startSelectDrag(self, mouseEvt):
     'Start dragging a selection rectangle.'
+    self.startDragPacing()
     self._drag_type = self.DRAG_SELECT
     self._drag_start_pos = mouseEvt.pos()
-    self._preexistingSelection = self.scene().selectionGroup.childItems()
+    self._preexistingSelection = set(self.scene().selectionGroup.childItems())
+    self._rubberBandedItems = set()  # selectable items in the rubber band as of the last update
     self._log.trace("{} pre-existing selections", len(self._preexistingSelection))
     self._rubberBandItem.setPolygon(QtGui.QPolygonF())
     self._rubberBandItem.show()
 
-  def updateSelectDrag(self, mouseEvt):
-    'Continue dragging the selection rectangle.'
-    viewIntRect = QtCore.QRect(self._drag_start_pos, mouseEvt.pos()).normalized()
+  def updateSelectDrag(self, pos):
+    'Continue dragging the selection rectangle to the given mouse position.'
+    viewIntRect = QtCore.QRect(self._drag_start_pos, pos).normalized()
     #if rectangle has in fact changed: #TODO
     #emit rubberBandChanged ?
     poly = self._rubberBandItem.mapFromScene(self.mapToScene(viewIntRect))
     self._rubberBandItem.setPolygon(poly)
-    rubberBandedItems = []
+    # Stored tiles only become selectable items if there aren't too many;
+    # otherwise just those promoted for the view are rubber banded.
+    self.scene().promoteStoredTiles(poly.boundingRect(), self.scene().PROMOTE_LIMIT)
+    group = self.scene().selectionGroup
+    rubberBandedItems = set()
     for it in self.scene().items(poly, deviceTransform=self.viewportTransform()):
-      if (    not it is self.scene().selectionGroup
+      if (    not it is group
           and it.isEnabled()
           and it.flags() & QtWidgets.QGraphicsItem.ItemIsSelectable):
-        rubberBandedItems.append(it)
-        if not it.isSelected():
-          it.setSelected(True)
-    if rubberBandedItems:
-      self._log.trace("{} items intersect rubberBand", len(rubberBandedItems))
-    deselectedItems = []
-    for it in self.scene().selectionGroup.childItems():
-      assert not it is self.scene().selectionGroup
-      if not (it in rubberBandedItems or it in self._preexistingSelection):
-        #if not it.collidesWithItem(self._rubberBandItem): # redundant
-          it.setSelected(False)
-          deselectedItems.append(it)
-    if deselectedItems:
-      self._log.trace("{} items removed from rubberBand", len(deselectedItems))
+        rubberBandedItems.add(it)
+    # Only touch the items that entered or left the rubber band since last time.
+    enteredItems = rubberBandedItems - self._rubberBandedItems
+    leftItems = self._rubberBandedItems - rubberBandedItems - self._preexistingSelection
+    self._rubberBandedItems = rubberBandedItems
+    if enteredItems:
+      self._log.trace("{} items entered rubberBand", len(enteredItems))
+      group.addTiles(enteredItems)
+    if leftItems:
+      self._log.trace("{} items removed from rubberBand", len(leftItems))
+      group.removeTiles(leftItems)
 
   def stopSelectDrag(self, mouseEvt):
     'Finish dragging the selection rectangle, keeping the selection.'
+    self._drag_pacer.flush()
     self._drag_type = self.DRAG_NONE
     self._rubberBandItem.hide()
     self.update()
 
   def cancelSelectDrag(self, mouseEvt):
     'Abort dragging the selection rectangle, reverting the the prior selection.'
-    for it in self.scene().selectionGroup.childItems():
-      if not it in self._preexistingSelection:
-        it.setSelected(False)
+    self._drag_pacer.cancel()
+    group = self.scene().selectionGroup
+    group.removeTiles(set(group.childItems()) - self._preexistingSelection)
     self.stopSelectDrag(mouseEvt)
 
   def stopDrag(self, mouseEvt):
@@ -190,6 +222,8 @@ class TileView(QtWidgets.QGraphicsView):
       self._log.trace("mouse grabbed: passing to super()")
       # Do standard QGraphicsView event multiplexing to scene's QGraphicsItem:
       return super().mousePressEvent(mouseEvt)
+    p = self.mapToScene(mouseEvt.pos())
+    self.scene().promoteStoredTiles(QtCore.QRectF(p, QtCore.QSizeF(1e-9, 1e-9)))
     items = self.items(mouseEvt.pos())
     for it in items:
       if it.isEnabled() and it.flags() & QtWidgets.QGraphicsItem.ItemIsSelectable:
@@ -219,11 +253,8 @@ class TileView(QtWidgets.QGraphicsView):
     # Ignore other buttons
 
   def mouseMoveEvent(self, mouseEvt):
-    if self._drag_type == self.DRAG_SELECT:
-      self.updateSelectDrag(mouseEvt)
-      mouseEvt.accept()
-    elif self._drag_type != self.DRAG_NONE:
-      self.updateXformDrag(mouseEvt)
+    if self._drag_type != self.DRAG_NONE:
+      self._drag_pacer.post(mouseEvt.pos(), mouseEvt.modifiers())
       mouseEvt.accept()
     else:
       super().mouseMoveEvent(mouseEvt)
@@ -236,6 +267,7 @@ class TileView(QtWidgets.QGraphicsView):
         mouseEvt.accept()
         return
       elif self._drag_type != self.DRAG_NONE:
+        self._drag_pacer.flush()
         self._drag_type = self.DRAG_NONE
         self.setCursor(QtCore.Qt.ArrowCursor)
         mouseEvt.accept()